@@ -0,0 +1,392 @@
+"""
+每本书的下载状态，保存在 `book_images/书籍id/` 目录中，重启之后不需要再扫描目录。
+
+    manifest.json     某一时刻的完整快照（书名、作者、总页数、书签、已下载页的位图、校验值）
+    manifest.journal  快照之后的每一次变化，一行一个 JSON，只追加
+
+只有图片已经完整写入、并且改名为最终文件名之后，才会在 journal 中记录这一页，
+所以崩溃时写了一半的图片不会被当成已经下载。
+
+journal 每一行都会立即 flush，但是 fsync 是攒一批（FSYNC_EVERY 行、FSYNC_INTERVAL 秒）才做一次，
+不会每保存一页就等一次磁盘。断电时最多丢掉最后几行，这些页下次会重新下载。
+
+这里只依赖标准库，子进程也会用到，不要在这里导入 settings、mylogger 等模块。
+"""
+
+import base64
+import hashlib
+import json
+import os
+import shutil
+import time
+import zlib
+from pathlib import Path
+
+
+def atomic_write_bytes(path: Path, data: bytes) -> None:
+    """
+    先写入临时文件，再改名为最终文件名，不会留下写了一半的文件。
+
+    临时文件名带上进程 id，多个实例同时写入同一个文件（比如 bookmark.json）时不会互相覆盖临时文件。
+    """
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def checksum(data: bytes) -> str:
+    return f"{zlib.crc32(data):08x}"
+
+
+def content_hash(data: bytes) -> str:
+    """用于判断内容是否完全相同（去重），比 checksum 可靠得多"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    """让 dst 成为和 src 内容相同的文件，优先使用硬链接，不占用额外的磁盘空间"""
+    tmp = dst.with_name(dst.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        # 文件系统不支持硬链接（比如 FAT32）
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class PageSet:
+    """
+    页码的集合，用位图保存：第 n 页对应第 n 位，1000 页的书只需要 126 个字节。
+
+    可以像 set 一样使用（add、discard、update、in、len、迭代），
+    另外可以把连续的页、缺少的页压缩成区间，用于生成补下载的计划。
+    """
+
+    def __init__(self, pages=()) -> None:
+        self._bits = bytearray()
+        self._count = 0
+        self.update(pages)
+
+    def add(self, page_num: int) -> None:
+        index, bit = divmod(page_num, 8)
+        if index >= len(self._bits):
+            self._bits.extend(bytes(index + 1 - len(self._bits)))
+        if not self._bits[index] & (1 << bit):
+            self._bits[index] |= 1 << bit
+            self._count += 1
+
+    def discard(self, page_num: int) -> None:
+        if page_num in self:
+            index, bit = divmod(page_num, 8)
+            self._bits[index] &= ~(1 << bit)
+            self._count -= 1
+
+    def update(self, pages) -> None:
+        for page_num in pages:
+            self.add(page_num)
+
+    def __contains__(self, page_num: int) -> bool:
+        index, bit = divmod(page_num, 8)
+        return 0 <= index < len(self._bits) and bool(self._bits[index] & (1 << bit))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self):
+        for start, end in self.ranges():
+            yield from range(start, end + 1)
+
+    def _runs(self, first: int, last: int, present: bool) -> list[tuple[int, int]]:
+        """[first, last] 中连续在（present 为 True）、不在集合中的页组成的区间"""
+        skip = 0xFF if not present else 0x00
+        runs = []
+        start = None
+        page_num = first
+        while page_num <= last:
+            index, bit = divmod(page_num, 8)
+            # 整个字节都不符合条件，一次跳过 8 页
+            if bit == 0 and start is None and page_num + 7 <= last:
+                byte = self._bits[index] if index < len(self._bits) else 0
+                if byte == skip:
+                    page_num += 8
+                    continue
+
+            if (page_num in self) == present:
+                if start is None:
+                    start = page_num
+            elif start is not None:
+                runs.append((start, page_num - 1))
+                start = None
+            page_num += 1
+
+        if start is not None:
+            runs.append((start, last))
+        return runs
+
+    def ranges(self) -> list[tuple[int, int]]:
+        """集合中的页组成的区间，比如 [(1, 3), (5, 5)]"""
+        return self._runs(0, len(self._bits) * 8 - 1, True)
+
+    def missing_ranges(self, total_page: int) -> list[tuple[int, int]]:
+        """第 1 ~ total_page 页中不在集合里的页组成的区间"""
+        return self._runs(1, total_page, False)
+
+    pass
+
+
+def format_ranges(ranges: list[tuple[int, int]]) -> str:
+    """[(1, 3), (5, 5)] => '1-3, 5'"""
+    return ", ".join(
+        str(start) if start == end else f"{start}-{end}" for start, end in ranges
+    )
+
+
+def pages_to_bitmap(pages) -> str:
+    """页码集合 => base64 编码的位图，第 n 页对应第 n 位"""
+    if not pages:
+        return ""
+    if isinstance(pages, PageSet):
+        return base64.b64encode(bytes(pages._bits)).decode()
+
+    bitmap = bytearray(max(pages) // 8 + 1)
+    for page_num in pages:
+        bitmap[page_num // 8] |= 1 << (page_num % 8)
+    return base64.b64encode(bytes(bitmap)).decode()
+
+
+def bitmap_to_pages(text: str) -> set[int]:
+    """base64 编码的位图 => 页码集合"""
+    pages = set()
+    for i, byte in enumerate(base64.b64decode(text)):
+        if not byte:
+            continue
+        for bit in range(8):
+            if byte & (1 << bit):
+                pages.add(i * 8 + bit)
+    return pages
+
+
+IMAGE_SUFFIXES = ("webp", "jpeg", "jpg", "png")
+"图片可能的扩展名，旧版本的 manifest 没有记录每一页的格式时，依次尝试"
+
+
+class BookManifest:
+    """一本书的下载状态，每次变化都会先追加到 journal 中，journal 过长时再合并为新的快照"""
+
+    VERSION = 1
+    COMPACT_EVERY = 200
+    "journal 超过多少行之后合并为快照"
+    FSYNC_EVERY = 32
+    "journal 每追加多少行 fsync 一次"
+    FSYNC_INTERVAL = 2.0
+    "距离上次 fsync 超过多少秒之后，下一次追加时立即 fsync"
+
+    def __init__(self, path: Path, shared: bool = False) -> None:
+        self.path = path
+        "书籍图片所在的目录"
+        self.shared = shared
+        """
+        多个实例同时追加 journal 时不能自动合并为快照，否则其它实例之后追加的记录会写进已经删除的 journal；
+        也不能截断 journal 中不完整的一行，它可能是其它实例正在追加的
+        """
+        self.snapshot_path = path / "manifest.json"
+        self.journal_path = path / "manifest.journal"
+
+        self.name = ""
+        self.author = ""
+        self.total_page = 0
+        self.bookmark = None
+        self.pages: dict[int, list] = {}
+        "已经下载的页 => [校验值, 文件大小, 内容的哈希值]，旧版本记录的页没有哈希值"
+        self.suffixes: dict[int, str] = {}
+        """
+        已经下载的页 => 图片文件的扩展名（比如 webp），旧版本记录的页没有。
+        下载到一半修改了 picture_format 时，同一本书的图片格式可能不一样，所以每一页都要记录
+        """
+
+        self._journal = None
+        self._journal_lines = 0
+        self._unsynced = 0
+        "已经写入、但是还没有 fsync 的行数"
+        self._synced_at = time.monotonic()
+
+    def exists(self) -> bool:
+        return self.snapshot_path.exists() or self.journal_path.exists()
+
+    def load(self, repair: bool = True) -> None:
+        """
+        读取快照，然后重放 journal。
+
+        repair 为 True 时会截断 journal 中不完整的最后一行，只有之后要追加 journal 的实例才需要；
+        只读取的进程（合并进程、rebuild）不要修复，那一行可能是代理正在追加的。
+        """
+        if self.snapshot_path.exists():
+            data = json.loads(self.snapshot_path.read_text(encoding="utf-8"))
+            self.name = data["name"]
+            self.author = data["author"]
+            self.total_page = data["total_page"]
+            self.bookmark = data["bookmark"]
+            checksums = data["checksums"]
+            suffixes = data.get("suffixes", {})
+            for page_num in bitmap_to_pages(data["pages"]):
+                self.pages[page_num] = checksums[str(page_num)]
+                if str(page_num) in suffixes:
+                    self.suffixes[page_num] = suffixes[str(page_num)]
+
+        if self.journal_path.exists():
+            data = self.journal_path.read_bytes()
+            good = 0  # 完整记录的字节数
+            for line in data.splitlines(keepends=True):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                # 崩溃时最后一行可能只写了一半
+                if record is None or not line.endswith(b"\n"):
+                    if self.shared or not repair:
+                        # 也可能是其它实例正在追加的一行，跳过它，不能截断
+                        continue
+                    break
+                self._apply(record)
+                self._journal_lines += 1
+                good += len(line)
+
+            # 去掉不完整的部分，否则之后追加的记录就接在半行后面了
+            if good < len(data) and repair and not self.shared:
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(good)
+
+    def _apply(self, record: dict) -> None:
+        op = record["op"]
+        if op == "info":
+            self.name = record["name"]
+            self.author = record["author"]
+            self.total_page = record["total_page"]
+        elif op == "bookmark":
+            self.bookmark = record["bookmark"]
+        elif op == "page":
+            self.pages[record["p"]] = [record["c"], record["s"]]
+            if "h" in record:
+                self.pages[record["p"]].append(record["h"])
+            if "f" in record:
+                self.suffixes[record["p"]] = record["f"]
+            else:
+                self.suffixes.pop(record["p"], None)
+        elif op == "drop":
+            self.pages.pop(record["p"], None)
+            self.suffixes.pop(record["p"], None)
+
+    def _append(self, record: dict) -> None:
+        self._apply(record)
+
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        # flush 之后其它进程（合并进程、其它实例）就能读到这一行了，fsync 只是为了断电时不丢
+        self._journal.flush()
+        self._unsynced += 1
+        if (
+            self._unsynced >= self.FSYNC_EVERY
+            or time.monotonic() - self._synced_at >= self.FSYNC_INTERVAL
+        ):
+            self.sync()
+
+        self._journal_lines += 1
+        if not self.shared and self._journal_lines >= self.COMPACT_EVERY:
+            self.compact()
+
+    def set_info(self, name: str, author: str, total_page: int) -> None:
+        self._append(
+            {"op": "info", "name": name, "author": author, "total_page": total_page}
+        )
+
+    def set_bookmark(self, bookmark) -> None:
+        self._append({"op": "bookmark", "bookmark": bookmark})
+
+    def add_page(
+        self,
+        page_num: int,
+        page_checksum: str,
+        size: int,
+        page_hash: str = "",
+        suffix: str = "",
+    ) -> None:
+        """
+        第 page_num 页已经完整地保存到磁盘上了，图片文件为 `page_num.suffix`。
+
+        page_hash 是这一页 6 个小图片的哈希值，用于发现内容完全相同的页。
+        """
+        record = {"op": "page", "p": page_num, "c": page_checksum, "s": size}
+        if page_hash:
+            record["h"] = page_hash
+        if suffix:
+            record["f"] = suffix
+        self._append(record)
+
+    def page_file(self, page_num: int, default_suffix: str) -> Path:
+        """
+        第 page_num 页的图片文件。
+
+        旧版本记录的页没有扩展名，先尝试 default_suffix（当前的 picture_format），找不到时再尝试其它格式。
+        """
+        suffix = self.suffixes.get(page_num)
+        if suffix:
+            return self.path / f"{page_num}.{suffix}"
+
+        path = self.path / f"{page_num}.{default_suffix}"
+        if not path.exists():
+            for other in IMAGE_SUFFIXES:
+                candidate = self.path / f"{page_num}.{other}"
+                if candidate.exists():
+                    return candidate
+        return path
+
+    def page_files(self, default_suffix: str) -> list[tuple[int, Path]]:
+        """所有已经下载的页的 (页码, 图片文件)，按页码排序"""
+        return [
+            (page_num, self.page_file(page_num, default_suffix))
+            for page_num in sorted(self.pages)
+        ]
+
+    def drop_page(self, page_num: int) -> None:
+        """第 page_num 页不再视为已下载（比如图片损坏了）"""
+        self._append({"op": "drop", "p": page_num})
+
+    def compact(self) -> None:
+        """把当前状态写成新的快照，然后清空 journal"""
+        data = {
+            "version": self.VERSION,
+            "name": self.name,
+            "author": self.author,
+            "total_page": self.total_page,
+            "bookmark": self.bookmark,
+            "pages": pages_to_bitmap(self.pages),
+            "checksums": {str(p): value for p, value in self.pages.items()},
+            "suffixes": {str(p): value for p, value in self.suffixes.items()},
+        }
+        atomic_write_bytes(
+            self.snapshot_path, json.dumps(data, ensure_ascii=False).encode("utf-8")
+        )
+
+        self.close()
+        self.journal_path.unlink(missing_ok=True)
+        self._journal_lines = 0
+
+    def sync(self) -> None:
+        """把还没有 fsync 的 journal 写到磁盘上"""
+        if self._journal is not None and self._unsynced:
+            os.fsync(self._journal.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def close(self) -> None:
+        if self._journal is not None:
+            self.sync()
+            self._journal.close()
+            self._journal = None
+
+    pass
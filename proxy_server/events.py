@@ -0,0 +1,108 @@
+"""
+通过本地接口 /events 向浏览器（翻页脚本）推送事件，使用 SSE（Server-Sent Events）。
+
+事件在代理的事件循环中发布，每个连接在本地接口的线程中读取自己的队列并写入响应，
+连接很慢的时候只会丢掉它最旧的事件，不会卡住事件循环。
+"""
+
+import json
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler
+
+from mylogger import logger
+
+__all__ = ["event_bus"]
+
+
+class EventBus:
+
+    MAX_QUEUE = 256
+    "每个连接最多积压多少条事件"
+    HEARTBEAT = 15
+    "多少秒没有事件时发送一次注释行，及时发现已经断开的连接"
+
+    def __init__(self) -> None:
+        self._subscribers: list[queue.Queue] = []
+        self._lock = threading.Lock()
+        self.published = 0
+        "发布的事件数量"
+        self.dropped = 0
+        "因为连接太慢而丢掉的事件数量"
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, event: str, data: dict) -> None:
+        """发布事件，没有连接时什么也不做"""
+        if not self._subscribers:
+            return
+
+        message = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        self.published += 1
+        with self._lock:
+            for q in self._subscribers:
+                try:
+                    q.put_nowait(message)
+                except queue.Full:
+                    # 丢掉最旧的事件，给新的事件腾出位置
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+                    q.put_nowait(message)
+                    self.dropped += 1
+
+    def stream(
+        self, handler: BaseHTTPRequestHandler, initial: list[tuple[str, dict]] = ()
+    ) -> None:
+        """
+        在本地接口的线程中持续推送事件，直到连接断开或者调用了 close。
+
+        initial 是连接建立之后立即发送的事件（比如当前建议的翻页间隔）。
+        """
+        q: queue.Queue = queue.Queue(self.MAX_QUEUE)
+        for event, data in initial:
+            q.put_nowait(
+                f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+            )
+        with self._lock:
+            self._subscribers.append(q)
+
+        try:
+            handler.send_response(200)
+            handler.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            handler.send_header("Cache-Control", "no-cache")
+            handler.send_cors_headers()
+            handler.end_headers()
+
+            while True:
+                try:
+                    message = q.get(timeout=self.HEARTBEAT)
+                except queue.Empty:
+                    message = ": ping\n\n"
+                if message is None:
+                    break
+                handler.wfile.write(message.encode("utf-8"))
+                handler.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug("事件推送的连接已断开")
+        finally:
+            with self._lock:
+                self._subscribers.remove(q)
+
+    def close(self) -> None:
+        """结束所有连接"""
+        with self._lock:
+            for q in self._subscribers:
+                try:
+                    q.put_nowait(None)
+                except queue.Full:
+                    q.get_nowait()
+                    q.put_nowait(None)
+
+    pass
+
+
+event_bus = EventBus()
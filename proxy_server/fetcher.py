@@ -0,0 +1,309 @@
+"""
+主动下载模式：不用等浏览器一页一页地翻，直接用代理抓到的会话（cookie、请求头）自己请求缺少的页。
+
+流程和浏览器一样，每一页的每个小图片：
+    1. 请求 once/get，得到加密的 encode_zn
+    2. 用 encode_zn 请求 lmg，得到小图片
+
+两个响应都交给 WQBookAddon.dispatch 处理，和浏览器的请求走完全相同的流程（SplitPageOrder、WQBook.add_split_page）。
+
+请求的参数 k 是 jwt，需要用网站的密钥签名，所以这里以抓到的 k 为模板，只替换书籍 id、页码等字段，
+再用 settings 中的 fetch_jwt_secret 重新签名。密钥不对的话网站会拒绝请求，这时只能继续用浏览器翻页。
+"""
+
+import asyncio
+import http.client
+import json
+import time
+import urllib.parse
+from collections.abc import Awaitable, Callable
+
+import utils
+from mylogger import logger
+from settings import settings
+from wqbook import SplitPageOrder, WQBook
+
+__all__ = ["PageFetcher"]
+
+
+SKIP_HEADERS = {
+    "host",
+    "content-length",
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+    "accept-encoding",
+    "proxy-connection",
+}
+"抓到的请求头中不能原样转发的部分，accept-encoding 去掉之后响应不会被压缩"
+
+
+class CapturedSession:
+    """代理抓到的会话：网站地址、请求头，以及参数 k 的模板"""
+
+    def __init__(self) -> None:
+        self.scheme = ""
+        self.host = ""
+        self.port = 0
+        self.headers: dict[str, str] = {}
+        self.once_get_k: dict | None = None
+        "once/get 请求参数 k 解密后的内容，用作模板"
+        self.lmg_k: dict | None = None
+        "lmg 请求参数 k 解密后的内容，用作模板"
+
+    def capture(self, route: str, request) -> None:
+        """记录 mitmproxy 的请求，route 是请求对应的接口名称"""
+        if route not in ("req_before_split_page", "split_page"):
+            return
+
+        self.scheme = request.scheme
+        self.host = request.host
+        self.port = request.port
+        self.headers = {
+            name: value
+            for name, value in request.headers.items()
+            if not name.startswith(":") and name.lower() not in SKIP_HEADERS
+        }
+
+        k = urllib.parse.parse_qs(urllib.parse.urlsplit(request.url).query).get("k")
+        data = utils.jwt_decrypt(k[0]) if k else {}
+        if not data:
+            return
+        if route == "req_before_split_page":
+            self.once_get_k = dict(data)
+        else:
+            self.lmg_k = dict(data)
+
+    @property
+    def ready(self) -> bool:
+        """至少抓到了一次 once/get、lmg 请求，才能自己请求"""
+        return bool(self.host and self.once_get_k and self.lmg_k)
+
+    @property
+    def netloc(self) -> str:
+        default_port = 443 if self.scheme == "https" else 80
+        return self.host if self.port == default_port else f"{self.host}:{self.port}"
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.scheme}://{self.netloc}"
+
+    def _sign(self, template: dict, **fields) -> str:
+        # 只有开启了主动下载才会用到，不在启动时导入
+        import jwt
+
+        payload = dict(template, **fields)
+        # 有过期时间的话，按照模板的有效期顺延
+        if "iat" in template and "exp" in template:
+            now = int(time.time())
+            payload["exp"] = now + template["exp"] - template["iat"]
+            payload["iat"] = now
+        return jwt.encode(payload, settings["fetch_jwt_secret"], algorithm="HS256")
+
+    def once_get_url(self, bid: int, page_num: int, zn: int) -> str:
+        k = self._sign(self.once_get_k, b=bid, p=page_num, zn=zn)
+        path = settings["api"]["req_before_split_page"]
+        return f"{self.base_url}{path}?bid={bid}&pnum={page_num}&k={k}"
+
+    def lmg_url(self, bid: int, page_num: int, encode_zn: str) -> str:
+        k = self._sign(self.lmg_k, b=bid, p=page_num, k=json.dumps({"zn": encode_zn}))
+        path = settings["api"]["split_page"]
+        return f"{self.base_url}{path}/{bid}/{page_num}?k={k}"
+
+    pass
+
+
+class ConnectionPool:
+    """
+    保持长连接的 HTTP 连接池，最多 size 个连接，同时也就最多 size 个请求。
+
+    请求在线程中执行，不会卡住事件循环。
+    只依赖标准库的 http.client，不需要为此安装 aiohttp、httpx 等异步客户端。
+    """
+
+    def __init__(self, session: CapturedSession, size: int, rate: float) -> None:
+        self.session = session
+        self.size = max(1, size)
+        self.rate = rate
+        "每秒最多发出多少个请求，为 0 表示不限制"
+        self._idle: list[http.client.HTTPConnection] = []
+        self._slots = asyncio.Semaphore(self.size)
+        self._next_time = 0.0
+
+        self.requests = 0
+        "发出的请求数量"
+        self.errors = 0
+        "失败的请求数量"
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.session.scheme == "https":
+            return http.client.HTTPSConnection(
+                self.session.host, self.session.port, timeout=30
+            )
+        return http.client.HTTPConnection(
+            self.session.host, self.session.port, timeout=30
+        )
+
+    async def _wait_rate(self) -> None:
+        """按照固定的间隔放行请求"""
+        if not self.rate:
+            return
+        now = time.monotonic()
+        wait = self._next_time - now
+        self._next_time = max(now, self._next_time) + 1 / self.rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def get(self, url: str) -> tuple[int, bytes]:
+        """返回 (状态码, 响应体)"""
+        parts = urllib.parse.urlsplit(url)
+        path = f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+        async with self._slots:
+            await self._wait_rate()
+            conn = self._idle.pop() if self._idle else self._connect()
+            self.requests += 1
+            try:
+                status, body = await asyncio.to_thread(self._request, conn, path)
+            except Exception:
+                self.errors += 1
+                conn.close()
+                raise
+            self._idle.append(conn)
+            return status, body
+
+    def _request(self, conn: http.client.HTTPConnection, path: str):
+        headers = dict(self.session.headers, Host=self.session.netloc)
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # 长连接被服务器关掉了，重新连接一次
+            conn.close()
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+        return response.status, response.read()
+
+    def close(self) -> None:
+        for conn in self._idle:
+            conn.close()
+        self._idle.clear()
+
+    pass
+
+
+class PageFetcher:
+    """主动请求书籍缺少的页"""
+
+    def __init__(
+        self,
+        dispatch: Callable[[str, bytes], Awaitable[None]],
+        split_page_order: SplitPageOrder,
+    ) -> None:
+        self.dispatch = dispatch
+        "WQBookAddon.dispatch，响应交给它处理"
+        self.split_page_order = split_page_order
+        self.session = CapturedSession()
+        self.concurrency = settings["fetch_concurrency"]
+        "同时请求多少页，为 0 表示不开启主动下载"
+        self.pool = ConnectionPool(
+            self.session, self.concurrency, settings["fetch_rate_limit"]
+        )
+        self.tasks: dict[int, asyncio.Task] = {}
+        "书籍 id => 正在进行的下载任务"
+
+    @property
+    def enabled(self) -> bool:
+        return self.concurrency > 0 and bool(settings["fetch_jwt_secret"])
+
+    def start(self, book: WQBook, again: bool = False) -> bool:
+        """
+        开始下载书籍缺少的页，已经在下载、还不能下载时返回 False。
+
+        需要知道书籍的总页数，并且已经抓到了 once/get、lmg 请求。
+        每本书只会自动下载一次，again 为 True 时（比如通过本地接口）会再下载一次仍然缺少的页。
+        """
+        if not self.enabled or not self.session.ready or not book.total_page:
+            return False
+
+        task = self.tasks.get(book.bid)
+        if task is not None and (not again or not task.done()):
+            return False
+
+        self.tasks[book.bid] = asyncio.ensure_future(self.fetch_book(book))
+        return True
+
+    async def fetch_book(self, book: WQBook) -> None:
+        missing = list(book.missing_pages())
+        if not missing:
+            return
+
+        logger.info(
+            f"开始主动下载书籍 <{book.bid}> 缺少的 <{len(missing)}> 页，并发 <{self.concurrency}>"
+        )
+        start = time.perf_counter()
+        queue = iter(missing)
+
+        async def worker():
+            for page_num in queue:
+                if book.paused:
+                    return
+                if book.is_page_downloaded(page_num):
+                    continue
+                if await book.claim_page(page_num):
+                    await self._fetch_page(book.bid, page_num)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        logger.info(
+            f"书籍 <{book.bid}> 主动下载结束，用时 <{time.perf_counter() - start:.1f}s>，"
+            f"请求 <{self.pool.requests}> 次，失败 <{self.pool.errors}> 次"
+        )
+
+    async def _fetch_page(self, bid: int, page_num: int) -> None:
+        """请求一页的 6 个小图片，失败的小图片会重试"""
+        for zn in range(6):
+            for attempt in range(settings["fetch_retries"] + 1):
+                try:
+                    await self._fetch_tile(bid, page_num, zn)
+                    break
+                except Exception as e:
+                    logger.limited(
+                        "error",
+                        "fetch_tile",
+                        "主动下载书籍 <%s> 的第 <%s> 页的第 <%s> 个小图片失败 <%s> 次: %s",
+                        bid,
+                        page_num,
+                        zn,
+                        attempt + 1,
+                        e,
+                    )
+                    # 最后一次失败之后不用再等了
+                    if attempt < settings["fetch_retries"]:
+                        await asyncio.sleep(2**attempt)
+
+    async def _fetch_tile(self, bid: int, page_num: int, zn: int) -> None:
+        url = self.session.once_get_url(bid, page_num, zn)
+        status, body = await self.pool.get(url)
+        if status != 200:
+            raise ValueError(f"once/get 响应状态码 {status}")
+        await self.dispatch(url, body)
+
+        k = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)["k"][0]
+        decoded = self.split_page_order.decode(k, json.loads(body)["data"])
+        if decoded is None:
+            raise ValueError("once/get 响应解密失败")
+
+        url = self.session.lmg_url(bid, page_num, decoded[3])
+        status, body = await self.pool.get(url)
+        if status != 200:
+            raise ValueError(f"lmg 响应状态码 {status}")
+        await self.dispatch(url, body)
+
+    async def stop(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks.clear()
+        self.pool.close()
+
+    pass
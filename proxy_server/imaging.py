@@ -0,0 +1,328 @@
+"""
+图片的拼接、编码。
+
+这里的函数会在子进程中执行，所以只能依赖 PIL，
+不要在这里导入 settings、mylogger 等模块（它们会在子进程中重复创建目录、日志文件）。
+
+PIL 在函数中才导入，代理进程只用到 SavedPage 时不需要加载它，启动更快。
+"""
+
+import time
+import zlib
+from io import BytesIO
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+from book_state import atomic_write_bytes, checksum
+from pdf_writer import PdfImage
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+class SavedPage(NamedTuple):
+    """保存好的一页"""
+
+    checksum: str
+    "图片文件的校验值"
+    size: int
+    "图片文件的大小"
+    pdf_image: PdfImage | None
+    "用于嵌入 PDF 的数据，不需要时为 None"
+    stitch_seconds: float = 0.0
+    "拼接小图片的耗时"
+    encode_seconds: float = 0.0
+    "编码整页图片的耗时（包括编码用于嵌入 PDF 的数据）"
+    write_seconds: float = 0.0
+    "写入磁盘的耗时"
+    kind: str = ""
+    "这一页的类型，见 classify_page，没有分类时为空字符串"
+    classify_seconds: float = 0.0
+    "分类的耗时"
+    duplicate_of: int = 0
+    "和之前的某一页内容完全相同时，为那一页的页码，这时没有拼接、编码，图片文件是链接过去的"
+    suffix: str = ""
+    "图片文件的扩展名，比如 webp"
+
+
+BILEVEL = "bilevel"
+GRAY = "gray"
+COLOR = "color"
+
+CHROMA_TOLERANCE = 12
+"Cb、Cr 偏离 128 不超过这个值的像素认为是无色的（JPEG、webp 压缩会让灰色带上一点颜色）"
+COLOR_RATIO = 0.005
+"有颜色的像素超过这个比例，就是彩色页"
+MIDTONE_RANGE = (48, 208)
+"亮度在这个范围内的像素是中间调（灰色）"
+MIDTONE_RATIO = 0.04
+"中间调的像素不超过这个比例，就是黑白页（文字边缘的抗锯齿会有少量中间调）"
+
+
+def stitch_page(split_pages: list[bytes]) -> "Image.Image":
+    """根据顺序，将 6 个小图片横向拼接成一张完整的图片"""
+    from PIL import Image
+
+    # 根据 bytes 生成 image 对象
+    images = [Image.open(BytesIO(data)) for data in split_pages]
+
+    # 计算横向合并时、最终图片的宽高
+    widths, heights = zip(*(image.size for image in images))
+    total_width = sum(widths)
+    max_height = max(heights)
+
+    # 生成大图片，将其它小图片的内容绘制上去
+    new_image = Image.new("RGB", (total_width, max_height))
+    x_offset = 0
+    for image in images:
+        new_image.paste(image, (x_offset, 0))
+        x_offset += image.size[0]
+
+    return new_image
+
+
+def _ratio_outside(histogram: list[int], low: int, high: int) -> float:
+    """直方图中 [low, high] 之外的像素比例"""
+    total = sum(histogram)
+    inside = sum(histogram[low : high + 1])
+    return (total - inside) / total if total else 0.0
+
+
+def classify_page(image: "Image.Image") -> str:
+    """
+    根据直方图判断这一页是黑白（BILEVEL）、灰度（GRAY）还是彩色（COLOR）。
+
+    直方图由 PIL 在 C 代码中统计，不需要逐个像素地遍历。
+    """
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    if image.mode == "RGB":
+        _, cb, cr = image.convert("YCbCr").split()
+        low, high = 128 - CHROMA_TOLERANCE, 128 + CHROMA_TOLERANCE
+        colored = max(
+            _ratio_outside(cb.histogram(), low, high),
+            _ratio_outside(cr.histogram(), low, high),
+        )
+        if colored > COLOR_RATIO:
+            return COLOR
+
+    # 中间调 = 1 - 两端的比例
+    low, high = MIDTONE_RANGE
+    histogram = image.convert("L").histogram()
+    midtone = 1 - _ratio_outside(histogram, low + 1, high - 1)
+    return BILEVEL if midtone <= MIDTONE_RATIO else GRAY
+
+
+def to_bilevel_image(image: "Image.Image") -> PdfImage:
+    """
+    编码成 1 位的黑白图片：有 libtiff 时使用 CCITT G4，否则使用 Flate。
+
+    两种编码都是无损的，文字页通常比 JPEG 小好几倍。
+    """
+    from PIL import Image, features
+
+    bw = image.convert("L").point([0] * 128 + [255] * 128, "1")
+    width, height = bw.size
+
+    if features.check("libtiff"):
+        # 整页写成一个 strip，取出其中的 G4 数据
+        stream = BytesIO()
+        bw.save(stream, format="TIFF", compression="group4", tiffinfo={278: height})
+        with Image.open(stream) as tiff:
+            offsets, counts = tiff.tag_v2[273], tiff.tag_v2[279]
+        if len(offsets) == 1:
+            data = stream.getvalue()[offsets[0] : offsets[0] + counts[0]]
+            # libtiff 把值为 0 的像素（黑色）编码为 CCITT 中的白色，所以 BlackIs1 为 true
+            parms = f"/K -1 /Columns {width} /Rows {height} /BlackIs1 true"
+            return PdfImage(
+                width, height, "DeviceGray", 1, "CCITTFaxDecode", data, parms
+            )
+
+    # 每行按字节对齐，1 表示白色，和 PDF 的 DeviceGray 一致
+    data = zlib.compress(bw.tobytes(), 6)
+    return PdfImage(width, height, "DeviceGray", 1, "FlateDecode", data)
+
+
+def to_pdf_image(
+    image: "Image.Image", quality: int, kind: str | None = None
+) -> PdfImage:
+    """
+    把图片编码成可以直接嵌入 PDF 的数据。
+
+    kind 为 None 时是彩色或灰度 JPEG（保持图片原来的模式），否则按照 classify_page 的结果选择编码：
+    黑白页为 1 位的 CCITT G4 或 Flate，灰度页为 8 位灰度 JPEG，彩色页为彩色 JPEG。
+    """
+    if kind == BILEVEL:
+        return to_bilevel_image(image)
+    if kind == GRAY and image.mode != "L":
+        image = image.convert("L")
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    stream = BytesIO()
+    image.save(stream, format="JPEG", quality=quality)
+
+    color_space = "DeviceGray" if image.mode == "L" else "DeviceRGB"
+    return PdfImage(
+        image.width, image.height, color_space, 8, "DCTDecode", stream.getvalue()
+    )
+
+
+def is_jpeg_format(picture_format: str) -> bool:
+    return picture_format.lower() in ("jpeg", "jpg")
+
+
+def pdf_image_from_jpeg(data: bytes) -> PdfImage | None:
+    """
+    JPEG 数据可以原样作为 DCTDecode 嵌入 PDF，这里只读取文件头获取宽高，不会解码像素。
+
+    如果不是 PDF 能直接使用的 JPEG（比如 CMYK），则返回 None。
+    """
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as image:
+        if image.format != "JPEG" or image.mode not in ("RGB", "L"):
+            return None
+
+        color_space = "DeviceGray" if image.mode == "L" else "DeviceRGB"
+        return PdfImage(image.width, image.height, color_space, 8, "DCTDecode", data)
+
+
+def pdf_image_from_file(
+    filename: Path, quality: int, adaptive: bool = False
+) -> PdfImage:
+    """
+    读取已经保存好的图片，转换成可以直接嵌入 PDF 的数据。
+
+    JPEG 图片直接复制字节，其它格式才需要解码、再编码一次。
+    adaptive 为 True 时会按照页的类型选择编码，彩色 JPEG 依然直接复制，
+    灰度 JPEG 需要解码后确认是不是黑白页。
+    """
+    from PIL import Image
+
+    data = filename.read_bytes()
+    if data[:2] == b"\xff\xd8":
+        pdf_image = pdf_image_from_jpeg(data)
+        if pdf_image is not None:
+            if not adaptive or pdf_image.color_space == "DeviceRGB":
+                return pdf_image
+
+            with Image.open(BytesIO(data)) as image:
+                if classify_page(image) != BILEVEL:
+                    return pdf_image
+                return to_bilevel_image(image)
+
+    with Image.open(BytesIO(data)) as image:
+        kind = classify_page(image) if adaptive else None
+        return to_pdf_image(image, quality, kind)
+
+
+def save_full_page(
+    split_pages: list[bytes],
+    filename: Path,
+    picture_format: str,
+    picture_quality: int,
+    pdf_image: bool = False,
+    adaptive: bool = False,
+) -> SavedPage:
+    """
+    拼接 6 个小图片，并且保存为一张完整的图片。
+
+    图片先写入临时文件再改名，所以 filename 要么不存在，要么是完整的图片。
+    如果 pdf_image 为 True，还会返回这一页用于嵌入 PDF 的数据，省得合并时再读取、解码一次图片。
+    保存为 JPEG 时，图片文件和 PDF 用的是同一份编码结果，整个过程只编码一次。
+
+    adaptive 为 True 时，拼接之后先判断这一页是黑白、灰度还是彩色：
+    黑白、灰度页以灰度保存图片文件，嵌入 PDF 时黑白页使用 1 位的编码。
+    """
+    start = time.perf_counter()
+    new_image = stitch_page(split_pages)
+    stitched = time.perf_counter()
+
+    kind = ""
+    if adaptive:
+        kind = classify_page(new_image)
+        if kind != COLOR:
+            new_image = new_image.convert("L")
+    classified = time.perf_counter()
+
+    # 压缩一下图片大小
+    stream = BytesIO()
+    new_image.save(stream, format=picture_format, quality=picture_quality)
+    data = stream.getvalue()
+
+    result = None
+    if pdf_image:
+        if is_jpeg_format(picture_format) and kind != BILEVEL:
+            result = pdf_image_from_jpeg(data)
+        if result is None:
+            result = to_pdf_image(new_image, picture_quality, kind or None)
+    encoded = time.perf_counter()
+
+    atomic_write_bytes(filename, data)
+    written = time.perf_counter()
+
+    return SavedPage(
+        checksum(data),
+        len(data),
+        result,
+        stitched - start,
+        encoded - classified,
+        written - encoded,
+        kind,
+        classified - stitched,
+        suffix=filename.suffix[1:],
+    )
+
+
+def _check_container(head: bytes, tail: bytes, size: int) -> str | None:
+    """
+    只根据文件头、文件尾检查 JPEG、WebP、PNG 是否完整，不解码像素。
+
+    返回问题的说明，没有发现问题时返回空字符串，不认识的格式返回 None（需要完整解码才能确定）。
+    """
+    if head[:3] == b"\xff\xd8\xff":
+        # JPEG 以 EOI 标记结尾，之后可能还有几个填充字节
+        return "" if b"\xff\xd9" in tail else "JPEG 没有结束标记，文件不完整"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        # RIFF 头中记录了之后的数据长度
+        expected = int.from_bytes(head[4:8], "little") + 8
+        return "" if size >= expected else f"WebP 文件不完整 <{size}/{expected}> 字节"
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return "" if b"IEND" in tail else "PNG 没有 IEND，文件不完整"
+    return None
+
+
+def check_image(filename: Path, full: bool = False) -> tuple[str, int, int]:
+    """
+    检查一张已经保存好的图片，返回 (问题, 宽, 高)，没有问题时问题为空字符串。
+
+    先只读取文件头、文件尾检查文件是否完整，再由 PIL 读取尺寸（同样不解码像素）；
+    full 为 True、或者不认识文件格式时，才完整地解码一次。
+    """
+    from PIL import Image
+
+    try:
+        size = filename.stat().st_size
+        if not size:
+            return "空文件", 0, 0
+        with open(filename, "rb") as f:
+            head = f.read(16)
+            f.seek(max(0, size - 32))
+            tail = f.read()
+    except OSError as e:
+        return f"无法读取: {e}", 0, 0
+
+    problem = _check_container(head, tail, size)
+    if problem:
+        return problem, 0, 0
+
+    try:
+        with Image.open(filename) as image:
+            width, height = image.size
+            if full or problem is None:
+                image.load()
+    except Exception as e:
+        return f"无法解码: {e}", 0, 0
+    return "", width, height
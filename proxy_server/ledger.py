@@ -0,0 +1,241 @@
+"""
+多个代理实例共用同一个 `book_images/<bid>/` 目录时，用一个 SQLite 数据库（ledger.sqlite3）协调每一页：
+
+    claimed  某个实例已经开始处理这一页（收到了它的请求），其它实例收到这一页的请求时直接放行
+    done     这一页已经完整地保存到磁盘上了，所有实例都不会再处理它
+
+认领有存活时间（claim_ttl），实例退出或者浏览器翻走了之后，其它实例可以重新认领这一页。
+所有页都保存好之后，第一个发现的实例被选为合并者，只有它会合并 PDF。
+
+SQLite 的写事务在多个进程之间是互斥的，所以不需要另外的文件锁。只适用于本地磁盘，不要放在网络文件系统上。
+本模块不依赖 settings、mylogger。
+
+写操作（认领、完成、选出合并者等）可能要等其它实例释放写锁，请在单独的一个线程中按顺序调用（见 wqbook.ledger_writer）；
+读操作（new_done_pages、claimed_by_others、stats、holds）使用另一个连接，WAL 模式下不会等待写锁，可以在事件循环中调用。
+"""
+
+import sqlite3
+import time
+from collections.abc import Iterable
+from pathlib import Path
+
+__all__ = ["PageLedger"]
+
+
+CLAIMED = "claimed"
+DONE = "done"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    page INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    updated REAL NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS pages_seq ON pages (seq);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class PageLedger:
+
+    FILENAME = "ledger.sqlite3"
+
+    def __init__(self, path: Path, owner: str, claim_ttl: float) -> None:
+        self.path = path / self.FILENAME
+        self.owner = owner
+        "本实例的名称"
+        self.claim_ttl = claim_ttl
+        "认领的存活时间（秒）"
+
+        self._claims: dict[int, float] = {}
+        "本实例认领的页 => 上次写入认领的时间，一半存活时间之内不需要再写数据库"
+        self._synced = 0
+        "new_done_pages 已经读到的 seq"
+
+        # isolation_level=None：自己控制事务，写事务使用 BEGIN IMMEDIATE，避免两个实例同时升级为写锁时死锁
+        self._conn = sqlite3.connect(
+            self.path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._reader = sqlite3.connect(
+            self.path, timeout=1, isolation_level=None, check_same_thread=False
+        )
+        "只用于读，和写操作不在同一个线程中"
+
+    def _write(self):
+        return _Transaction(self._conn)
+
+    def _next_seq(self) -> int:
+        return self._conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) + 1 FROM pages"
+        ).fetchone()[0]
+
+    def import_pages(self, pages: Iterable[int]) -> None:
+        """把本实例已经下载的页（比如开启共享之前下载的）记录为 done"""
+        pages = list(pages)
+        if not pages:
+            return
+
+        now = time.time()
+        with self._write():
+            seq = self._next_seq()
+            for page in pages:
+                cursor = self._conn.execute(
+                    "INSERT INTO pages VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (page) DO UPDATE SET state = excluded.state, "
+                    "owner = excluded.owner, updated = excluded.updated, seq = excluded.seq "
+                    "WHERE state != ?",
+                    (page, DONE, self.owner, now, seq, DONE),
+                )
+                seq += cursor.rowcount
+
+    def claim(self, page: int) -> bool:
+        """
+        认领一页，返回 False 表示这一页已经保存好了、或者被其它实例认领了，本实例不需要处理它。
+
+        本实例已经认领过的页返回 True，并且会刷新认领的时间。
+        """
+        if self.holds(page):
+            return True
+
+        now = time.time()
+        with self._write():
+            row = self._conn.execute(
+                "SELECT state, owner, updated FROM pages WHERE page = ?", (page,)
+            ).fetchone()
+            if row is not None:
+                state, owner, updated = row
+                if state == DONE or (
+                    owner != self.owner and now - updated < self.claim_ttl
+                ):
+                    self._claims.pop(page, None)
+                    return False
+
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, 0)",
+                (page, CLAIMED, self.owner, now),
+            )
+        self._claims[page] = now
+        return True
+
+    def holds(self, page: int) -> bool:
+        """本实例最近认领过这一页，不需要访问数据库，claim 一定返回 True"""
+        claimed = self._claims.get(page)
+        return claimed is not None and time.time() - claimed < self.claim_ttl / 2
+
+    def complete(self, page: int) -> None:
+        """这一页已经保存好了，并且已经记录到 manifest 中"""
+        with self._write():
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                (page, DONE, self.owner, time.time(), self._next_seq()),
+            )
+        self._claims.pop(page, None)
+
+    def release(self, page: int) -> None:
+        """放弃本实例认领的一页（比如保存失败了），其它实例可以立即认领它"""
+        self._claims.pop(page, None)
+        with self._write():
+            self._conn.execute(
+                "DELETE FROM pages WHERE page = ? AND state = ? AND owner = ?",
+                (page, CLAIMED, self.owner),
+            )
+
+    def release_all(self) -> None:
+        """放弃本实例认领的所有页"""
+        self._claims.clear()
+        with self._write():
+            self._conn.execute(
+                "DELETE FROM pages WHERE state = ? AND owner = ?", (CLAIMED, self.owner)
+            )
+
+    def drop_pages(self, pages: Iterable[int]) -> None:
+        """
+        这些页不再视为已下载（比如图片损坏了），任何实例都可以重新认领它们。
+
+        书籍又缺页了，之前选出的合并者也作废，重新下载完之后再选一次。
+        """
+        with self._write():
+            self._conn.executemany(
+                "DELETE FROM pages WHERE page = ?", [(page,) for page in pages]
+            )
+            self._conn.execute("DELETE FROM meta WHERE key = 'merger'")
+
+    def new_done_pages(self) -> list[int]:
+        """上次调用之后，所有实例新保存好的页"""
+        rows = self._reader.execute(
+            "SELECT page, seq FROM pages WHERE state = ? AND seq > ? ORDER BY seq",
+            (DONE, self._synced),
+        ).fetchall()
+        if rows:
+            self._synced = rows[-1][1]
+        return [page for page, _ in rows]
+
+    def claimed_by_others(self) -> set[int]:
+        """其它实例正在处理（认领还没过期）的页"""
+        rows = self._reader.execute(
+            "SELECT page FROM pages WHERE state = ? AND owner != ? AND updated > ?",
+            (CLAIMED, self.owner, time.time() - self.claim_ttl),
+        )
+        return {page for (page,) in rows}
+
+    def elect_merger(self, total_page: int) -> str:
+        """
+        所有页都保存好之后选出合并者，返回合并者的名称，还没有保存好所有页时返回空字符串。
+
+        只有第一个调用的实例会被选中，之后（包括重启之后）再调用都返回同一个名称。
+        """
+        with self._write():
+            done = self._conn.execute(
+                "SELECT COUNT(*) FROM pages WHERE state = ?", (DONE,)
+            ).fetchone()[0]
+            if not total_page or done < total_page:
+                return ""
+
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'merger'"
+            ).fetchone()
+            if row is not None:
+                return row[0]
+
+            self._conn.execute("INSERT INTO meta VALUES ('merger', ?)", (self.owner,))
+            return self.owner
+
+    def stats(self) -> dict:
+        rows = self._reader.execute(
+            "SELECT state, owner, COUNT(*) FROM pages GROUP BY state, owner"
+        ).fetchall()
+        stats: dict[str, dict[str, int]] = {}
+        for state, owner, count in rows:
+            stats.setdefault(owner, {})[state] = count
+        return stats
+
+    def close(self) -> None:
+        self._conn.close()
+        self._reader.close()
+
+    pass
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE 的写事务，出现异常时回滚"""
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
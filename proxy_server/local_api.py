@@ -0,0 +1,195 @@
+"""
+本地 HTTP 接口，只监听 127.0.0.1，运行在单独的线程中，不会占用 mitmproxy 的事件循环。
+
+各个模块通过 local_api.add_route 注册自己的接口，比如 `/metrics`。
+接口函数运行在 HTTP 服务器的线程中，如果需要修改代理的状态，请通过 loop.call_soon_threadsafe 交给事件循环。
+
+浏览器中的任何网页都能请求 127.0.0.1，所以：
+    只有翻页脚本所在的网站（allowed_origins）可以跨域访问，其它网站发来的请求（带有 Origin）一律拒绝
+    修改状态的请求（POST、DELETE）必须带上 `Content-Type: application/json`，浏览器跨域发送时一定会先预检
+没有 Origin 的请求（curl、本地的脚本）不受限制。
+"""
+
+import threading
+import urllib.parse
+from collections.abc import Callable, Iterable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+
+from mylogger import logger
+
+__all__ = ["local_api", "ApiRequest"]
+
+
+class ApiRequest(NamedTuple):
+    method: str
+    path: str
+    "不包括查询参数的路径"
+    query: dict[str, list[str]]
+    body: bytes
+    handler: BaseHTTPRequestHandler
+    "需要自己写响应时（比如持续推送事件）使用"
+
+
+ApiResponse = tuple[int, str, bytes] | None
+"(状态码, Content-Type, 响应体)，接口函数自己写了响应时返回 None"
+
+MUTATING_METHODS = ("POST", "DELETE")
+
+
+class LocalApi:
+
+    def __init__(self) -> None:
+        self.routes: dict[tuple[str, str], Callable[[ApiRequest], ApiResponse]] = {}
+        "(请求方法, 路径) => 接口函数。路径以 / 结尾时表示前缀匹配"
+        self.server: ThreadingHTTPServer | None = None
+        self.allowed_origins: set[str] = set()
+        "允许跨域访问的网站，比如 `https://wqbook.wqxuetang.com`"
+
+    def add_route(
+        self, method: str, path: str, func: Callable[[ApiRequest], ApiResponse]
+    ) -> None:
+        self.routes[(method, path)] = func
+
+    def _find_route(self, method: str, path: str):
+        func = self.routes.get((method, path))
+        if func:
+            return func
+
+        # 前缀匹配，最长的优先，比如 /books/ 可以匹配 /books/3238891/pause
+        prefixes = [
+            p
+            for m, p in self.routes
+            if m == method and p.endswith("/") and path.startswith(p)
+        ]
+        if prefixes:
+            return self.routes[(method, max(prefixes, key=len))]
+        return None
+
+    def start(self, port: int, allowed_origins: Iterable[str] = ()) -> None:
+        """在后台线程中启动，port 为 0 时不启动"""
+        self.allowed_origins = set(allowed_origins)
+        if not port or self.server is not None:
+            return
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _origin_allowed(self) -> bool:
+                origin = self.headers.get("Origin")
+                return origin is None or origin in api.allowed_origins
+
+            def send_cors_headers(self) -> None:
+                """只给允许的网站发送跨域的响应头，接口函数自己写响应时也需要调用"""
+                origin = self.headers.get("Origin")
+                if origin is not None and origin in api.allowed_origins:
+                    self.send_header("Access-Control-Allow-Origin", origin)
+                self.send_header("Vary", "Origin")
+
+            def _send(self, status: int, content_type: str, body: bytes) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_cors_headers()
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self, method: str):
+                if not self._origin_allowed():
+                    logger.limited(
+                        "error",
+                        "local_api_origin",
+                        "拒绝了来自 <%s> 的本地接口请求: %s %s",
+                        self.headers.get("Origin"),
+                        method,
+                        self.path,
+                    )
+                    self._send(403, "text/plain; charset=utf-8", b"forbidden origin")
+                    return
+
+                content_type = self.headers.get("Content-Type") or ""
+                if method in MUTATING_METHODS and not content_type.startswith(
+                    "application/json"
+                ):
+                    self._send(
+                        415,
+                        "text/plain; charset=utf-8",
+                        b"Content-Type must be application/json",
+                    )
+                    return
+
+                parsed = urllib.parse.urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                request = ApiRequest(
+                    method,
+                    parsed.path,
+                    urllib.parse.parse_qs(parsed.query),
+                    self.rfile.read(length) if length else b"",
+                    self,
+                )
+
+                func = api._find_route(method, parsed.path)
+                if func is None:
+                    response = (404, "text/plain; charset=utf-8", b"not found")
+                else:
+                    try:
+                        response = func(request)
+                    except Exception as e:
+                        logger.error(f"本地接口 {method} {self.path} 出错: {e}")
+                        response = (500, "text/plain; charset=utf-8", str(e).encode())
+
+                if response is None:
+                    return
+
+                self._send(*response)
+
+            def do_OPTIONS(self):
+                """跨域的预检请求，只允许翻页脚本所在的网站"""
+                if self.headers.get("Origin") not in api.allowed_origins:
+                    self._send(403, "text/plain; charset=utf-8", b"forbidden origin")
+                    return
+
+                self.send_response(204)
+                self.send_cors_headers()
+                self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE")
+                self.send_header("Access-Control-Allow-Headers", "Content-Type")
+                # Chrome 的 Private Network Access：公网的网页访问 127.0.0.1 之前需要确认
+                if self.headers.get("Access-Control-Request-Private-Network"):
+                    self.send_header("Access-Control-Allow-Private-Network", "true")
+                self.send_header("Access-Control-Max-Age", "600")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_DELETE(self):
+                self._handle("DELETE")
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        except OSError as e:
+            logger.error(f"本地接口启动失败，端口 <{port}>: {e}")
+            return
+
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f"本地接口已启动: http://127.0.0.1:{port}")
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    pass
+
+
+local_api = LocalApi()
@@ -5,4 +5,6 @@
 from mylogger import logger
 from process_url import *
 
+addons = [WQBookAddon()]
+
 logger.info(". . . proxy_server start . . . \n")
@@ -0,0 +1,371 @@
+"""
+合并 PDF 的调度器。
+
+所有书籍的合并任务都在一个有限大小的进程池中执行，不会占用代理的进程，也不会因为同时合并太多书而互相拖慢。
+任务按照优先级排队，可以取消，失败之后会重试，任务的状态保存在 `book_images/merge_jobs.json` 中，
+代理退出时没有完成的任务，下次启动时会继续执行。
+
+离线处理（比如重放抓包）退出之前需要调用 wait_idle，等待所有任务完成。
+"""
+
+import heapq
+import json
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from pathlib import Path
+
+import utils
+from book_state import atomic_write_bytes
+from metrics import metrics
+from mylogger import logger
+from settings import settings
+
+__all__ = ["merge_scheduler"]
+
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class MergeScheduler:
+
+    def __init__(self) -> None:
+        self.jobs: dict[int, dict] = {}
+        "书籍 id => 任务，同一本书同时只会有一个任务"
+        self.workers = settings["merge_workers"]
+        "同时合并的书籍数量"
+        self.max_retries = settings["merge_max_retries"]
+        "失败之后最多重试几次"
+
+        self._queue: list[tuple[tuple, int]] = []
+        "(优先级, 书籍 id) 组成的最小堆"
+        self._running: dict[int, Future] = {}
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+        "任务结束时通知 wait_idle"
+        self._executor: "ProcessPoolExecutor | None" = None
+        self._progress_queue = None
+        self._started = False
+        self._warned_optimize = False
+        self.state_name = ""
+        "不为空时任务的状态保存在 merge_jobs.<state_name>.json 中，同时运行的多个进程不会互相覆盖"
+
+    @property
+    def state_file(self) -> Path:
+        name = self.state_name
+        if not name and settings["shared_store"]:
+            # 多个实例共用图片目录时，每个实例的任务分开保存
+            name = settings["instance_id"]
+        if name:
+            name = utils.be_good_name(name, "_")
+            return settings["image_path"] / f"merge_jobs.{name}.json"
+        return settings["image_path"] / "merge_jobs.json"
+
+    # region 对外的接口
+
+    def start(self) -> None:
+        """读取上次没有完成的任务，继续执行"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+            if self.state_file.exists():
+                jobs = json.loads(self.state_file.read_text(encoding="utf-8"))
+                for job in jobs:
+                    if job["state"] in (QUEUED, RUNNING):
+                        logger.info(
+                            f"继续执行上次没有完成的合并任务: 书籍 <{job['bid']}>"
+                        )
+                        job["state"] = QUEUED
+                        job.update(job.pop("next", {}))
+                        self.jobs[job["bid"]] = job
+                        self._push(job)
+
+            self._pump()
+
+    def submit(
+        self, bid: int, images_path: Path, output: Path, partial: Path, pages: int
+    ) -> None:
+        """
+        提交一本书的合并任务。
+
+        partial 是正在写入的 PDF 文件，边下载边生成 PDF 时它已经包含了大部分页，合并时会跳过这些页。
+        pages 是书籍的页数，用于计算优先级。
+
+        这本书已经有任务在排队时，以这次提交的参数为准；正在合并时，等它结束之后再合并一次。
+        """
+        with self._lock:
+            self.start()
+
+            params = {
+                "images_path": str(images_path),
+                "output": str(output),
+                "partial": str(partial),
+                "pages": pages,
+            }
+            job = self.jobs.get(bid)
+            if job and job["state"] == QUEUED:
+                job.update(params)
+                self._save()
+                return
+            if job and job["state"] == RUNNING:
+                job["next"] = params
+                self._save()
+                return
+
+            job = {
+                "bid": bid,
+                **params,
+                "created": time.time(),
+                "attempts": 0,
+                "state": QUEUED,
+                "progress": [0, pages],
+                "error": "",
+            }
+            self.jobs[bid] = job
+            (images_path / "merge.cancel").unlink(missing_ok=True)
+
+            self._push(job)
+            logger.info(
+                f"书籍 <{bid}> 的合并任务已加入队列，前面还有 <{len(self._queue) - 1}> 个任务"
+            )
+            self._pump()
+
+    def cancel(self, bid: int) -> bool:
+        """取消一本书的合并任务，正在合并的任务会在下一次报告进度时停止"""
+        with self._lock:
+            job = self.jobs.get(bid)
+            if not job or job["state"] not in (QUEUED, RUNNING):
+                return False
+
+            if job["state"] == RUNNING:
+                (Path(job["images_path"]) / "merge.cancel").touch()
+                return True
+
+            job["state"] = CANCELLED
+            self._queue = [item for item in self._queue if item[1] != bid]
+            heapq.heapify(self._queue)
+            self._save()
+            self._idle.notify_all()
+            logger.info(f"书籍 <{bid}> 的合并任务已取消")
+            return True
+
+    def wait_idle(self, timeout: float | None = None) -> bool:
+        """
+        等待所有排队中、正在合并的任务结束（包括失败之后等待重试的任务），返回是否已经全部结束。
+
+        会阻塞当前线程，在事件循环中请使用 asyncio.to_thread 调用。
+        """
+        with self._idle:
+            return self._idle.wait_for(
+                lambda: all(
+                    job["state"] not in (QUEUED, RUNNING) for job in self.jobs.values()
+                ),
+                timeout,
+            )
+
+    def status(self) -> list[dict]:
+        """所有任务的状态"""
+        with self._lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def shutdown(self) -> None:
+        """不再开始新的任务。正在合并的任务会在合并完成之后退出，没开始的任务下次启动时继续"""
+        with self._lock:
+            self._queue.clear()
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    # endregion
+
+    def _priority(self, job: dict) -> tuple:
+        """值越小越先执行"""
+        if settings["merge_priority"] == "small_first":
+            return (job["pages"], job["created"])
+        return (job["created"],)
+
+    def _push(self, job: dict) -> None:
+        heapq.heappush(self._queue, (self._priority(job), job["bid"]))
+        self._save()
+
+    def _save(self) -> None:
+        """保存任务的状态，已经完成的任务不需要保存"""
+        jobs = [job for job in self.jobs.values() if job["state"] != DONE]
+        if not jobs:
+            self.state_file.unlink(missing_ok=True)
+            return
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_bytes(
+            self.state_file, json.dumps(jobs, ensure_ascii=False).encode("utf-8")
+        )
+
+    def _get_executor(self) -> "ProcessPoolExecutor":
+        if self._executor is None:
+            # 第一次合并时才导入，代理启动时不需要加载 multiprocessing 和 PIL
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            import pdf_merge
+
+            self._progress_queue = multiprocessing.Queue()
+            self._executor = ProcessPoolExecutor(
+                self.workers,
+                initializer=pdf_merge.init_worker,
+                initargs=(self._progress_queue,),
+            )
+            threading.Thread(
+                target=self._read_progress, args=(self._progress_queue,), daemon=True
+            ).start()
+        return self._executor
+
+    def _read_progress(self, progress_queue) -> None:
+        """读取合并进程报告的进度"""
+        while True:
+            bid, done, total = progress_queue.get()
+            with self._lock:
+                job = self.jobs.get(bid)
+                if job:
+                    job["progress"] = [done, total]
+            logger.debug("书籍 <%s> 合并进度 <%s/%s>", bid, done, total)
+
+    def _pump(self) -> None:
+        """有空闲的进程时，开始执行优先级最高的任务"""
+        import pdf_merge
+
+        while self._queue and len(self._running) < self.workers:
+            _, bid = heapq.heappop(self._queue)
+            job = self.jobs[bid]
+            if job["state"] != QUEUED:
+                continue
+
+            job["state"] = RUNNING
+            job["attempts"] += 1
+            job["started"] = time.time()
+            self._save()
+
+            future = self._get_executor().submit(
+                pdf_merge.build_book,
+                bid,
+                Path(job["images_path"]),
+                Path(job["partial"]),
+                Path(job["output"]),
+                settings["picture_format"],
+                settings["picture_quality"],
+                settings["adaptive_encoding"],
+                settings["merge_page_workers"],
+                self._optimize(),
+            )
+            self._running[bid] = future
+            future.add_done_callback(lambda f, bid=bid: self._on_done(bid, f))
+
+    def _optimize(self) -> bool:
+        """是否在合并之后优化 PDF，开启了 pdf_optimize 但是没有安装 pikepdf 时只提示一次"""
+        if not settings["pdf_optimize"]:
+            return False
+
+        import pdf_optimize
+
+        if pdf_optimize.available():
+            return True
+        if not self._warned_optimize:
+            self._warned_optimize = True
+            logger.error(
+                "开启了 pdf_optimize，但是没有安装 pikepdf，合并之后不会优化 PDF"
+            )
+        return False
+
+    def _on_done(self, bid: int, future: Future) -> None:
+        import pdf_merge
+
+        with self._lock:
+            self._running.pop(bid, None)
+            job = self.jobs[bid]
+            metrics.merge_pdf.observe(time.time() - job["started"])
+
+            error = None
+            if future.cancelled():
+                # 代理退出时还没开始的任务，下次启动时继续
+                job["state"] = QUEUED
+            else:
+                error = future.exception()
+
+            if future.cancelled():
+                pass
+            elif error is None:
+                job["state"] = DONE
+                job["progress"] = [job["pages"], job["pages"]]
+                logger.info(f"合并图片为 PDF 成功，文件名: {job['output']}")
+                self._log_optimized(bid, future.result())
+            elif isinstance(error, pdf_merge.MergeCancelled):
+                job["state"] = CANCELLED
+                (Path(job["images_path"]) / "merge.cancel").unlink(missing_ok=True)
+                logger.info(f"书籍 <{bid}> 的合并任务已取消")
+            elif job["attempts"] <= self.max_retries:
+                job["state"] = QUEUED
+                job["error"] = str(error)
+                delay = settings["merge_retry_delay"] * job["attempts"]
+                logger.error(
+                    f"书籍 <{bid}> 合并 PDF 失败: {error}，<{delay}s> 后第 <{job['attempts']}> 次重试"
+                )
+                timer = threading.Timer(delay, self._retry, args=(bid,))
+                timer.daemon = True
+                timer.start()
+            else:
+                job["state"] = FAILED
+                job["error"] = "".join(traceback.format_exception(error))
+                logger.error(f"书籍 <{bid}> 合并 PDF 失败，不再重试: {error}")
+
+            # 合并期间又提交了这本书（比如手动合并之后书下载完了），需要再合并一次
+            params = None
+            if "next" in job and job["state"] != QUEUED:
+                params = job.pop("next")
+                if self._executor is None:
+                    # 代理正在退出，下次启动时再合并
+                    job.update(params, state=QUEUED, attempts=0)
+                    params = None
+
+            self._save()
+            if params:
+                self.submit(
+                    bid,
+                    Path(params["images_path"]),
+                    Path(params["output"]),
+                    Path(params["partial"]),
+                    params["pages"],
+                )
+            elif self._executor is not None:
+                self._pump()
+            self._idle.notify_all()
+
+    def _log_optimized(self, bid: int, result: dict) -> None:
+        import pdf_optimize
+
+        if result["optimized"]:
+            job = self.jobs[bid]
+            job["optimized"] = result["optimized"]
+            logger.info(
+                f"书籍 <{bid}> 的 PDF 已优化: {pdf_optimize.describe(result['optimized'])}"
+            )
+        elif result["optimize_error"]:
+            logger.error(
+                f"书籍 <{bid}> 的 PDF 优化失败，保留优化之前的 PDF: {result['optimize_error']}"
+            )
+
+    def _retry(self, bid: int) -> None:
+        with self._lock:
+            job = self.jobs.get(bid)
+            if job and job["state"] == QUEUED and self._executor is not None:
+                self._push(job)
+                self._pump()
+
+    pass
+
+
+merge_scheduler = MergeScheduler()
@@ -0,0 +1,303 @@
+"""
+各个处理阶段的统计：计数器、耗时直方图、当前状态（gauge）。
+
+可以通过本地接口 `/metrics` 以 Prometheus 文本格式读取，也会定期在日志中输出一行摘要。
+这里只依赖标准库。
+"""
+
+import threading
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+
+__all__ = ["metrics"]
+
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+"耗时直方图的分桶（秒）"
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    items = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        items.append(extra)
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._children: dict[tuple, "_Metric"] = {}
+
+    def labels(self, *values) -> "_Metric":
+        """获取某一组标签值对应的统计"""
+        values = tuple(str(value) for value in values)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = type(self)(self.name, self.help)
+            return child
+
+    def _samples(self) -> list[tuple[tuple, "_Metric"]]:
+        if not self.labelnames:
+            return [((), self)]
+        with self._lock:
+            return sorted(self._children.items())
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, metric in self._samples():
+            lines.extend(metric._render_one(self.labelnames, values))
+        return lines
+
+    def _render_one(self, labelnames: tuple, values: tuple) -> list[str]:
+        raise NotImplementedError
+
+    pass
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def _render_one(self, labelnames, values) -> list[str]:
+        return [f"{self.name}{_format_labels(labelnames, values)} {self.value}"]
+
+    pass
+
+
+class Gauge(_Metric):
+    """当前状态，每次读取时调用 func 获取最新的值"""
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, help: str, func: Callable[[], float] | None = None
+    ) -> None:
+        super().__init__(name, help)
+        self.func = func
+
+    def get(self) -> float:
+        try:
+            return self.func() if self.func else 0
+        except Exception:
+            # 读取时对象可能正在变化，这次就不统计了
+            return 0
+
+    def _render_one(self, labelnames, values) -> list[str]:
+        return [f"{self.name} {self.get()}"]
+
+    pass
+
+
+class Histogram(_Metric):
+    """耗时直方图，单位为秒"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = [0] * len(DEFAULT_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.sum += seconds
+            for i, bound in enumerate(DEFAULT_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[i] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        """用 with 语句统计一段代码的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def _render_one(self, labelnames, values) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(DEFAULT_BUCKETS, self.buckets):
+            cumulative += count
+            labels = _format_labels(labelnames, values, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(labelnames, values, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{labels} {self.count}")
+
+        labels = _format_labels(labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {self.sum}")
+        lines.append(f"{self.name}_count{labels} {self.count}")
+        return lines
+
+    def summary(self) -> str:
+        """形如 `12 次 / 平均 3.4ms`"""
+        if not self.count:
+            return "0 次"
+        return f"{self.count} 次 / 平均 {self.sum / self.count * 1000:.1f}ms"
+
+    pass
+
+
+class Metrics:
+    """所有统计项都在这里注册"""
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+
+        # region 各阶段的耗时
+        self.dispatch = self._add(
+            Histogram(
+                "wqbook_dispatch_seconds", "WQBookAddon 处理一个响应的耗时", ("route",)
+            )
+        )
+        self.jwt_decrypt = self._add(
+            Histogram("wqbook_jwt_decrypt_seconds", "jwt 解密参数 k 的耗时")
+        )
+        self.aes_decrypt = self._add(
+            Histogram("wqbook_aes_decrypt_seconds", "AES 解密 once/get 响应的耗时")
+        )
+        self.tile_order = self._add(
+            Histogram("wqbook_tile_order_seconds", "查找小图片顺序的耗时")
+        )
+        self.stitch = self._add(
+            Histogram("wqbook_stitch_seconds", "拼接 6 个小图片的耗时")
+        )
+        self.classify = self._add(
+            Histogram("wqbook_classify_seconds", "判断整页是黑白、灰度还是彩色的耗时")
+        )
+        self.encode = self._add(
+            Histogram("wqbook_encode_seconds", "编码整页图片的耗时")
+        )
+        self.disk_write = self._add(
+            Histogram("wqbook_disk_write_seconds", "整页图片写入磁盘的耗时")
+        )
+        self.merge_pdf = self._add(
+            Histogram("wqbook_merge_pdf_seconds", "合并、生成 PDF 的耗时")
+        )
+        # endregion
+
+        # region 计数器
+        self.tiles = self._add(Counter("wqbook_tiles_total", "收到的小图片数量"))
+        self.tiles_dropped = self._add(
+            Counter("wqbook_tiles_dropped_total", "没有确认顺序、被丢弃的小图片数量")
+        )
+        self.pages_saved = self._add(
+            Counter("wqbook_pages_saved_total", "保存成功的页数")
+        )
+        self.pages_failed = self._add(
+            Counter("wqbook_pages_failed_total", "保存失败的页数")
+        )
+        self.pages_deduped = self._add(
+            Counter(
+                "wqbook_pages_deduped_total",
+                "和之前的页内容完全相同、没有再次编码的页数",
+            )
+        )
+        self.tiles_deduped = self._add(
+            Counter(
+                "wqbook_tiles_deduped_total", "和之前的小图片内容完全相同的小图片数量"
+            )
+        )
+        self.pending_tiles = self._add(
+            Counter(
+                "wqbook_parked_tiles_total",
+                "暂存的小图片：查不到顺序被暂存（miss）、之后等到了顺序（hit）、一直没等到被清理（expired）",
+                ("result",),
+            )
+        )
+        self.zn_expired = self._add(
+            Counter(
+                "wqbook_zn_table_expired_total",
+                "因为超过存活时间而被清理的小图片顺序映射关系数量",
+            )
+        )
+        self.zn_evicted = self._add(
+            Counter(
+                "wqbook_zn_table_evicted_total",
+                "因为超过数量上限而被清理的小图片顺序映射关系数量",
+            )
+        )
+        self.page_kinds = self._add(
+            Counter(
+                "wqbook_page_kinds_total", "各类型（黑白、灰度、彩色）的页数", ("kind",)
+            )
+        )
+        # endregion
+
+    def _add(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def gauge(self, name: str, help: str, func: Callable[[], float]) -> Gauge:
+        """注册一个 gauge，同名的会被替换"""
+        return self._add(Gauge(name, help, func))
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """日志中输出的一行摘要"""
+        stages = [
+            ("jwt", self.jwt_decrypt),
+            ("aes", self.aes_decrypt),
+            ("查顺序", self.tile_order),
+            ("拼接", self.stitch),
+            ("分类", self.classify),
+            ("编码", self.encode),
+            ("写入", self.disk_write),
+            ("合并 PDF", self.merge_pdf),
+        ]
+        parts = [f"{name} {metric.summary()}" for name, metric in stages]
+
+        gauges = [
+            f"{metric.name.removeprefix('wqbook_')}={metric.get():g}"
+            for metric in list(self._metrics.values())
+            if isinstance(metric, Gauge)
+        ]
+        return (
+            f"已保存 <{self.pages_saved.value}> 页，小图片 <{self.tiles.value}> 个 | "
+            + " | ".join(parts)
+            + " | "
+            + " ".join(gauges)
+        )
+
+    pass
+
+
+metrics = Metrics()
@@ -1,10 +1,19 @@
 """
 封装一个简单的日志输出，并没有使用标准库、第三方库。
 可自行修改下面的方法，只要不改动接口就行。
+
+日志先放进队列，由后台线程写入控制台、文件，代理的事件循环不会因为写日志而卡住。
+热点路径上的日志请使用 % 格式（`logger.debug("书籍 <%s>", bid)`）或者传入一个函数，
+日志级别没有开启时不会格式化字符串；重复很多次的日志请使用 `logger.limited`。
 """
 
+import atexit
+import queue
+import threading
+import time
 from pathlib import Path
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 
 
 from settings import settings
@@ -15,19 +24,49 @@ __all__ = ["logger"]
 import logging
 
 
+class _QueueHandler(QueueHandler):
+    """
+    在调用的线程中只拼接 message（参数可能之后会被修改），时间、级别等格式化交给后台线程。
+
+    记录器上只有这一个处理器，所以不需要像 QueueHandler 那样复制一份 record。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
 class MyLogger:
 
-    def __init__(self, level: str, log_file: Path | None):
+    def __init__(
+        self,
+        level: str,
+        log_file: Path | None,
+        repeat_interval: float = 0,
+        name: str = "default",
+    ):
         """记录日志，默认输出到控制台，可以指定文件名称输出到文件（此时就不会再输出到控制台中）"""
         self.log_file = log_file
+        self.repeat_interval = repeat_interval
+        "limited 的日志，同一个 key 每隔多少秒才输出一次，为 0 表示不限制"
 
-        # 创建名为 default 的记录器
-        self.logger = logging.getLogger("default")
+        # 创建名为 name 的记录器，代理使用的是 default
+        self.logger = logging.getLogger(name)
         self.logger.setLevel(level)
 
         self.level = self.logger.getEffectiveLevel()
         self.default_handler = None
         self.default_formatter = None
+        self.listener: QueueListener | None = None
+        "在后台线程中把队列中的日志交给 default_handler"
+
+        self._repeats: dict[str, list] = {}
+        "limited 的 key => [上次输出的时间, 之后省略的条数]"
+        self._repeats_lock = threading.Lock()
 
         self._add_default_things()
 
@@ -45,8 +84,16 @@ class MyLogger:
             self.default_handler = logging.StreamHandler()
 
         self.default_handler.setLevel(self.level)
-        # 给记录器添加处理器
-        self.logger.addHandler(self.default_handler)
+
+        # 记录器只负责把日志放进队列，由后台线程交给处理器写入
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(_QueueHandler(log_queue))
+        self.listener = QueueListener(
+            log_queue, self.default_handler, respect_handler_level=True
+        )
+        self.listener.start()
+        # 退出时写完队列中剩下的日志
+        atexit.register(self.stop)
 
         # 默认的格式器
         self.default_formatter = logging.Formatter(
@@ -55,16 +102,64 @@ class MyLogger:
         # 给处理器添加格式器
         self.default_handler.setFormatter(self.default_formatter)
 
-    def info(self, *args, **kwargs):
-        self.logger.info(*args, **kwargs)
+    def _log(self, level: int, msg, args, kwargs) -> None:
+        # 级别没有开启时，不格式化字符串，也不调用 msg 函数
+        if not self.logger.isEnabledFor(level):
+            return
+        if callable(msg):
+            msg = msg()
+        if kwargs:
+            self.logger.log(level, msg, *args, **kwargs)
+            return
+
+        # 日志格式中没有文件名、行号，不需要像 logger.log 那样查找调用者
+        record = self.logger.makeRecord(self.logger.name, level, "", 0, msg, args, None)
+        self.logger.handle(record)
+
+    def info(self, msg, *args, **kwargs):
+        self._log(logging.INFO, msg, args, kwargs)
 
-    def error(self, *args, **kwargs):
-        self.logger.error(*args, **kwargs)
+    def error(self, msg, *args, **kwargs):
+        self._log(logging.ERROR, msg, args, kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self._log(logging.DEBUG, msg, args, kwargs)
+
+    def limited(self, level: str, key: str, msg, *args, **kwargs):
+        """
+        同一个 key 的日志每隔 repeat_interval 秒最多输出一条，用于每个小图片都可能出现的日志，
+        比如网站改版之后每个请求都解密失败。之间省略的条数会附在下一条日志的后面。
+        """
+        levelno = logging.getLevelName(level.upper())
+        if not self.logger.isEnabledFor(levelno):
+            return
 
-    def debug(self, *args, **kwargs):
-        self.logger.debug(*args, **kwargs)
+        if self.repeat_interval:
+            now = time.monotonic()
+            with self._repeats_lock:
+                repeat = self._repeats.get(key)
+                if repeat is not None and now - repeat[0] < self.repeat_interval:
+                    repeat[1] += 1
+                    return
+                suppressed = repeat[1] if repeat is not None else 0
+                self._repeats[key] = [now, 0]
+
+            if suppressed:
+                if callable(msg):
+                    msg = msg()
+                msg = f"{msg}（之前省略了 {suppressed} 条相同的日志）"
+
+        self._log(levelno, msg, args, kwargs)
+
+    def stop(self):
+        """写完队列中剩下的日志，之后的日志不会再输出"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
 
     pass
 
 
-logger = MyLogger(settings["logger_level"], settings["log_file"])
+logger = MyLogger(
+    settings["logger_level"], settings["log_file"], settings["log_repeat_interval"]
+)
@@ -0,0 +1,193 @@
+"""
+整页图片的拼接、编码流水线。
+
+小图片的响应只负责收集 bytes，凑齐 6 张之后交给这里，
+由进程池在后台完成拼接、编码、保存，这样就不会卡住 mitmproxy 的事件循环啦。
+"""
+
+import asyncio
+import time
+from collections.abc import Callable
+
+import imaging
+from imaging import SavedPage
+from metrics import metrics
+from mylogger import logger
+from settings import settings
+from wqbook import WQBook
+
+
+class PagePipeline:
+    """带有界队列的整页保存流水线"""
+
+    def __init__(self, workers: int, max_queue: int) -> None:
+        self.workers = workers
+        "进程池的进程数，为 0 时直接在事件循环中保存（也就是原来的行为）"
+        self.max_queue = max(1, max_queue)
+        "最多允许多少页同时处于等待编码、正在编码的状态"
+        self.executor = None
+        "第一次保存时才创建进程池，代理启动时不需要加载 multiprocessing"
+
+        self.pending = 0
+        "已经提交、但还没有保存完成的页数，也就是队列深度"
+        self.waiting = 0
+        "因为队列已满、正在等待空位的页数"
+        self.backpressure_count = 0
+        "队列已满导致等待的次数"
+        self.backpressure_seconds = 0.0
+        "因为队列已满而等待的总时长"
+        self.completed = 0
+        "保存成功的页数"
+        self.failed = 0
+        "保存失败的页数"
+        self.deduplicated = 0
+        "和之前的页内容完全相同、直接链接过去的页数"
+
+        self._slots = asyncio.Semaphore(self.max_queue)
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(
+        self,
+        book: WQBook,
+        page_num: int,
+        on_saved: Callable[[WQBook, int, SavedPage | None], None],
+    ) -> None:
+        """
+        提交书籍的第 page_num 页（必须已经凑齐 6 张小图片）。
+
+        只有队列已满时才会等待，否则立即返回，保存完成后会在事件循环中调用 on_saved，
+        保存失败时传给 on_saved 的结果为 None。
+        """
+        # 排队期间同一页又凑齐了一次（比如重复收到了小图片），它已经提交过了
+        if page_num in book.saving_page or page_num not in book.pages:
+            return
+
+        # 和之前保存的某一页内容完全相同，直接链接过去，不需要排队编码
+        source = book.find_duplicate(page_num)
+        if source is not None:
+            saved = book.save_duplicate_page(page_num, source)
+            if saved is not None:
+                book.take_full_page(page_num)
+                self.deduplicated += 1
+                metrics.pages_deduped.inc()
+                on_saved(book, page_num, saved)
+                return
+
+        # 先取走这一页，它就被视为正在保存，等待空位时不会再被提交一次
+        page = book.take_full_page(page_num)
+        try:
+            await self._acquire(book, page_num)
+        except BaseException:
+            on_saved(book, page_num, None)
+            raise
+
+        # 等待空位期间这本书被移除了，不需要再保存
+        if book.closed:
+            self._slots.release()
+            on_saved(book, page_num, None)
+            return
+
+        self.pending += 1
+        try:
+            filename = book.page_path(page_num)
+            task = asyncio.ensure_future(
+                self._save(book, page_num, page.split_pages_list(), filename, on_saved)
+            )
+        except BaseException:
+            self.pending -= 1
+            self._slots.release()
+            on_saved(book, page_num, None)
+            raise
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _acquire(self, book: WQBook, page_num: int) -> None:
+        """等待编码队列的空位"""
+        if not self._slots.locked():
+            await self._slots.acquire()
+            return
+
+        self.backpressure_count += 1
+        self.waiting += 1
+        logger.limited(
+            "info",
+            "backpressure",
+            "编码队列已满 <%s/%s>，书籍 <%s> 的第 <%s> 页等待中 . . .",
+            self.pending,
+            self.max_queue,
+            book.bid,
+            page_num,
+        )
+        start = time.perf_counter()
+        try:
+            await self._slots.acquire()
+        finally:
+            self.backpressure_seconds += time.perf_counter() - start
+            self.waiting -= 1
+
+    async def _save(self, book, page_num, split_pages, filename, on_saved) -> None:
+        args = (
+            split_pages,
+            filename,
+            settings["picture_format"],
+            settings["picture_quality"],
+            # 边下载边生成 PDF 时，顺便把嵌入 PDF 的数据也编码好
+            book.incremental,
+            settings["adaptive_encoding"],
+        )
+
+        saved = None
+        try:
+            if self.workers <= 0:
+                saved = imaging.save_full_page(*args)
+            else:
+                if self.executor is None:
+                    from concurrent.futures import ProcessPoolExecutor
+
+                    self.executor = ProcessPoolExecutor(self.workers)
+                loop = asyncio.get_running_loop()
+                saved = await loop.run_in_executor(
+                    self.executor, imaging.save_full_page, *args
+                )
+            self.completed += 1
+            metrics.pages_saved.inc()
+            metrics.stitch.observe(saved.stitch_seconds)
+            if saved.kind:
+                metrics.classify.observe(saved.classify_seconds)
+                metrics.page_kinds.labels(saved.kind).inc()
+            metrics.encode.observe(saved.encode_seconds)
+            metrics.disk_write.observe(saved.write_seconds)
+        except Exception as e:
+            self.failed += 1
+            metrics.pages_failed.inc()
+            logger.error(f"保存书籍 <{book.bid}> 的第 <{page_num}> 页失败: {e}")
+        finally:
+            self.pending -= 1
+            self._slots.release()
+
+        on_saved(book, page_num, saved)
+
+    def stats(self) -> dict:
+        """流水线当前的状态，包括队列深度、背压情况"""
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "pending": self.pending,
+            "waiting": self.waiting,
+            "backpressure_count": self.backpressure_count,
+            "backpressure_seconds": round(self.backpressure_seconds, 3),
+            "completed": self.completed,
+            "failed": self.failed,
+            "deduplicated": self.deduplicated,
+        }
+
+    async def drain(self) -> None:
+        """等待所有已经提交的页保存完成"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    pass
@@ -0,0 +1,216 @@
+"""
+把一本书的图片合并成 PDF，会在合并进程中执行。
+
+和 imaging 一样，这里不要导入 settings、mylogger 等模块。
+"""
+
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+import imaging
+from book_state import BookManifest
+from pdf_writer import IncrementalPdf, PdfImage
+
+_progress_queue = None
+"子进程中用于报告进度的队列，由 init_worker 设置"
+
+PROGRESS_EVERY = 20
+"每合并多少页报告一次进度、检查一次是否被取消"
+
+WINDOW_PER_WORKER = 4
+"并行转换时，每个进程最多同时有几页在转换中、等待写入"
+
+
+class MergeCancelled(Exception):
+    """合并任务被取消了"""
+
+
+def init_worker(progress_queue) -> None:
+    """进程池的 initializer"""
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def _convert_pages(
+    pages: list[tuple[int, Path]], quality: int, adaptive: bool, workers: int
+) -> Iterator[tuple[int, PdfImage]]:
+    """
+    按照页码顺序逐个返回 (页码, 嵌入 PDF 的数据)。
+
+    workers 大于 1 时在进程池中并行转换，同时最多只有 workers * WINDOW_PER_WORKER 页在转换中、
+    等待写入，所以占用的内存和书的页数无关。
+    """
+    if workers <= 1:
+        for page_num, path in pages:
+            yield page_num, imaging.pdf_image_from_file(path, quality, adaptive)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        window: deque[tuple[int, Future]] = deque()
+        todo = iter(pages)
+        try:
+            while True:
+                # 把窗口填满，然后按顺序取出最早提交的那一页
+                while len(window) < workers * WINDOW_PER_WORKER:
+                    item = next(todo, None)
+                    if item is None:
+                        break
+                    page_num, path = item
+                    future = executor.submit(
+                        imaging.pdf_image_from_file, path, quality, adaptive
+                    )
+                    window.append((page_num, future))
+
+                if not window:
+                    return
+
+                page_num, future = window.popleft()
+                yield page_num, future.result()
+        finally:
+            for _, future in window:
+                future.cancel()
+
+
+def merge_pages(
+    pages: list[tuple[int, Path]],
+    partial: Path,
+    output: Path,
+    bookmark: list | None,
+    quality: int,
+    job_id: int | None = None,
+    cancel_path: Path | None = None,
+    adaptive: bool = False,
+    workers: int = 1,
+) -> int:
+    """
+    把 pages 中的图片按页码写入 PDF，返回总页数。
+
+    partial 是正在写入的 PDF，如果它已经存在（边下载边生成，或者上次合并到一半），已经写入的页会被跳过。
+    cancel_path 文件存在时会停止合并，partial 会保留下来，下次可以接着合并。
+    adaptive 为 True 时按照页的类型（黑白、灰度、彩色）选择编码，见 imaging.pdf_image_from_file。
+    workers 是转换图片的进程数，转换好的页依然按照页码顺序写入。
+    """
+    # 下载目录在第一次合并时才创建
+    output.parent.mkdir(parents=True, exist_ok=True)
+    partial.parent.mkdir(parents=True, exist_ok=True)
+    pdf = IncrementalPdf(partial)
+    try:
+        # 重复的页是硬链接到同一个文件的，它们直接引用第一页的图片，不需要再转换
+        todo, shared, first = [], {}, {}
+        for page_num, path in pages:
+            try:
+                stat = path.stat()
+                source = first.setdefault((stat.st_dev, stat.st_ino), page_num)
+            except OSError:
+                source = page_num
+
+            if page_num in pdf:
+                continue
+            if source == page_num:
+                todo.append((page_num, path))
+            else:
+                shared.setdefault(source, []).append((page_num, path))
+
+        done = reported = len(pdf)
+
+        def add_shared(source: int) -> None:
+            nonlocal done
+            for page_num, path in shared.pop(source, []):
+                if not pdf.add_shared_page(page_num, source):
+                    pdf.add_page(
+                        page_num, imaging.pdf_image_from_file(path, quality, adaptive)
+                    )
+                done += 1
+
+        for source in [source for source in shared if source in pdf]:
+            add_shared(source)
+
+        converted = _convert_pages(todo, quality, adaptive, workers)
+        try:
+            for page_num, pdf_image in converted:
+                pdf.add_page(page_num, pdf_image)
+                done += 1
+                add_shared(page_num)
+
+                if done - reported >= PROGRESS_EVERY:
+                    reported = done
+                    if _progress_queue is not None and job_id is not None:
+                        _progress_queue.put((job_id, done, len(pages)))
+                    if cancel_path is not None and cancel_path.exists():
+                        raise MergeCancelled()
+        finally:
+            converted.close()
+
+        total = len(pdf)
+        pdf.finalize(output, bookmark or None)
+        return total
+    finally:
+        pdf.close()
+
+
+def merge_book(
+    job_id: int,
+    images_path: Path,
+    partial: Path,
+    output: Path,
+    suffix: str,
+    quality: int,
+    adaptive: bool = False,
+    workers: int = 1,
+) -> int:
+    """
+    根据书籍的 manifest 合并 PDF，只有 manifest 中记录的页才会被合并。
+
+    每一页的图片格式以 manifest 中记录的为准，旧版本没有记录格式的页才使用 suffix。
+    """
+    manifest = BookManifest(images_path)
+    if not manifest.exists():
+        raise FileNotFoundError(f"没有找到书籍的 manifest: {images_path}")
+    # 代理可能正在追加 journal，只读取，不修复
+    manifest.load(repair=False)
+    manifest.close()
+
+    pages = manifest.page_files(suffix)
+    return merge_pages(
+        pages,
+        partial,
+        output,
+        manifest.bookmark,
+        quality,
+        job_id,
+        images_path / "merge.cancel",
+        adaptive,
+        workers,
+    )
+
+
+def build_book(
+    job_id: int,
+    images_path: Path,
+    partial: Path,
+    output: Path,
+    suffix: str,
+    quality: int,
+    adaptive: bool = False,
+    workers: int = 1,
+    optimize: bool = False,
+) -> dict:
+    """
+    合并 PDF（merge_book），optimize 为 True 时再优化一次（见 pdf_optimize）。
+
+    返回合并的页数、优化前后的对比。优化失败不影响已经合并好的 PDF，只在返回值中记录错误。
+    """
+    pages = merge_book(
+        job_id, images_path, partial, output, suffix, quality, adaptive, workers
+    )
+    result = {"pages": pages, "optimized": None, "optimize_error": None}
+    if optimize:
+        import pdf_optimize
+
+        try:
+            result["optimized"] = pdf_optimize.optimize_pdf(output)
+        except Exception as e:
+            result["optimize_error"] = f"{type(e).__name__}: {e}"
+    return result
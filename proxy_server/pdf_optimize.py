@@ -0,0 +1,107 @@
+"""
+合并完成之后优化 PDF（settings.jsonc 中的 pdf_optimize），在合并进程中执行，需要安装 pikepdf：
+
+    合并内容完全相同的图片      同一个图片只保留一份，所有用到它的页都引用它
+    删除没有用到的资源
+    压缩的对象流、交叉引用流    xref 表不再是每个对象 20 个字节的明文
+    线性化                    第一页的对象放在文件开头，阅读器、网络共享上的文件不需要读完整个文件就能显示第一页
+
+和 pdf_merge 一样，这里不要导入 settings、mylogger 等模块。
+"""
+
+import hashlib
+import importlib.util
+import os
+import time
+from pathlib import Path
+
+
+def available() -> bool:
+    """是否安装了 pikepdf"""
+    return importlib.util.find_spec("pikepdf") is not None
+
+
+def open_time(path: Path, repeat: int = 3) -> float:
+    """打开 PDF 并读取第一页的图片所用的时间（秒），取 repeat 次中最快的一次"""
+    import pikepdf
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with pikepdf.open(path) as pdf:
+            for image in pdf.pages[0].images.values():
+                image.read_raw_bytes()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _dedupe_images(pdf) -> int:
+    """内容完全相同的图片 XObject 只保留第一个，返回去掉的数量"""
+    seen = {}
+    deduped = 0
+    for page in pdf.pages:
+        resources = page.obj.get("/Resources")
+        xobjects = resources.get("/XObject") if resources is not None else None
+        if xobjects is None:
+            continue
+
+        for name in list(xobjects.keys()):
+            xobj = xobjects[name]
+            if xobj.get("/Subtype") != "/Image":
+                continue
+
+            digest = hashlib.blake2b(xobj.read_raw_bytes(), digest_size=16)
+            for key in ("/Width", "/Height", "/ColorSpace", "/Filter", "/DecodeParms"):
+                digest.update(repr(xobj.get(key)).encode())
+
+            first = seen.setdefault(digest.digest(), xobj)
+            if first.objgen != xobj.objgen:
+                xobjects[name] = first
+                deduped += 1
+    return deduped
+
+
+def optimize_pdf(path: Path, linearize: bool = True) -> dict:
+    """
+    重写 path，返回优化前后的大小（字节）、打开时间（秒），以及合并的重复图片数量。
+
+    先写入临时文件再替换，优化失败时 path 保持不变。
+    """
+    import pikepdf
+
+    before_size = path.stat().st_size
+    before_open = open_time(path)
+
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.optimize")
+    try:
+        with pikepdf.open(path) as pdf:
+            deduped = _dedupe_images(pdf)
+            pdf.remove_unreferenced_resources()
+            pdf.save(
+                tmp,
+                compress_streams=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                linearize=linearize,
+            )
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    return {
+        "size_before": before_size,
+        "size_after": path.stat().st_size,
+        "open_before": before_open,
+        "open_after": open_time(path),
+        "deduped_images": deduped,
+        "linearized": linearize,
+    }
+
+
+def describe(stats: dict) -> str:
+    """优化结果的说明，用于日志"""
+    return (
+        f"大小 <{stats['size_before'] / 1024 / 1024:.2f}MB> => "
+        f"<{stats['size_after'] / 1024 / 1024:.2f}MB>，"
+        f"打开时间 <{stats['open_before'] * 1000:.1f}ms> => <{stats['open_after'] * 1000:.1f}ms>，"
+        f"合并重复图片 <{stats['deduped_images']}> 个"
+    )
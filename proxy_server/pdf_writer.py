@@ -0,0 +1,323 @@
+"""
+一个只能写入图片页的、最简单的 PDF 生成器。
+
+每一页都是一个图片 XObject + 一个内容流 + 一个 Page 对象，写完就落盘，不在内存中保留图片数据。
+最后 finalize 时才写入页面树、书签、xref，所以不管书有多少页，占用的内存都差不多。
+
+这里只依赖标准库，方便在子进程中使用，不要在这里导入 settings、mylogger 等模块。
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import NamedTuple
+
+
+class PdfImage(NamedTuple):
+    """可以直接嵌入到 PDF 中的图片数据，data 已经是按照 filter 编码好的"""
+
+    width: int
+    height: int
+    color_space: str
+    "如 DeviceRGB、DeviceGray"
+    bits: int
+    "每个颜色分量的位数"
+    filter: str
+    "如 DCTDecode（也就是 JPEG）、FlateDecode"
+    data: bytes
+    decode_parms: str = ""
+    "DecodeParms 字典的内容，不需要时为空"
+
+
+def _pdf_text(text: str) -> bytes:
+    """PDF 中的文本字符串，统一用 UTF-16BE 编码，中文书签也能正常显示"""
+    return b"<FEFF" + text.encode("utf-16-be").hex().upper().encode() + b">"
+
+
+class IncrementalPdf:
+    """
+    边下载、边写入的 PDF 文件。
+
+    写入过程中 PDF 文件保存为 path，每写入一页都会在 path.idx 中追加一行记录，
+    所以进程重启后可以继续写入。如果上次写到一半崩溃了，会把文件截断到最后一条完整的记录。
+
+    内容完全相同的图片只写入一次，之后的页都引用同一个图片 XObject（比如空白页、重复的章节页）。
+    """
+
+    CATALOG = 1
+    "Catalog 对象的编号"
+    PAGES = 2
+    "页面树根节点的编号"
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        "正在写入的 PDF 文件"
+        self.index_path = path.with_name(path.name + ".idx")
+        "记录每一页对象偏移量的文件"
+
+        self.offsets: dict[int, int] = {}
+        "对象编号 => 在文件中的偏移量"
+        self.pages: dict[int, int] = {}
+        "页码 => Page 对象的编号"
+        self.next_obj = self.PAGES + 1
+        "下一个可用的对象编号"
+        self.images: dict[str, int] = {}
+        "图片数据的哈希值 => 图片 XObject 的编号"
+        self.page_images: dict[int, tuple[int, int, int, str]] = {}
+        "页码 => (图片 XObject 的编号, 宽, 高, 图片数据的哈希值)"
+        self.shared = 0
+        "引用了之前的图片、没有重复写入图片数据的页数"
+
+        self._file = None
+        self._index = None
+        self._open()
+
+    def _open(self) -> None:
+        end = 0
+        # index 中完整的记录的总长度
+        good = 0
+        if self.path.exists() and self.index_path.exists():
+            for line in self.index_path.read_bytes().splitlines(keepends=True):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                # 最后一行可能只写了一半
+                if record is None or not line.endswith(b"\n"):
+                    break
+                good += len(line)
+
+                for num, offset in record["objs"]:
+                    self.offsets[num] = offset
+                    self.next_obj = max(self.next_obj, num + 1)
+                self.pages[record["page"]] = record["objs"][-1][0]
+                if "image" in record:
+                    image = record["image"]
+                    self.page_images[record["page"]] = (
+                        image,
+                        record["w"],
+                        record["h"],
+                        record["hash"],
+                    )
+                    self.images.setdefault(record["hash"], image)
+                    self.shared += record.get("shared", False)
+                end = record["end"]
+
+        if end:
+            self._file = open(self.path, "r+b")
+            self._file.truncate(end)
+            self._file.seek(end)
+            # 同样去掉 index 中不完整的部分，否则之后追加的记录就接在半行后面了
+            with open(self.index_path, "r+b") as f:
+                f.truncate(good)
+            self._index = open(self.index_path, "a", encoding="utf-8")
+        else:
+            self._file = open(self.path, "wb")
+            self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+            self._index = open(self.index_path, "w", encoding="utf-8")
+
+    def __contains__(self, page_num: int) -> bool:
+        return page_num in self.pages
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def _alloc(self) -> int:
+        num = self.next_obj
+        self.next_obj += 1
+        return num
+
+    def _write_obj(self, num: int, body: bytes, stream: bytes | None = None) -> None:
+        self.offsets[num] = self._file.tell()
+        self._file.write(b"%d 0 obj\n" % num + body)
+        if stream is not None:
+            self._file.write(b"\nstream\n" + stream + b"\nendstream")
+        self._file.write(b"\nendobj\n")
+
+    def add_page(self, page_num: int, image: PdfImage) -> None:
+        """把一张图片作为第 page_num 页追加到文件末尾，重复添加的页会被忽略"""
+        if page_num in self.pages:
+            return
+
+        # 数据相同、宽高不同的图片也是可能的（比如不同大小的空白页），所以宽高等属性也要算进去
+        digest = hashlib.blake2b(image.data, digest_size=16)
+        digest.update(repr(image[:5] + image[6:]).encode())
+        digest = digest.hexdigest()
+        image_obj = self.images.get(digest)
+        if image_obj is not None:
+            self._write_page(page_num, image_obj, image.width, image.height, digest)
+            return
+
+        image_obj = self._alloc()
+        parms = b""
+        if image.decode_parms:
+            parms = b" /DecodeParms << " + image.decode_parms.encode() + b" >>"
+        self._write_obj(
+            image_obj,
+            b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /%s"
+            b" /BitsPerComponent %d /Filter /%s%s /Length %d >>"
+            % (
+                image.width,
+                image.height,
+                image.color_space.encode(),
+                image.bits,
+                image.filter.encode(),
+                parms,
+                len(image.data),
+            ),
+            image.data,
+        )
+        self.images[digest] = image_obj
+        self._write_page(
+            page_num, image_obj, image.width, image.height, digest, new_image=True
+        )
+
+    def add_shared_page(self, page_num: int, source: int) -> bool:
+        """
+        第 page_num 页和第 source 页的图片完全相同，直接引用 source 页的图片。
+
+        source 页不在文件中时返回 False，这时需要用 add_page 添加。
+        """
+        if page_num in self.pages:
+            return True
+        if source not in self.page_images:
+            return False
+
+        self._write_page(page_num, *self.page_images[source])
+        return True
+
+    def _write_page(
+        self,
+        page_num: int,
+        image_obj: int,
+        width: int,
+        height: int,
+        digest: str,
+        new_image: bool = False,
+    ) -> None:
+        """写入一页的内容流、Page 对象，然后在 path.idx 中记录这一页"""
+        content_obj, page_obj = self._alloc(), self._alloc()
+
+        # 72 dpi，一个像素对应一个单位，和 PIL 保存 PDF 时的默认行为一样
+        content = b"q %d 0 0 %d 0 0 cm /Im0 Do Q" % (width, height)
+        self._write_obj(content_obj, b"<< /Length %d >>" % len(content), content)
+
+        self._write_obj(
+            page_obj,
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d]"
+            b" /Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>"
+            % (self.PAGES, width, height, image_obj, content_obj),
+        )
+        self._file.flush()
+
+        self.pages[page_num] = page_obj
+        self.page_images[page_num] = (image_obj, width, height, digest)
+        if not new_image:
+            self.shared += 1
+
+        objs = (
+            (image_obj, content_obj, page_obj) if new_image else (content_obj, page_obj)
+        )
+        record = {
+            "page": page_num,
+            "objs": [[n, self.offsets[n]] for n in objs],
+            "image": image_obj,
+            "w": width,
+            "h": height,
+            "hash": digest,
+            "shared": not new_image,
+            "end": self._file.tell(),
+        }
+        self._index.write(json.dumps(record) + "\n")
+        self._index.flush()
+
+    def _write_outline(self, bookmark: list) -> int | None:
+        """写入书签，返回 Outlines 对象的编号，没有可用的书签时返回 None"""
+        root = self._alloc()
+
+        def _write_items(items: list, parent: int) -> tuple[int, int, int]:
+            """写入同一层级的书签，返回 (First, Last, Count)"""
+            # 书签对应的页没有下载的话，就跳过它
+            items = [item for item in items if int(item["pnum"]) in self.pages]
+            nums = [self._alloc() for _ in items]
+            count = len(items)
+
+            for i, item in enumerate(items):
+                body = b"<< /Title " + _pdf_text(item["label"])
+                body += b" /Parent %d 0 R" % parent
+                if i > 0:
+                    body += b" /Prev %d 0 R" % nums[i - 1]
+                if i < len(items) - 1:
+                    body += b" /Next %d 0 R" % nums[i + 1]
+
+                if item["children"]:
+                    first, last, child_count = _write_items(item["children"], nums[i])
+                    if child_count:
+                        body += b" /First %d 0 R /Last %d 0 R /Count %d" % (
+                            first,
+                            last,
+                            child_count,
+                        )
+                        count += child_count
+
+                page_obj = self.pages[int(item["pnum"])]
+                body += b" /Dest [%d 0 R /Fit] >>" % page_obj
+                self._write_obj(nums[i], body)
+
+            if not nums:
+                return 0, 0, 0
+            return nums[0], nums[-1], count
+
+        first, last, count = _write_items(bookmark, root)
+        if not count:
+            return None
+
+        self._write_obj(
+            root,
+            b"<< /Type /Outlines /First %d 0 R /Last %d 0 R /Count %d >>"
+            % (first, last, count),
+        )
+        return root
+
+    def finalize(self, output: Path, bookmark: list | None = None) -> None:
+        """写入页面树、书签、xref，然后把文件移动到 output"""
+        kids = b" ".join(b"%d 0 R" % self.pages[p] for p in sorted(self.pages))
+        self._write_obj(
+            self.PAGES,
+            b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % len(self.pages),
+        )
+
+        outline = self._write_outline(bookmark) if bookmark else None
+        catalog = b"<< /Type /Catalog /Pages %d 0 R" % self.PAGES
+        if outline:
+            catalog += b" /Outlines %d 0 R /PageMode /UseOutlines" % outline
+        self._write_obj(self.CATALOG, catalog + b" >>")
+
+        # 交叉引用表，每一项固定 20 个字节
+        xref_offset = self._file.tell()
+        size = self.next_obj
+        lines = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        for num in range(1, size):
+            if num in self.offsets:
+                lines.append(b"%010d 00000 n \n" % self.offsets[num])
+            else:
+                # 崩溃后被截断掉的对象
+                lines.append(b"0000000000 00000 f \n")
+        self._file.write(b"".join(lines))
+        self._file.write(
+            b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (size, self.CATALOG, xref_offset)
+        )
+
+        self.close()
+        os.replace(self.path, output)
+        self.index_path.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._index.close()
+            self._file = self._index = None
+
+    pass
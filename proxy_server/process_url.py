@@ -2,14 +2,51 @@
 根据 URL 进行不同的处理
 """
 
+import asyncio
 import json
+import re
 import urllib.parse
 
 import mitmproxy.http
 
 from mylogger import logger
-from settings import settings
-from wqbook import WQBook, SplitPageOrder
+from settings import RESTART_KEYS, reload_settings, settings, settings_mtime
+from imaging import SavedPage
+from events import event_bus
+from fetcher import PageFetcher
+from local_api import ApiRequest, local_api
+from merge_scheduler import merge_scheduler
+from metrics import metrics
+from page_worker import PagePipeline
+from wqbook import WQBook, SplitPageOrder, ledger_writer, pending_memory
+
+ROUTE_KEY = "wqbook_route"
+"请求阶段确定的路由保存在 flow.metadata 中的 key"
+
+
+class ApiRouter:
+    """根据域名、路径确定请求对应 settings["api"] 中的哪一个接口，正则只编译一次"""
+
+    def __init__(self, hosts: list[str], api: dict[str, str]) -> None:
+        self.hosts = set(hosts)
+        "网站的域名"
+        self.pattern = re.compile(
+            "|".join(f"(?P<{name}>{re.escape(path)})" for name, path in api.items())
+        )
+        "路径以某个接口开头时，匹配到的分组名称就是接口的名称"
+
+    def match(self, host: str, path: str) -> str | None:
+        """返回接口的名称，如 split_page，不需要处理时返回 None"""
+        if host not in self.hosts:
+            return None
+
+        m = self.pattern.match(path)
+        return m.lastgroup if m else None
+
+    pass
+
+
+api_router = ApiRouter(settings["api_hosts"], settings["api"])
 
 
 class WQBookAddon:
@@ -17,41 +54,173 @@ class WQBookAddon:
     def __init__(self) -> None:
         self.wqbook_pool: dict[int, WQBook] = {}
         "记录需要下载的书籍，key 是书籍 ID"
+        self.unloaded_book: set[int] = set()
+        "需要下载、但是还没有读取下载状态的书籍 ID，见 load_book"
         self.downloaded_book: set[int] = set()
         "记录已经下载过的书籍，key 是书籍 ID"
         self.split_page_order = SplitPageOrder()
         "记录小图片的下载顺序"
-
+        self.page_pipeline = PagePipeline(
+            settings["page_workers"], settings["page_queue_size"]
+        )
+        "在后台拼接、编码整页图片"
+        self.fetcher = PageFetcher(self.dispatch, self.split_page_order)
+        "主动请求缺少的页"
+        self._metrics_task: asyncio.Task | None = None
+        self._settings_task: asyncio.Task | None = None
+        self._load_task: asyncio.Task | None = None
+        self._settings_mtime = settings_mtime()
+        "配置文件上次的修改时间"
+        self._pacing_ms = 0
+        "上一次推送给翻页脚本的翻页间隔"
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+        merge_scheduler.start()
         self._init_wqbook_pool()
+        self._init_metrics()
         pass
 
     def _init_wqbook_pool(self) -> None:
         """读取 settings 文件，确认要下载哪些 book"""
         for book_id in settings["book_id"]:
-            self.wqbook_pool[book_id] = WQBook(book_id)
+            self.add_book(book_id)
+
+    def add_book(self, bid: int) -> bool:
+        """开始下载一本书，已经在下载、已经下载完的书返回 False"""
+        if (
+            bid in self.wqbook_pool
+            or bid in self.unloaded_book
+            or bid in self.downloaded_book
+        ):
+            return False
+
+        # 这里不读取书籍的下载状态，书籍多的时候代理可以立即启动
+        self.unloaded_book.add(bid)
+        logger.info(f"开始下载书籍 <{bid}>")
+        return True
+
+    def load_book(self, bid: int) -> WQBook | None:
+        """
+        返回需要下载的书籍，不需要下载、已经下载完的书籍返回 None。
+
+        书籍的下载状态（manifest、目录）在第一次用到时才读取：收到这本书的请求，
+        或者代理启动之后在空闲时由 _load_books 读取。
+        """
+        if bid in self.unloaded_book:
+            self.unloaded_book.discard(bid)
+            book = WQBook(bid)
+
+            # 上次已经下载完了，只是还没来得及生成 PDF
+            if book.resume_pdf():
+                self.downloaded_book.add(bid)
+            else:
+                self.wqbook_pool[bid] = book
+
+        return self.wqbook_pool.get(bid)
+
+    async def _load_books(self) -> None:
+        """代理启动之后，逐个读取还没有用到的书籍，每读取一本就让出一次事件循环"""
+        while self.unloaded_book:
+            await asyncio.sleep(0)
+            if self.unloaded_book:
+                self.load_book(min(self.unloaded_book))
+
+    def remove_book(self, bid: int) -> bool:
+        """不再下载一本书，还没凑齐小图片的页会被丢弃，已经保存的页不受影响"""
+        if bid in self.unloaded_book:
+            self.unloaded_book.discard(bid)
+            logger.info(f"不再下载书籍 <{bid}>")
+            return True
+
+        book = self.wqbook_pool.pop(bid, None)
+        if book is None:
+            return False
+
+        task = self.fetcher.tasks.pop(bid, None)
+        if task is not None:
+            task.cancel()
+        book.close()
+        logger.info(f"不再下载书籍 <{bid}>")
+        return True
+
+    def sync_books(self) -> None:
+        """按照 settings 中的 book_id 添加、移除书籍，其它书籍的状态不受影响"""
+        wanted = set(settings["book_id"])
+        for bid in [*self.wqbook_pool, *self.unloaded_book]:
+            if bid not in wanted:
+                self.remove_book(bid)
+        for bid in settings["book_id"]:
+            self.add_book(bid)
 
     # region 下面是 mitmproxy 规定的各种方法
 
-    async def response(self, flow: mitmproxy.http.HTTPFlow) -> None:
-        """对响应进行拦截，根据 URL 转发到各个方法进行处理"""
-        req_url = flow.request.pretty_url
-        body = flow.response.content
+    def requestheaders(self, flow: mitmproxy.http.HTTPFlow) -> None:
+        """
+        刚收到请求头时就确定要不要处理这个请求。
 
-        # 小图片的请求
-        if settings["api"]["split_page"] in req_url:
-            await self.process_req_split_page(req_url, body)
+        不需要处理的请求（其它网站、视频、大文件等）直接以流的方式转发，mitmproxy 不会缓存它们的内容。
+        """
+        route = api_router.match(flow.request.pretty_host, flow.request.path)
+        if route is None:
+            flow.request.stream = True
+            return
 
-        # 小图片之前的请求
-        elif settings["api"]["req_before_split_page"] in req_url:
-            await self.process_req_before_split_page(req_url, body)
+        flow.metadata[ROUTE_KEY] = route
+        self.fetcher.session.capture(route, flow.request)
 
-        # 书籍信息请求
-        elif settings["api"]["book_info"] in req_url:
-            await self.process_book_info(req_url, body)
+    def responseheaders(self, flow: mitmproxy.http.HTTPFlow) -> None:
+        """只缓存需要处理的响应，其它响应以流的方式转发"""
+        if ROUTE_KEY not in flow.metadata:
+            flow.response.stream = True
 
-        # 书签请求
-        elif settings["api"]["bookmark"] in req_url:
-            await self.process_bookmark(req_url, body)
+    async def response(self, flow: mitmproxy.http.HTTPFlow) -> None:
+        """对响应进行拦截，根据请求阶段确定的路由转发到各个方法进行处理"""
+        route = flow.metadata.get(ROUTE_KEY)
+        if route is None:
+            return
+
+        await self._process(route, flow.request.pretty_url, flow.response.content)
+
+    async def running(self) -> None:
+        """代理已经启动，开始提供本地接口、定期输出统计"""
+        self._loop = asyncio.get_running_loop()
+        # 只有翻页脚本所在的网站可以跨域访问本地接口
+        local_api.start(
+            settings["local_api_port"],
+            [f"https://{host}" for host in settings["api_hosts"]],
+        )
+        if settings["metrics_log_interval"]:
+            self._metrics_task = asyncio.ensure_future(self._log_metrics())
+        if settings["settings_reload_interval"]:
+            self._settings_task = asyncio.ensure_future(self._watch_settings())
+        self._load_task = asyncio.ensure_future(self._load_books())
+
+    async def done(self, wait_merges: bool = False) -> None:
+        """
+        mitmproxy 退出时，等待后台还没保存完的页。
+
+        wait_merges 为 True 时（离线重放抓包）还会等待所有合并任务完成，否则没开始的合并任务下次启动时继续。
+        """
+        if self._metrics_task:
+            self._metrics_task.cancel()
+        if self._settings_task:
+            self._settings_task.cancel()
+        if self._load_task:
+            self._load_task.cancel()
+        event_bus.close()
+        local_api.stop()
+
+        await self.fetcher.stop()
+        await self.page_pipeline.drain()
+        self.page_pipeline.shutdown()
+        # 下次可以直接按照计划补下载缺少的页，其它实例可以立即认领本实例没有处理完的页
+        for book in self.wqbook_pool.values():
+            book.close()
+        # 已经下载完的书可能还在选出合并者，合并任务要在 shutdown 之前提交
+        await ledger_writer.drain()
+        if wait_merges:
+            await asyncio.to_thread(merge_scheduler.wait_idle)
+        merge_scheduler.shutdown()
 
     # endregion
 
@@ -59,20 +228,334 @@ class WQBookAddon:
 
     # region 下面是自定义的各种方法
 
+    async def dispatch(self, req_url: str, body: bytes) -> None:
+        """根据 URL 转发到各个方法进行处理，离线重放抓包文件时也是调用它"""
+        parsed_url = urllib.parse.urlsplit(req_url)
+        route = api_router.match(parsed_url.hostname or "", parsed_url.path)
+        if route is None:
+            return
+
+        await self._process(route, req_url, body)
+
+    async def _process(self, route: str, req_url: str, body: bytes) -> None:
+        process = {
+            # 小图片的请求
+            "split_page": self.process_req_split_page,
+            # 小图片之前的请求
+            "req_before_split_page": self.process_req_before_split_page,
+            # 书籍信息请求
+            "book_info": self.process_book_info,
+            # 书签请求
+            "bookmark": self.process_bookmark,
+        }[route]
+
+        with metrics.dispatch.labels(route).time():
+            await process(req_url, body)
+
+    def _init_metrics(self) -> None:
+        """注册各个 gauge，以及本地接口 /metrics"""
+        metrics.gauge(
+            "wqbook_books",
+            "正在下载的书籍数量",
+            lambda: len(self.wqbook_pool),
+        )
+        metrics.gauge(
+            "wqbook_pending_pages",
+            "还没有保存完成的页数（包括还没凑齐小图片的页）",
+            lambda: sum(len(book.pages) for book in list(self.wqbook_pool.values()))
+            + self.page_pipeline.pending,
+        )
+        metrics.gauge(
+            "wqbook_page_queue_depth",
+            "等待编码、正在编码的页数",
+            lambda: self.page_pipeline.pending,
+        )
+        metrics.gauge(
+            "wqbook_zn_table_size",
+            "小图片顺序映射关系的数量",
+            lambda: len(self.split_page_order.zn_table),
+        )
+        metrics.gauge(
+            "wqbook_pending_tiles",
+            "暂存的、还没有映射关系的小图片数量",
+            lambda: len(self.split_page_order.pending_tiles),
+        )
+        metrics.gauge(
+            "wqbook_pending_memory_bytes",
+            "还没凑齐小图片的页占用的内存",
+            lambda: pending_memory.used,
+        )
+        metrics.gauge(
+            "wqbook_event_subscribers",
+            "订阅 /events 的连接数量",
+            lambda: event_bus.subscribers,
+        )
+        metrics.gauge(
+            "wqbook_merge_jobs",
+            "排队中、正在合并 PDF 的书籍数量",
+            lambda: sum(
+                job["state"] in ("queued", "running")
+                for job in merge_scheduler.status()
+            ),
+        )
+
+        local_api.add_route(
+            "GET",
+            "/metrics",
+            lambda request: (
+                200,
+                "text/plain; version=0.0.4; charset=utf-8",
+                metrics.render().encode(),
+            ),
+        )
+
+        local_api.add_route("GET", "/events", self.api_events)
+        local_api.add_route("GET", "/merge_jobs", self.api_merge_jobs)
+        local_api.add_route("DELETE", "/merge_jobs/", self.api_cancel_merge)
+        local_api.add_route("POST", "/fetch/", self.api_fetch)
+        local_api.add_route("GET", "/books", self.api_books)
+        local_api.add_route("GET", "/books/", self.api_refetch_plan)
+        local_api.add_route("POST", "/books/", self.api_control_book)
+        local_api.add_route("DELETE", "/books/", self.api_control_book)
+
+    def api_events(self, request: ApiRequest):
+        """GET /events 以 SSE 的方式推送页保存完成、小图片被丢弃、建议的翻页间隔等事件"""
+        event_bus.stream(request.handler, [("pacing", self.pacing())])
+
+    def pacing(self) -> dict:
+        """
+        根据积压情况建议翻页脚本的翻页间隔：编码队列、暂存的小图片越多，翻页越慢。
+
+        积压为 0 时是 scroll_min_interval_ms，积压满了时是 scroll_max_interval_ms。
+        """
+        pipeline = self.page_pipeline
+        order = self.split_page_order
+        load = max(
+            (pipeline.pending + pipeline.waiting) / pipeline.max_queue,
+            len(order.pending_tiles) / max(1, order.pending_max_size),
+        )
+        low = settings["scroll_min_interval_ms"]
+        high = settings["scroll_max_interval_ms"]
+        # 取整到 100ms，积压有一点变化时不需要推送
+        interval = round((low + (high - low) * min(1.0, load)) / 100) * 100
+        return {
+            "interval_ms": interval,
+            "pending": pipeline.pending,
+            "waiting": pipeline.waiting,
+            "max_queue": pipeline.max_queue,
+            "pending_tiles": len(order.pending_tiles),
+        }
+
+    def _publish_pacing(self) -> dict:
+        """建议的翻页间隔变化时推送 pacing 事件"""
+        pacing = self.pacing()
+        if pacing["interval_ms"] != self._pacing_ms:
+            self._pacing_ms = pacing["interval_ms"]
+            event_bus.publish("pacing", pacing)
+        return pacing
+
+    def api_merge_jobs(self, request: ApiRequest):
+        """所有合并任务的状态、进度"""
+        body = json.dumps(merge_scheduler.status(), ensure_ascii=False)
+        return 200, "application/json; charset=utf-8", body.encode()
+
+    def api_cancel_merge(self, request: ApiRequest):
+        """DELETE /merge_jobs/书籍ID 取消合并"""
+        bid = int(request.path.rsplit("/", 1)[-1])
+        if not merge_scheduler.cancel(bid):
+            return 404, "text/plain; charset=utf-8", b"no such job"
+        return 200, "text/plain; charset=utf-8", b"cancelled"
+
+    def api_fetch(self, request: ApiRequest):
+        """POST /fetch/书籍ID 主动下载这本书缺少的页"""
+        bid = int(request.path.rsplit("/", 1)[-1])
+        book = self._run_in_loop(self.load_book, bid) if self._loop else None
+        if book is None:
+            return 404, "text/plain; charset=utf-8", b"no such book"
+        if not self.fetcher.enabled or not self.fetcher.session.ready:
+            return 409, "text/plain; charset=utf-8", b"fetcher is not ready"
+
+        self._loop.call_soon_threadsafe(self.fetcher.start, book, True)
+        return 202, "text/plain; charset=utf-8", b"started"
+
+    def _run_in_loop(self, func, *args):
+        """本地接口运行在其它线程中，修改代理的状态需要交给事件循环执行，并等待结果"""
+
+        async def call():
+            return func(*args)
+
+        return asyncio.run_coroutine_threadsafe(call(), self._loop).result(timeout=30)
+
+    def api_books(self, request: ApiRequest):
+        """GET /books 所有书籍的下载状态"""
+
+        def collect():
+            books = [
+                {
+                    "bid": book.bid,
+                    "name": book.name,
+                    "total_page": book.total_page,
+                    "downloaded": len(book.downloaded_page),
+                    "pending": len(book.pages),
+                    "paused": book.paused,
+                    "shared": book.ledger.stats() if book.ledger else None,
+                }
+                for book in self.wqbook_pool.values()
+            ]
+            books += [{"bid": bid, "loaded": False} for bid in self.unloaded_book]
+            books += [{"bid": bid, "complete": True} for bid in self.downloaded_book]
+            return books
+
+        body = json.dumps(self._run_in_loop(collect), ensure_ascii=False)
+        return 200, "application/json; charset=utf-8", body.encode()
+
+    def api_refetch_plan(self, request: ApiRequest):
+        """
+        GET /books/书籍ID/missing 补下载的计划（JSON），见 WQBook.refetch_plan。
+        加上 ?format=text 时只返回压缩后的页码区间，比如 `1-3, 5`。
+        """
+        parts = request.path.strip("/").split("/")
+        if (
+            self._loop is None
+            or len(parts) != 3
+            or not parts[1].isdigit()
+            or parts[2] != "missing"
+        ):
+            return 404, "text/plain; charset=utf-8", b"not found"
+
+        def plan():
+            book = self.load_book(int(parts[1]))
+            return book.refetch_plan() if book is not None else None
+
+        plan = self._run_in_loop(plan)
+        if plan is None:
+            return 404, "text/plain; charset=utf-8", b"no such book"
+        if request.query.get("format") == ["text"]:
+            return 200, "text/plain; charset=utf-8", plan["text"].encode()
+        body = json.dumps(plan, ensure_ascii=False)
+        return 200, "application/json; charset=utf-8", body.encode()
+
+    def api_control_book(self, request: ApiRequest):
+        """
+        控制书籍的下载：
+            POST   /books/书籍ID         添加书籍
+            DELETE /books/书籍ID         移除书籍
+            POST   /books/书籍ID/pause   暂停下载
+            POST   /books/书籍ID/resume  继续下载
+            POST   /books/书籍ID/merge   立即合并已经下载的页
+
+        添加、移除只在本次运行中有效，修改配置文件中的 book_id 之后以配置文件为准。
+        """
+        parts = request.path.strip("/").split("/")
+        if self._loop is None or len(parts) not in (2, 3) or not parts[1].isdigit():
+            return 404, "text/plain; charset=utf-8", b"not found"
+
+        bid = int(parts[1])
+        action = parts[2] if len(parts) == 3 else request.method
+
+        def control() -> bool:
+            if action == "POST":
+                return self.add_book(bid)
+            if action == "DELETE":
+                return self.remove_book(bid)
+
+            book = self.load_book(bid)
+            if book is None:
+                return False
+            if action == "pause":
+                book.paused = True
+                task = self.fetcher.tasks.get(bid)
+                if task is not None:
+                    task.cancel()
+            elif action == "resume":
+                book.paused = False
+            elif action == "merge":
+                book.merge_now()
+            else:
+                return False
+
+            logger.info(f"书籍 <{bid}>: {action}")
+            return True
+
+        if not self._run_in_loop(control):
+            return 409, "text/plain; charset=utf-8", b"nothing changed"
+        return 200, "text/plain; charset=utf-8", b"ok"
+
+    async def _watch_settings(self) -> None:
+        """定期检查配置文件是否被修改，修改之后重新读取，不需要重启代理"""
+        interval = settings["settings_reload_interval"]
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                mtime = settings_mtime()
+                if mtime == self._settings_mtime:
+                    continue
+                self._settings_mtime = mtime
+                changed = reload_settings()
+            except Exception as e:
+                # 可能正在编辑、保存了一半，下次修改之后再读取
+                logger.error(f"重新读取配置文件失败: {e}")
+                continue
+
+            if changed:
+                self.apply_settings(changed)
+
+    def apply_settings(self, changed: list[str]) -> None:
+        """配置文件中的 changed 设置项被修改了"""
+        logger.info(f"配置文件已修改: {changed}")
+
+        if "book_id" in changed:
+            self.sync_books()
+        if "pending_page_memory_mb" in changed:
+            pending_memory.limit = settings["pending_page_memory_mb"] * 1024 * 1024
+
+        order = self.split_page_order
+        order.ttl = settings["zn_table_ttl"]
+        order.max_size = settings["zn_table_max_size"]
+        order.pending_ttl = settings["pending_tile_ttl"]
+        order.pending_max_size = settings["pending_tile_max_size"]
+        self.fetcher.pool.rate = settings["fetch_rate_limit"]
+
+        need_restart = [key for key in changed if key in RESTART_KEYS]
+        if need_restart:
+            logger.info(f"以下设置项需要重启代理才能生效: {need_restart}")
+
+    async def _log_metrics(self) -> None:
+        """定期在日志中输出各阶段的统计"""
+        interval = settings["metrics_log_interval"]
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(f"各阶段统计: {metrics.summary()}")
+
     async def filter_book(self, bid: int, page_num: int | None = None) -> bool:
         """是否需要过滤该书籍、或者该书籍某一页的处理"""
         # 不需要处理该书籍
-        if bid not in self.wqbook_pool:
+        if self.load_book(bid) is None:
             return True
 
         # 该书籍已经下载过了
         if bid in self.downloaded_book:
             return True
 
+        # 该书籍暂停下载了
+        if self.wqbook_pool[bid].paused:
+            return True
+
         # 该书籍的这一页已经下载过了
         if page_num and self.wqbook_pool[bid].is_page_downloaded(page_num):
             return True
 
+        # 多个实例共用图片目录时，这一页已经由其它实例保存好了、或者正在处理
+        book = self.wqbook_pool[bid]
+        if page_num and not await book.claim_page(page_num):
+            return True
+
+        # 认领时可能等待了 ledger 的写线程，这期间书籍可能已经下载完、被移除，这一页也可能已经保存好了
+        if self.wqbook_pool.get(bid) is not book or (
+            page_num and book.is_page_downloaded(page_num)
+        ):
+            return True
+
         return False
 
     async def process_book_info(self, url: str, body: bytes):
@@ -112,7 +595,11 @@ class WQBookAddon:
         # 故不需要解析整个 url 来获取书籍 id 哟
         k = query["k"][0]
         data = json.loads(body.decode())
-        self.split_page_order.add(k, data["data"])
+        resolved = self.split_page_order.add(k, data["data"])
+
+        # 它对应的小图片已经先到了
+        if resolved:
+            await self._add_split_page(*resolved)
 
     async def process_req_split_page(self, url: str, body: bytes):
         """处理 6 个小图片的请求"""
@@ -127,25 +614,72 @@ class WQBookAddon:
         if await self.filter_book(bid, page_num):
             return
 
+        # 已经抓到了请求的模板，可以开始主动下载缺少的页了（开启了主动下载模式时）
+        self.fetcher.start(self.wqbook_pool[bid])
+
         query = urllib.parse.parse_qs(parsed_url.query)
         # 解析 k 值，确认它是访问哪本书的、某一页，然后通过查表获取该小图片的顺序！
         k = query["k"][0]
 
         # 获取该小图片的顺序
-        order = self.split_page_order.get(k)
-        # 没有获取到小图片的信息，则忽略该请求了
+        metrics.tiles.inc()
+        order = self.split_page_order.get(k, body)
+        # 没有获取到小图片的信息，小图片已经被暂存起来，等映射关系到了之后再处理
         if order == -1:
             return
 
-        logger.debug(f"处理小图片 - 书籍 <{bid}>，页码 <{page_num}>，顺序 <{order}>")
+        await self._add_split_page(bid, page_num, order, body)
+
+    async def _add_split_page(self, bid: int, page_num: int, order: int, body: bytes):
+        """已经确认了小图片的顺序，把它添加到书籍的这一页"""
+        # 暂存的小图片等到映射关系时，这一页可能已经下载好了
+        if await self.filter_book(bid, page_num):
+            return
+
+        logger.debug(
+            "处理小图片 - 书籍 <%s>，页码 <%s>，顺序 <%s>", bid, page_num, order
+        )
+
+        # 给书籍的这一页添加小图片，凑齐 6 个小图片后交给流水线在后台合成、保存这一页
+        # 这里只会在编码队列已满时等待，否则立即放行这个响应
+        if self.wqbook_pool[bid].add_split_page(page_num, order, body):
+            await self.page_pipeline.submit(
+                self.wqbook_pool[bid], page_num, self.on_page_saved
+            )
+            self._publish_pacing()
+
+    def on_page_saved(
+        self, book: WQBook, page_num: int, saved: SavedPage | None
+    ) -> None:
+        """流水线保存完一页之后的回调，如果已经达到了最大页数，说明 PDF 已经下载完成"""
+        is_complete = book.finish_page(page_num, saved)
+        logger.debug(lambda: f"编码队列状态 => {self.page_pipeline.stats()}")
+        logger.debug(lambda: f"小图片顺序状态 => {self.split_page_order.stats()}")
+        if book.closed:
+            # 已经不再下载这本书了，翻页脚本也不需要知道
+            return
+
+        # 通知翻页脚本，这一页已经保存好了（或者保存失败，需要重新翻到）
+        pacing = self._publish_pacing()
+        if saved is None:
+            event_bus.publish("page-failed", {"bid": book.bid, "page": page_num})
+        else:
+            event_bus.publish(
+                "page-saved",
+                {
+                    "bid": book.bid,
+                    "page": page_num,
+                    "downloaded": len(book.downloaded_page),
+                    "total_page": book.total_page,
+                    "duplicate_of": saved.duplicate_of,
+                    "pacing": pacing,
+                },
+            )
 
-        # 给书籍的这一页添加小图片，如果添加了 6 个小图片后会自动合成、保存这一页
-        # 并且如果已经达到了最大页数，说明 PDF 已经下载完成
-        is_complete = self.wqbook_pool[bid].add_split_page(page_num, order, body)
         if is_complete:
-            logger.info(f"好耶！书籍 <{bid}> 已经下载完成，正在生成 PDF . . .")
-            self.downloaded_book.add(bid)
-            self.wqbook_pool.pop(bid)
+            logger.info(f"好耶！书籍 <{book.bid}> 已经下载完成，正在生成 PDF . . .")
+            self.downloaded_book.add(book.bid)
+            self.wqbook_pool.pop(book.bid, None)
 
     async def process_bookmark(self, url: str, body: bytes):
         """处理书签"""
@@ -164,6 +698,3 @@ class WQBookAddon:
     # endregion
 
     pass
-
-
-addons = [WQBookAddon()]
@@ -0,0 +1,202 @@
+"""
+离线批量重新生成 PDF：扫描 image_path 下每一本书的图片目录（book_images/<bid>/），
+根据其中的 manifest（页、书名、作者、书签）把图片合并成 PDF，输出到 save_path，文件名和在线下载时一样。
+
+修改了输出相关的设置（图片格式、质量、自适应编码）之后，可以用它重新生成所有的 PDF。
+PDF 比书籍目录中所有的图片、manifest、bookmark.json 都新的书会被跳过，除非加上 --force。
+
+用法:
+    python rebuild.py --jobs 4
+    python rebuild.py 3238891 3199625 --force
+
+多本书会在多个进程中同时合并，此时每本书只用一个进程转换图片。
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import pdf_merge
+import pdf_optimize
+import utils
+from book_state import IMAGE_SUFFIXES, BookManifest
+from mylogger import logger
+from settings import settings
+
+SOURCE_FILES = ("manifest.json", "manifest.journal", "bookmark.json")
+"除了图片之外，PDF 的内容还来自这些文件"
+
+
+def find_books(image_path: Path, book_ids: list[int] | None = None) -> list[Path]:
+    """找到所有有 manifest 的书籍目录，按 bid 排序"""
+    if not image_path.exists():
+        return []
+
+    books = []
+    for path in image_path.iterdir():
+        if not path.is_dir() or not path.name.isdigit():
+            continue
+        if book_ids and int(path.name) not in book_ids:
+            continue
+        if BookManifest(path).exists():
+            books.append(path)
+    return sorted(books, key=lambda path: int(path.name))
+
+
+def output_path(images_path: Path) -> Path:
+    """和 WQBook._output_pdf_path 一样，根据 manifest 中的书名、作者得到 PDF 的路径"""
+    manifest = BookManifest(images_path)
+    # 代理可能正在追加 journal，只读取，不修复
+    manifest.load(repair=False)
+    manifest.close()
+
+    good_name = utils.be_good_name(manifest.name)
+    good_author = utils.be_good_name(manifest.author)
+    return settings["save_path"] / f"{images_path.name}_{good_name}({good_author}).pdf"
+
+
+def is_up_to_date(images_path: Path, output: Path) -> bool:
+    """PDF 存在，并且不比书籍的任何图片、manifest、书签旧"""
+    if not output.exists():
+        return False
+
+    pdf_mtime = output.stat().st_mtime
+    # 修改过 picture_format 的书中可能有多种格式的图片，都要比较
+    suffixes = tuple(f".{suffix}" for suffix in IMAGE_SUFFIXES)
+    with os.scandir(images_path) as entries:
+        for entry in entries:
+            # 只比较 PDF 的内容来源，不管 refetch.json、正在写入的 PDF 等文件
+            if not (entry.name.endswith(suffixes) or entry.name in SOURCE_FILES):
+                continue
+            if entry.stat().st_mtime > pdf_mtime:
+                return False
+    return True
+
+
+def rebuild_book(
+    bid: int, images_path: Path, output: Path, page_workers: int, optimize: bool
+) -> dict:
+    """在子进程中合并一本书，返回页数、耗时、PDF 的大小，以及优化前后的对比"""
+    start = time.perf_counter()
+    # 每一页的格式以 manifest 中记录的为准，picture_format 只用于旧版本没有记录格式的页
+    result = pdf_merge.build_book(
+        bid,
+        images_path,
+        output.with_name(output.name + ".partial"),
+        output,
+        settings["picture_format"],
+        settings["picture_quality"],
+        settings["adaptive_encoding"],
+        page_workers,
+        optimize,
+    )
+    return {
+        "bid": bid,
+        **result,
+        "seconds": time.perf_counter() - start,
+        "size": output.stat().st_size,
+    }
+
+
+def rebuild(
+    book_ids: list[int] | None, jobs: int, force: bool, optimize: bool
+) -> list[dict]:
+    books = find_books(settings["image_path"], book_ids)
+
+    todo: list[tuple[int, Path, Path]] = []
+    for images_path in books:
+        output = output_path(images_path)
+        if not force and is_up_to_date(images_path, output):
+            logger.info(
+                f"书籍 <{images_path.name}> 的 PDF 已经是最新的，跳过: {output}"
+            )
+            continue
+        todo.append((int(images_path.name), images_path, output))
+
+    logger.info(
+        f"找到书籍 <{len(books)}> 本，需要重新生成 <{len(todo)}> 本，进程数 <{jobs}>"
+    )
+    if not todo:
+        return []
+
+    # 多本书同时合并时，每本书只用一个进程转换图片，避免进程数成倍增加
+    page_workers = 1 if jobs > 1 else settings["merge_page_workers"]
+
+    results = []
+    with ProcessPoolExecutor(min(jobs, len(todo))) as executor:
+        futures = {
+            executor.submit(
+                rebuild_book, bid, images_path, output, page_workers, optimize
+            ): bid
+            for bid, images_path, output in todo
+        }
+        for future in as_completed(futures):
+            bid = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(
+                    f"[{len(results) + 1}/{len(todo)}] 书籍 <{bid}> 合并失败: {e}"
+                )
+                results.append({"bid": bid, "error": str(e)})
+                continue
+
+            results.append(result)
+            logger.info(
+                f"[{len(results)}/{len(todo)}] 书籍 <{bid}> 合并完成: <{result['pages']}> 页，"
+                f"<{result['size'] / 1024 / 1024:.1f}MB>，耗时 <{result['seconds']:.2f}s>"
+            )
+            if result["optimized"]:
+                logger.info(
+                    f"书籍 <{bid}> 的 PDF 已优化: {pdf_optimize.describe(result['optimized'])}"
+                )
+            elif result["optimize_error"]:
+                logger.error(
+                    f"书籍 <{bid}> 的 PDF 优化失败: {result['optimize_error']}"
+                )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="根据已经下载的图片，批量重新生成 PDF")
+    parser.add_argument(
+        "book_id", type=int, nargs="*", help="要重新生成的书籍 id，默认为所有书籍"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="同时合并多少本书，默认为 CPU 核心数",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="PDF 已经是最新的也重新生成"
+    )
+    parser.add_argument(
+        "--optimize",
+        action=argparse.BooleanOptionalAction,
+        default=settings["pdf_optimize"],
+        help="合并之后优化 PDF（需要安装 pikepdf），默认使用 settings.jsonc 中的 pdf_optimize",
+    )
+    args = parser.parse_args()
+
+    if args.optimize and not pdf_optimize.available():
+        parser.error("没有安装 pikepdf，不能优化 PDF")
+
+    start = time.perf_counter()
+    results = rebuild(args.book_id, max(1, args.jobs), args.force, args.optimize)
+    elapsed = time.perf_counter() - start
+
+    done = [result for result in results if "error" not in result]
+    pages = sum(result["pages"] for result in done)
+    size = sum(result["size"] for result in done)
+    logger.info(
+        f"全部合并完成: 书籍 <{len(done)}/{len(results)}> 本，<{pages}> 页，"
+        f"<{size / 1024 / 1024:.1f}MB>，耗时 <{elapsed:.2f}s>，"
+        f"<{pages / elapsed if elapsed else 0:.2f}> 页/秒"
+    )
+
+
+if __name__ == "__main__":
+    main()
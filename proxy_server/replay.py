@@ -0,0 +1,141 @@
+"""
+离线重放抓包文件：把 mitmproxy 保存的 flow 文件（mitmdump -w 生成）或者浏览器导出的 HAR 文件，
+按顺序交给 WQBookAddon 处理，生成的图片、PDF 和在线下载时一样。
+
+修改了处理流程之后，可以用它重新处理以前的抓包，不需要再去网站上翻页；也可以用来测试处理速度。
+
+用法:
+    python replay.py a.flows b.har --jobs 2
+    python replay.py a.flows --book-id 3238891 3199625
+
+多个文件会在多个进程中同时处理，同一本书的抓包最好放在同一个文件里，否则多个进程会同时写入同一本书。
+每个进程的合并任务保存在各自的 merge_jobs.replay_<进程 id>.json 中，所有 PDF 都合并完之后才会退出。
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from mylogger import logger
+from settings import settings
+
+
+def read_har(path: Path) -> Iterator[tuple[str, bytes]]:
+    """读取 HAR 文件中的每一个请求，返回 (URL, 响应体)"""
+    har = json.loads(path.read_text(encoding="utf-8"))
+    for entry in har["log"]["entries"]:
+        content = entry["response"].get("content", {})
+        text = content.get("text")
+        if text is None:
+            continue
+
+        if content.get("encoding") == "base64":
+            body = base64.b64decode(text)
+        else:
+            body = text.encode("utf-8")
+        yield entry["request"]["url"], body
+
+
+def read_mitmproxy_flows(path: Path) -> Iterator[tuple[str, bytes]]:
+    """读取 mitmdump -w 保存的 flow 文件，返回 (URL, 响应体)"""
+    from mitmproxy import http, io
+
+    with open(path, "rb") as f:
+        for flow in io.FlowReader(f).stream():
+            if isinstance(flow, http.HTTPFlow) and flow.response is not None:
+                yield flow.request.pretty_url, flow.response.content
+
+
+def read_flows(path: Path) -> Iterator[tuple[str, bytes]]:
+    if path.suffix.lower() == ".har":
+        return read_har(path)
+    return read_mitmproxy_flows(path)
+
+
+async def _replay(path: Path) -> dict:
+    from merge_scheduler import merge_scheduler
+    from process_url import WQBookAddon
+
+    # 不和正在运行的代理、同时重放的其它进程共用 merge_jobs.json
+    merge_scheduler.state_name = f"replay_{os.getpid()}"
+    addon = WQBookAddon()
+
+    flow_count = 0
+    start = time.perf_counter()
+    for url, body in read_flows(path):
+        flow_count += 1
+        await addon.dispatch(url, body)
+
+    # 等待后台保存完所有页，并且合并完所有 PDF
+    await addon.done(wait_merges=True)
+    elapsed = time.perf_counter() - start
+
+    # 和之前的页内容相同、直接链接过去的页也保存了，只是不需要编码
+    encoded = addon.page_pipeline.completed
+    deduplicated = addon.page_pipeline.deduplicated
+    pages = encoded + deduplicated
+    return {
+        "file": str(path),
+        "flows": flow_count,
+        "pages": pages,
+        "encoded": encoded,
+        "deduplicated": deduplicated,
+        "seconds": elapsed,
+        "pages_per_second": pages / elapsed if elapsed else 0.0,
+    }
+
+
+def replay_file(path: Path, book_ids: list[int] | None = None) -> dict:
+    """重放一个抓包文件，返回处理的请求数、保存的页数（包括去重的页）、耗时"""
+    if book_ids:
+        settings["book_id"] = book_ids
+
+    result = asyncio.run(_replay(path))
+    logger.info(
+        f"重放 <{path}> 完成: 请求 <{result['flows']}> 个，保存 <{result['pages']}> 页"
+        f"（编码 <{result['encoded']}> 页，去重 <{result['deduplicated']}> 页），"
+        f"耗时 <{result['seconds']:.2f}s>，<{result['pages_per_second']:.2f}> 页/秒"
+    )
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="离线重放抓包文件，生成图片和 PDF")
+    parser.add_argument("files", nargs="+", type=Path, help="flow 文件或者 .har 文件")
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="同时处理多少个文件，默认为 1"
+    )
+    parser.add_argument(
+        "--book-id",
+        type=int,
+        nargs="*",
+        help="要处理的书籍 id，默认使用 settings.jsonc 中的 book_id",
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.jobs > 1 and len(args.files) > 1:
+        with ProcessPoolExecutor(args.jobs) as executor:
+            results = list(
+                executor.map(replay_file, args.files, [args.book_id] * len(args.files))
+            )
+    else:
+        results = [replay_file(path, args.book_id) for path in args.files]
+    elapsed = time.perf_counter() - start
+
+    pages = sum(result["pages"] for result in results)
+    deduplicated = sum(result["deduplicated"] for result in results)
+    logger.info(
+        f"全部重放完成: 文件 <{len(results)}> 个，保存 <{pages}> 页（去重 <{deduplicated}> 页），"
+        f"耗时 <{elapsed:.2f}s>，<{pages / elapsed if elapsed else 0:.2f}> 页/秒"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+"""
+检查已经下载的图片是否完整：扫描 image_path 下每一本书的 manifest 中记录的页，在多个进程中同时检查。
+
+    1. 文件是否存在、是否为空、大小是否和 manifest 中记录的一样（只需要 stat）
+    2. 文件头、文件尾是否完整，读取图片尺寸（不解码像素），见 imaging.check_image
+    3. 尺寸和这本书大部分页不一样、大小和 manifest 不一样、或者加上了 --full 时，才完整地解码一次
+
+有问题的页会从 manifest 中删除（图片改名为 .corrupt），下次下载这本书时会重新下载这些页。
+已经写入了这些页的 PDF（边下载边生成的 book.partial.pdf、上次没合并完的 .partial）也会被删除，
+否则重新下载之后合并时还是会跳过这些页，合并时会从图片补上其它页。
+检查通过的页按照 (mtime, 大小) 缓存在书籍目录的 scan_cache.json 中，文件没有变化时下次不再检查。
+每一页的图片格式以 manifest 中记录的为准。一本书的大部分页都找不到图片时，多半是配置或者目录不对，
+而不是图片坏了，这时不会删除任何页，除非加上 --force。
+
+用法:
+    python scan.py --jobs 4
+    python scan.py 3238891 --full --dry-run
+    python scan.py 3238891 --force
+
+请在代理没有下载这些书的时候运行，否则代理不知道哪些页被删除了。
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import imaging
+from book_state import BookManifest, atomic_write_bytes
+from mylogger import logger
+from rebuild import find_books, output_path
+from settings import settings
+
+CACHE_FILE = "scan_cache.json"
+CACHE_VERSION = 2
+CHUNK_SIZE = 64
+"每个任务检查多少页"
+MISSING = "文件不存在"
+MASS_MISSING_RATIO = 0.5
+"找不到图片的页超过这个比例（并且不少于 MASS_MISSING_MIN 页）时，认为是配置不对，不删除任何页"
+MASS_MISSING_MIN = 5
+
+
+def check_pages(items: list, full: bool) -> list:
+    """
+    在子进程中检查一批页，items 是 (页码, 图片文件, manifest 中记录的大小) 组成的列表。
+
+    返回 (页码, 问题, 宽, 高, 是否完整解码过) 组成的列表。
+    """
+    results = []
+    for page_num, path, expected_size in items:
+        try:
+            size = path.stat().st_size
+        except OSError:
+            results.append((page_num, MISSING, 0, 0, False))
+            continue
+
+        # 大小和 manifest 中记录的不一样，只能完整解码来确认图片是否还能用
+        decode = full or size != expected_size
+        problem, width, height = imaging.check_image(path, decode)
+        results.append((page_num, problem, width, height, decode))
+    return results
+
+
+class BookScan:
+    """一本书的扫描状态"""
+
+    def __init__(self, images_path: Path, suffix: str) -> None:
+        self.bid = int(images_path.name)
+        self.images_path = images_path
+        self.suffix = suffix
+        "当前的 picture_format，只用于旧版本的 manifest 中没有记录格式的页"
+
+        self.manifest = BookManifest(images_path, settings["shared_store"])
+        self.manifest.load()
+        self.manifest.close()
+        self.files = dict(self.manifest.page_files(suffix))
+        "页码 => 图片文件"
+
+        self.cache_path = images_path / CACHE_FILE
+        self.cache: dict[str, list] = self._load_cache()
+        "页码 => [mtime_ns, 大小, 宽, 高, 是否完整解码过, 文件名]，只缓存检查通过的页"
+
+        self.todo: list[tuple[int, Path, int]] = []
+        "需要检查的 (页码, 图片文件, manifest 中记录的大小)"
+        self.stat: dict[int, tuple[int, int]] = {}
+        "页码 => (mtime_ns, 大小)"
+        self.sizes: dict[int, tuple[int, int, bool]] = {}
+        "检查通过的页 => (宽, 高, 是否完整解码过)"
+        self.bad: dict[int, str] = {}
+        "有问题的页 => 问题"
+        self.warnings: dict[int, str] = {}
+        "可以使用、但是有些奇怪的页 => 说明"
+        self.stale_pdfs: list[Path] = []
+        "写入了有问题的页、需要删除的 PDF"
+        self.refused = False
+        "大部分页都找不到图片，没有删除任何页"
+        self.total = len(self.manifest.pages)
+        "manifest 中记录的页数"
+        self.cached = 0
+        "直接使用缓存的页数"
+
+    def _load_cache(self) -> dict[str, list]:
+        try:
+            data = json.loads(self.cache_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        if data.get("version") != CACHE_VERSION:
+            return {}
+        return data["pages"]
+
+    def plan(self, full: bool) -> None:
+        """stat 每一页，没有变化的页直接使用缓存，其它页放进 todo"""
+        for page_num, value in sorted(self.manifest.pages.items()):
+            expected_size = value[1]
+            path = self.files[page_num]
+            try:
+                st = path.stat()
+            except OSError:
+                self.bad[page_num] = MISSING
+                continue
+            if not st.st_size:
+                self.bad[page_num] = "空文件"
+                continue
+
+            self.stat[page_num] = (st.st_mtime_ns, st.st_size)
+            cached = self.cache.get(str(page_num))
+            if (
+                cached is not None
+                and cached[:2] == [st.st_mtime_ns, st.st_size]
+                and cached[5] == path.name
+                and (cached[4] or not full)
+            ):
+                self.sizes[page_num] = (cached[2], cached[3], cached[4])
+                self.cached += 1
+            else:
+                self.todo.append((page_num, path, expected_size))
+
+    def chunks(self, items: list) -> list[list]:
+        return [items[i : i + CHUNK_SIZE] for i in range(0, len(items), CHUNK_SIZE)]
+
+    def add_results(self, results: list) -> None:
+        for page_num, problem, width, height, decoded in results:
+            if problem:
+                self.bad[page_num] = problem
+            else:
+                self.sizes[page_num] = (width, height, decoded)
+                expected_size = self.manifest.pages[page_num][1]
+                if self.stat.get(page_num, (0, 0))[1] != expected_size:
+                    self.warnings[page_num] = (
+                        "大小和 manifest 中记录的不一样，但是可以正常解码"
+                    )
+
+    def odd_pages(self) -> list[tuple[int, int]]:
+        """尺寸和大部分页不一样的页，还没有完整解码过的需要再完整解码一次"""
+        counts: dict[tuple[int, int], int] = {}
+        for width, height, _ in self.sizes.values():
+            counts[(width, height)] = counts.get((width, height), 0) + 1
+        if not counts:
+            return []
+
+        common = max(counts, key=counts.get)
+        todo = []
+        for page_num, (width, height, decoded) in sorted(self.sizes.items()):
+            if (width, height) == common:
+                continue
+            self.warnings[page_num] = (
+                f"尺寸 <{width}x{height}> 和大部分页 <{common[0]}x{common[1]}> 不一样"
+            )
+            if not decoded:
+                todo.append(
+                    (page_num, self.files[page_num], self.manifest.pages[page_num][1])
+                )
+        return todo
+
+    def mass_missing(self) -> bool:
+        """大部分页都找不到图片，多半是配置（比如 image_path）不对，而不是图片坏了"""
+        missing = sum(problem == MISSING for problem in self.bad.values())
+        return (
+            missing >= MASS_MISSING_MIN and missing >= self.total * MASS_MISSING_RATIO
+        )
+
+    def apply(self, dry_run: bool, force: bool = False) -> None:
+        """把有问题的页标记为没有下载，保存检查通过的页的缓存"""
+        for page_num in self.bad:
+            self.sizes.pop(page_num, None)
+            self.warnings.pop(page_num, None)
+
+        if self.bad and not force and self.mass_missing():
+            self.refused = True
+            dry_run = True
+
+        if self.bad:
+            self.stale_pdfs = self._find_stale_pdfs()
+
+        if self.bad and not dry_run:
+            for page_num in sorted(self.bad):
+                self.manifest.drop_page(page_num)
+                path = self.files[page_num]
+                if path.exists():
+                    os.replace(path, path.with_name(path.name + ".corrupt"))
+            self.manifest.close()
+            self._drop_from_ledger()
+            for pdf in self.stale_pdfs:
+                pdf.unlink(missing_ok=True)
+                pdf.with_name(pdf.name + ".idx").unlink(missing_ok=True)
+
+        pages = {
+            str(page_num): [
+                *self.stat[page_num],
+                width,
+                height,
+                decoded,
+                self.files[page_num].name,
+            ]
+            for page_num, (width, height, decoded) in self.sizes.items()
+        }
+        atomic_write_bytes(
+            self.cache_path,
+            json.dumps({"version": CACHE_VERSION, "pages": pages}).encode("utf-8"),
+        )
+
+    def _find_stale_pdfs(self) -> list[Path]:
+        """
+        正在写入的 PDF 中已经有了有问题的页，IncrementalPdf 会跳过已经写入的页，重新下载之后也不会替换它们。
+        """
+        output = output_path(self.images_path)
+        stale = []
+        for pdf in (
+            self.images_path / "book.partial.pdf",
+            output.with_name(output.name + ".partial"),
+        ):
+            index_path = pdf.with_name(pdf.name + ".idx")
+            if not index_path.exists():
+                continue
+            for line in index_path.read_text(encoding="utf-8").splitlines():
+                try:
+                    page_num = json.loads(line)["page"]
+                except (ValueError, KeyError):
+                    continue
+                if page_num in self.bad:
+                    stale.append(pdf)
+                    break
+        return stale
+
+    def _drop_from_ledger(self) -> None:
+        """多个实例共用图片目录时，其它实例也要知道这些页需要重新下载"""
+        from ledger import PageLedger
+
+        if not (self.images_path / PageLedger.FILENAME).exists():
+            return
+        ledger = PageLedger(
+            self.images_path, settings["instance_id"], settings["claim_ttl"]
+        )
+        try:
+            ledger.drop_pages(self.bad)
+        finally:
+            ledger.close()
+
+    pass
+
+
+def _run(executor: ProcessPoolExecutor, scans: list[BookScan], todo, full: bool):
+    """把每本书要检查的页分成若干批，在进程池中同时检查"""
+    futures = []
+    for scan in scans:
+        for chunk in scan.chunks(todo(scan)):
+            futures.append((scan, executor.submit(check_pages, chunk, full)))
+    for scan, future in futures:
+        scan.add_results(future.result())
+
+
+def scan_books(
+    book_ids: list[int] | None,
+    jobs: int,
+    full: bool,
+    dry_run: bool,
+    force: bool = False,
+) -> list[BookScan]:
+    suffix = settings["picture_format"]
+    scans = [
+        BookScan(path, suffix) for path in find_books(settings["image_path"], book_ids)
+    ]
+    for scan in scans:
+        scan.plan(full)
+
+    with ProcessPoolExecutor(jobs) as executor:
+        _run(executor, scans, lambda scan: scan.todo, full)
+        # 尺寸不一致的页再完整解码一次，确认它们是不是坏的
+        _run(executor, scans, lambda scan: scan.odd_pages(), True)
+
+    for scan in scans:
+        scan.apply(dry_run, force)
+        checked = scan.total - scan.cached
+        logger.info(
+            f"书籍 <{scan.bid}> 检查 <{checked}> 页，缓存 <{scan.cached}> 页，"
+            f"有问题 <{len(scan.bad)}> 页，需要注意 <{len(scan.warnings)}> 页"
+        )
+        for page_num, problem in sorted(scan.bad.items()):
+            logger.error(f"书籍 <{scan.bid}> 的第 <{page_num}> 页有问题: {problem}")
+        for page_num, warning in sorted(scan.warnings.items()):
+            logger.info(f"书籍 <{scan.bid}> 的第 <{page_num}> 页: {warning}")
+        if scan.refused:
+            logger.error(
+                f"书籍 <{scan.bid}> 的 <{len(scan.bad)}/{scan.total}> 页有问题，其中大部分是找不到图片，"
+                f"多半是配置不对（比如 image_path），没有删除任何页。确实需要删除时请加上 --force"
+            )
+        for pdf in scan.stale_pdfs:
+            action = "需要删除" if dry_run or scan.refused else "已经删除"
+            logger.info(f"书籍 <{scan.bid}> 的 {pdf} 中写入了有问题的页，{action}")
+    return scans
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="检查已经下载的图片是否完整")
+    parser.add_argument(
+        "book_id", type=int, nargs="*", help="要检查的书籍 id，默认为所有书籍"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="检查图片的进程数，默认为 CPU 核心数",
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="完整解码每一页（包括缓存中的页）"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="只检查，不从 manifest 中删除有问题的页"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="大部分页都找不到图片时也删除它们（默认认为是配置不对，不删除）",
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    scans = scan_books(
+        args.book_id, max(1, args.jobs), args.full, args.dry_run, args.force
+    )
+    elapsed = time.perf_counter() - start
+
+    pages = sum(scan.total for scan in scans)
+    cached = sum(scan.cached for scan in scans)
+    bad = sum(len(scan.bad) for scan in scans)
+    action = "" if args.dry_run or not bad else "，已经标记为没有下载"
+    logger.info(
+        f"全部检查完成: 书籍 <{len(scans)}> 本，<{pages}> 页（缓存 <{cached}> 页），"
+        f"有问题 <{bad}> 页{action}，耗时 <{elapsed:.2f}s>，"
+        f"<{(pages - cached) / elapsed if elapsed else 0:.0f}> 页/秒"
+    )
+
+
+if __name__ == "__main__":
+    main()
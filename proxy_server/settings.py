@@ -1,12 +1,29 @@
+import os
+import socket
 import commentjson as json
 from pathlib import Path
 from datetime import datetime
 
-__all__ = ["settings"]
+__all__ = ["settings", "reload_settings", "settings_mtime", "RESTART_KEYS"]
 
 # 配置文件必须在本 .py 的同一层目录中！
 settings_file = Path(__file__).parent / "settings.jsonc"
-settings = json.loads(settings_file.read_text(encoding="utf-8"))
+
+# 同一台机器上运行多个代理实例时，可以用环境变量 WQBOOK_SETTINGS 指定另一个配置文件，
+# 其中的设置项会覆盖 settings.jsonc 中的（比如 local_api_port、instance_id）
+override_file = (
+    Path(os.environ["WQBOOK_SETTINGS"]) if os.environ.get("WQBOOK_SETTINGS") else None
+)
+
+
+def _read() -> dict:
+    data = json.loads(settings_file.read_text(encoding="utf-8"))
+    if override_file is not None:
+        data.update(json.loads(override_file.read_text(encoding="utf-8")))
+    return data
+
+
+settings = _read()
 
 
 def create_path(path: str):
@@ -22,8 +39,19 @@ settings["save_path"] = project_dir / "download_book"
 # 保存书籍每一页时的临时路径。以 `/书籍id/` 目录保存特定书籍的图片
 settings["image_path"] = project_dir / "book_images"
 
-create_path(settings["save_path"])
-create_path(settings["image_path"])
+# 这两个目录在第一次用到时才创建（保存图片、合并 PDF），启动时不需要访问磁盘
+
+
+def _normalize(data: dict) -> None:
+    # 合并 PDF 时转换图片的进程数，0 表示使用所有 CPU 核心
+    data["merge_page_workers"] = data["merge_page_workers"] or os.cpu_count() or 1
+    # 同一台机器上的多个实例的本地接口端口肯定不同，重启之后也不变
+    data["instance_id"] = (
+        data["instance_id"] or f"{socket.gethostname()}-{data['local_api_port']}"
+    )
+
+
+_normalize(settings)
 
 
 if settings["log_file"]:
@@ -36,3 +64,47 @@ if settings["log_file"]:
     settings["log_file"] = log_path / f"{formatted_time}.log"
 else:
     settings["log_file"] = None
+
+
+DERIVED_KEYS = ("save_path", "image_path", "log_file")
+"由这里计算出来的设置项，重新读取配置文件时保留原来的值"
+
+RESTART_KEYS = (
+    "page_workers",
+    "page_queue_size",
+    "merge_workers",
+    "merge_page_workers",
+    "local_api_port",
+    "api_hosts",
+    "api",
+    "logger_level",
+    "fetch_concurrency",
+    "shared_store",
+    "instance_id",
+)
+"启动时就已经用掉的设置项，修改之后需要重启代理才能生效"
+
+
+def settings_mtime() -> float:
+    if override_file is not None:
+        return max(settings_file.stat().st_mtime, override_file.stat().st_mtime)
+    return settings_file.stat().st_mtime
+
+
+def reload_settings() -> list[str]:
+    """
+    重新读取配置文件，直接修改 settings 字典，返回值发生变化的设置项。
+
+    大部分设置项每次用到时才从 settings 中读取，所以修改之后立即生效，RESTART_KEYS 中的除外。
+    配置文件格式错误时抛出异常，settings 保持不变。
+    """
+    data = _read()
+    _normalize(data)
+
+    changed = []
+    for key, value in data.items():
+        if key in DERIVED_KEYS or settings.get(key) == value:
+            continue
+        settings[key] = value
+        changed.append(key)
+    return changed
@@ -1,52 +1,71 @@
 import json
+import functools
 import traceback
 import base64
 from pathlib import Path
-from io import BytesIO
-
-import jwt
-import pypdf
-from PIL import Image
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import unpad
-
 
+# jwt、Crypto、pdf_merge（会加载 PIL）都在函数中才导入，收到第一个请求之前不需要它们，代理启动更快
+from metrics import metrics
 from mylogger import logger
 from settings import settings
 
 
+@functools.lru_cache(maxsize=4096)
 def jwt_decrypt(k: str) -> dict:
-    """如果解密失败，则返回空字典"""
+    """
+    如果解密失败，则返回空字典。
+
+    同一个 k 值的结果会被缓存，所以不要修改返回的字典。
+    """
+    import jwt
+
     try:
-        decrypt_data = jwt.decode(
-            k,
-            "secret",
-            algorithms=["HS256"],
-            # 必须加上这一行
-            options={"verify_signature": False},
-        )
+        with metrics.jwt_decrypt.time():
+            decrypt_data = jwt.decode(
+                k,
+                "secret",
+                algorithms=["HS256"],
+                # 必须加上这一行
+                options={"verify_signature": False},
+            )
     except Exception as e:
-        logger.error(
-            f"jwt_decrypt 错误: {e}。\n解密数据为: {k}。\n堆栈: { traceback.format_exc()}。"
+        # 网站改版之后每个请求都会失败，同样的错误不需要每次都输出
+        logger.limited(
+            "error",
+            "jwt_decrypt",
+            lambda: f"jwt_decrypt 错误: {e}。\n解密数据为: {k}。\n堆栈: { traceback.format_exc()}。",
         )
         decrypt_data = {}
 
     return decrypt_data
 
 
+@functools.lru_cache(maxsize=1024)
+def _aes_cipher(key: bytes):
+    """ECB 模式没有状态，同一个 key 的 cipher 对象可以重复使用"""
+    from Crypto.Cipher import AES
+
+    return AES.new(key, AES.MODE_ECB)
+
+
 def aes_decrypt(ciphertext: str, key: str) -> str:
     """如果解密失败，则返回空字符串"""
+    from Crypto.Util.Padding import unpad
+
     ciphertext = base64.b64decode(ciphertext)
     key = key.encode()
 
-    cipher = AES.new(key, AES.MODE_ECB)
+    cipher = _aes_cipher(key)
 
     try:
-        text = unpad(cipher.decrypt(ciphertext), AES.block_size)
+        with metrics.aes_decrypt.time():
+            text = unpad(cipher.decrypt(ciphertext), cipher.block_size)
         result = text.decode()
     except Exception as e:
-        logger.error(
-            f"AES decrypt error: {e}。\n密文为: {ciphertext}，key 为: {key}。\n堆栈: { traceback.format_exc()}。"
+        logger.limited(
+            "error",
+            "aes_decrypt",
+            lambda: f"AES decrypt error: {e}。\n密文为: {ciphertext}，key 为: {key}。\n堆栈: { traceback.format_exc()}。",
         )
         result = ""
 
@@ -75,75 +94,40 @@ def get_imgs_files(dir: Path, suffix: str) -> list[Path]:
     return sorted(result, key=lambda x: int(x.stem))
 
 
-def _add_bookmark(pdf_writer: pypdf.PdfWriter, bookmark: dict):
-    """给 PDF 添加书签"""
-    """
-    bookmark 的每一项都是一个书签，格式如下：
-        {
-            "id": "281474976645121",
-            "pid": "0",
-            "label": "封面",  # 书签名
-            "pnum": "1",     # 书签的页数
-            "level": "1",    # 书签的层级
-            "isLeaf": true,  # 是否是叶子节点，如果是，则下方的 children 为 null，否则为下一层级的书签
-            "children": null   # 下一层级的书签
-        },
+def merge_image_as_pdf(path: Path, filename: str, bookmark: dict | None = None):
     """
+    将目录下的图片合并成一个 PDF，并添加书签。
 
-    all_page_num = pdf_writer.get_num_pages()  # 记录总页数，因为图片可能缺页呀
-
-    def _add_outline(parent_bookmark, bookmark: dict):
-        """递归添加书签。
-
-        parent_bookmark 记录最近一次访问的、上一层级的书签，当前书签都将添加到其下面
-        """
-        for item in bookmark:
-            title = item["label"]
-            page_num = int(item["pnum"]) - 1  # 索引从 0 开始哟
-
-            # pdf 缺页了，那就先返回吧
-            if page_num > all_page_num:
-                return
-
-            # 先添加当前书签
-            current_bookmark = pdf_writer.add_outline_item(
-                title, page_num, parent_bookmark
-            )
-
-            # 递归处理子书签
-            if item["children"]:
-                _add_outline(current_bookmark, item["children"])
-
-        pass
-
-    _add_outline(None, bookmark)
-    pass
-
+    JPEG 图片会原样嵌入 PDF，不会解码像素；其它格式的图片需要解码后再编码成 JPEG。
+    每一页写完就落盘，内存中不会保留所有页的数据。
+    """
+    import pdf_merge
 
-def merge_image_as_pdf(path: Path, filename: str, bookmark: dict | None = None):
-    """将目录下的图片合并成一个 PDF，并添加书签"""
-    page_num = 0  # 记录当前处理的是第几页
+    filename = Path(filename)
+    pages = [
+        (int(img.stem), img)
+        for img in get_imgs_files(path, suffix=settings["picture_format"])
+    ]
 
     try:
-        with pypdf.PdfWriter() as pdf_writer:
-            # 先拼接成一个 PDF，然后添加书签
-            for img in get_imgs_files(path, suffix=settings["picture_format"]):
-                page_num += 1
-
-                # 图片转为 pdf 保存到 stream 中
-                pdf_stream = BytesIO()
-                Image.open(img).save(pdf_stream, "PDF")
-
-                # 读取 stream 中的 pdf 文件
-                reader = pypdf.PdfReader(pdf_stream)
-                pdf_writer.add_page(reader.pages[0])
+        with metrics.merge_pdf.time():
+            pdf_merge.merge_pages(
+                pages,
+                filename.with_name(filename.name + ".partial"),
+                filename,
+                bookmark,
+                settings["picture_quality"],
+                adaptive=settings["adaptive_encoding"],
+                workers=settings["merge_page_workers"],
+            )
 
-            if bookmark:
-                _add_bookmark(pdf_writer, bookmark)
+        logger.info(f"合并图片为 PDF 成功，文件名: {filename}")
 
-            pdf_writer.write(filename)
+        import pdf_optimize
 
-            logger.info(f"合并图片为 PDF 成功，文件名: {filename}")
+        if settings["pdf_optimize"] and pdf_optimize.available():
+            stats = pdf_optimize.optimize_pdf(filename)
+            logger.info(f"PDF 已优化: {pdf_optimize.describe(stats)}")
 
     except Exception as e:
         logger.error(f"合并图片为 PDF 失败: {e}。\n堆栈: { traceback.format_exc()}。")
@@ -152,7 +136,7 @@ def merge_image_as_pdf(path: Path, filename: str, bookmark: dict | None = None):
 
 
 if __name__ == "__main__":
-    # 此处用于手动合并 PDF
+    # 此处用于手动合并一本书的 PDF，批量重新生成所有书籍的 PDF 请使用 rebuild.py
     images_path = Path("这里填入下载的图片的位置")
 
     # 书签文件应该也在 images_path 下
@@ -2,72 +2,221 @@
 基本的 class
 """
 
+import asyncio
 import json
-import threading
+import shutil
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import Future
 from pathlib import Path
-from io import BytesIO
-
-from PIL import Image
+from typing import TYPE_CHECKING
 
+import imaging
 import utils
+from book_state import (
+    IMAGE_SUFFIXES,
+    BookManifest,
+    PageSet,
+    atomic_write_bytes,
+    checksum,
+    content_hash,
+    format_ranges,
+    link_or_copy,
+    pages_to_bitmap,
+)
+from imaging import SavedPage
+from pdf_writer import IncrementalPdf
+from events import event_bus
+from merge_scheduler import merge_scheduler
+from metrics import metrics
 from settings import settings
 from mylogger import logger
 
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from ledger import PageLedger
+
 
 class OnePage:
     """表示书籍一页的内容"""
 
+    __slots__ = ("split_pages", "hashes", "count", "spilled")
+
     def __init__(self) -> None:
-        self.added_pages: set[int] = set()
-        "记录添加的小图片的顺序数字，当它的长度为 6 时，表示已经添加了 6 张小图片啦"
-        self.split_pages: dict[int, bytes] = {}
-        "一页由 6 个被分割后的图片组成，它们也是有顺序的"
-
-    def add_split_page(self, index: int, image: bytes) -> None:
-        """添加一个被分割后的图片"""
-        if index < 0 and index > 6:
+        self.split_pages: list[bytes | None] = [None] * 6
+        "一页由 6 个被分割后的图片组成，它们也是有顺序的，还没到的小图片为 None"
+        self.hashes: list[str | None] = [None] * 6
+        "6 个小图片的哈希值，转移到磁盘上之后依然保留在内存中"
+        self.count = 0
+        "已经添加的小图片数量，当它为 6 时，表示已经添加了 6 张小图片啦"
+        self.spilled = False
+        "小图片是否已经被转移到磁盘上了"
+
+    def add_split_page(self, index: int, image: bytes) -> int:
+        """添加一个被分割后的图片，返回新增占用的内存大小"""
+        if index < 0 or index > 5:
             logger.error(f"添加分割后小图片出错，其位置为: {index}（不在 [0, 5] 之间）")
-            return
+            return 0
+
+        old = self.split_pages[index]
+        if old is None:
+            self.count += 1
 
         self.split_pages[index] = image
-        self.added_pages.add(index)
+        self.hashes[index] = content_hash(image)
+        return len(image) - (len(old) if old else 0)
 
     def is_enough(self) -> bool:
         """判断是否已经有 6 张小图片啦"""
-        return len(self.split_pages) == 6
+        return self.count == 6
+
+    def page_key(self) -> str:
+        """由 6 个小图片的哈希值得到的、这一页内容的哈希值，内容相同的页不需要再拼接、编码"""
+        return content_hash("".join(self.hashes).encode())
+
+    def nbytes(self) -> int:
+        """小图片占用的内存大小"""
+        return sum(len(image) for image in self.split_pages if image)
+
+    def split_pages_list(self) -> list[bytes]:
+        """按照顺序返回 6 个小图片"""
+        return list(self.split_pages)
+
+    def spill(self, path: Path) -> int:
+        """把小图片转移到磁盘上的 path 目录，返回释放的内存大小"""
+        path.mkdir(parents=True, exist_ok=True)
+
+        freed = 0
+        for i, image in enumerate(self.split_pages):
+            if image is not None:
+                (path / f"{i}.tile").write_bytes(image)
+                freed += len(image)
+        self.split_pages = [None] * 6
+        self.spilled = True
+        return freed
+
+    def load(self, path: Path) -> int:
+        """从磁盘上的 path 目录读回小图片，返回新增占用的内存大小"""
+        loaded = 0
+        for tile in path.glob("*.tile"):
+            image = tile.read_bytes()
+            self.split_pages[int(tile.stem)] = image
+            loaded += len(image)
+            tile.unlink()
+        path.rmdir()
+        self.spilled = False
+        return loaded
 
     def save_full_page(self, filename: Path) -> None:
         """拼接 6 个小图片，并且保存为一张完整的图片"""
-        # 根据顺序，将所有图片拼接在一起
-        images = []  # 保存生成的 image 对象
-
-        for i in range(6):
-            # 根据 bytes 生成 image 对象
-            img = Image.open(BytesIO(self.split_pages[i]))
-            images.append(img)
-
-        # 计算横向合并时、最终图片的宽高
-        widths, heights = zip(*(image.size for image in images))
-        total_width = sum(widths)
-        max_height = max(heights)
-
-        # 生成大图片，将其它小图片的内容绘制上去
-        new_image = Image.new("RGB", (total_width, max_height))
-        x_offset = 0
-        for image in images:
-            new_image.paste(image, (x_offset, 0))
-            x_offset += image.size[0]
-
-        # 压缩一下图片大小
-        new_image.save(
+        imaging.save_full_page(
+            self.split_pages_list(),
             filename,
-            format=settings["picture_format"],
-            quality=settings["picture_quality"],
+            settings["picture_format"],
+            settings["picture_quality"],
         )
 
     pass
 
 
+class PendingPageMemory:
+    """
+    统计所有书籍中、还没凑齐 6 张小图片的页占用的内存。
+
+    超过上限之后，最久没有收到小图片的页会被转移到磁盘上，等它剩下的小图片到了再读回内存。
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        "内存上限（字节），为 0 表示不限制"
+        self.used = 0
+        "当前占用的内存（字节）"
+        self.pages: OrderedDict[tuple[int, int], WQBook] = OrderedDict()
+        "(书籍 id, 页码) => 书籍，按照最近一次收到小图片的时间排列，最久的在最前面"
+        self.spilled = 0
+        "转移到磁盘上的页数"
+        self.loaded = 0
+        "从磁盘读回内存的页数"
+
+    def touch(self, book: "WQBook", page_num: int, delta: int) -> None:
+        """书籍的第 page_num 页收到了小图片，占用的内存增加了 delta"""
+        key = (book.bid, page_num)
+        self.pages.pop(key, None)
+        self.pages[key] = book
+        self.used += delta
+
+    def release(self, book: "WQBook", page_num: int, nbytes: int) -> None:
+        """书籍的第 page_num 页已经不在内存中了"""
+        self.pages.pop((book.bid, page_num), None)
+        self.used -= nbytes
+
+    def spill_if_needed(self) -> None:
+        """超过内存上限时，把最久没有收到小图片的页转移到磁盘上"""
+        if not self.limit:
+            return
+
+        while self.used > self.limit and self.pages:
+            (_, page_num), book = self.pages.popitem(last=False)
+            self.used -= book.spill_page(page_num)
+            self.spilled += 1
+
+    def stats(self) -> dict:
+        return {
+            "used": self.used,
+            "limit": self.limit,
+            "pages": len(self.pages),
+            "spilled": self.spilled,
+            "loaded": self.loaded,
+        }
+
+    pass
+
+
+pending_memory = PendingPageMemory(settings["pending_page_memory_mb"] * 1024 * 1024)
+"所有书籍共用的内存统计"
+
+
+class LedgerWriter:
+    """
+    多个实例共用图片目录时，所有书籍的 ledger 写操作都在这一个线程中按顺序执行。
+
+    SQLite 的写事务要等其它实例释放写锁（最多 30 秒），不能在 mitmproxy 的事件循环中等待。
+    """
+
+    def __init__(self) -> None:
+        self._executor: "ThreadPoolExecutor | None" = None
+
+    def submit(self, func: Callable, *args) -> Future:
+        """在写线程中执行，需要结果时 await asyncio.wrap_future(future)"""
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="ledger")
+        return self._executor.submit(func, *args)
+
+    def write(self, func: Callable, *args) -> None:
+        """在写线程中执行，不等待结果，出错时记录日志"""
+        self.submit(func, *args).add_done_callback(self._log_error)
+
+    @staticmethod
+    def _log_error(future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"写入 ledger 失败: {future.exception()}")
+
+    async def drain(self) -> None:
+        """等待之前提交的写操作全部完成"""
+        if self._executor is not None:
+            await asyncio.wrap_future(self._executor.submit(lambda: None))
+
+    pass
+
+
+ledger_writer = LedgerWriter()
+"所有书籍共用的 ledger 写线程"
+
+
 class WQBook:
     """表示一本书籍"""
 
@@ -85,38 +234,157 @@ class WQBook:
 
         self.pages: dict[int, OnePage] = {}
         "记录书籍的每一页"
-        self.downloaded_page: set[int] = set()
+        self.downloaded_page = PageSet()
         "记录已经下载过的页"
+        self.saving_page: set[int] = set()
+        "记录已经凑齐小图片、正在后台保存的页"
 
-        self.images_path = self._init_images_path()
+        self.images_path = settings["image_path"] / f"{self.bid}"
         "保存该书籍所有图片的目录"
-
-    def _init_images_path(self) -> Path:
-        path = settings["image_path"] / f"{self.bid}"
+        self.manifest = BookManifest(self.images_path, settings["shared_store"])
+        "书籍的下载状态，重启之后直接读取它，不需要扫描目录"
+        self.ledger: "PageLedger | None" = None
+        "多个实例共用图片目录时，用于认领页、选出合并者，见 ledger.py"
+        self.incremental_pdf: IncrementalPdf | None = None
+        "边下载边写入的 PDF 文件，仅在 pdf_mode 为 incremental 时使用"
+
+        self.page_keys: dict[str, int] = {}
+        "页的内容的哈希值 => 第一个是这个内容的页码，用于发现内容完全相同的页"
+        self._saving_keys: dict[int, str] = {}
+        "正在保存的页 => 页的内容的哈希值"
+        self.tile_hashes: set[str] = set()
+        "本次运行收到的所有小图片的哈希值"
+        self.tiles_received = 0
+        "本次运行收到的小图片数量"
+        self.tiles_duplicate = 0
+        "本次运行收到的、和之前的小图片内容完全相同的小图片数量"
+        self.pages_saved = 0
+        "本次运行保存的页数"
+        self.pages_duplicate = 0
+        "本次运行保存的、和之前的页内容完全相同（直接链接到之前的图片）的页数"
+        self._has_book_info = False
+        "本次运行是否已经收到过书籍信息"
+        self.paused = False
+        "暂停下载，暂停期间收到的小图片都会被忽略"
+        self.closed = False
+        "已经调用过 close，还在流水线中的页保存完之后不再记录"
+
+        self._init_images_path()
+        if settings["shared_store"]:
+            self._init_ledger()
+
+    def _init_images_path(self) -> None:
+        path = self.images_path
         is_exist = path.exists()
         path.mkdir(parents=True, exist_ok=True)
 
         if not is_exist:
-            return path
-
-        # 查看该目录下面已经下载了多少图片
-        downloaded_imgs = utils.get_imgs_files(path, suffix=settings["picture_format"])
-        for img in downloaded_imgs:
-            page_num = int(img.stem)
-            # 表示这一页已经下载过了
-            self.downloaded_page.add(page_num)
+            return
 
-        if downloaded_imgs:
+        if self.manifest.exists():
+            self.manifest.load()
+        else:
+            self._migrate_legacy_images()
+
+        # 只有 manifest 中记录的页才算下载完成，写了一半的图片不会被记录
+        self.downloaded_page.update(self.manifest.pages)
+        for page_num, value in sorted(self.manifest.pages.items()):
+            if len(value) > 2:
+                self.page_keys.setdefault(value[2], page_num)
+        self.name = self.manifest.name
+        self.author = self.manifest.author
+        self.total_page = self.manifest.total_page
+        if self.manifest.bookmark:
+            self.bookmark = self.manifest.bookmark
+
+        if self.downloaded_page:
             logger.info(
-                f"书籍 <{self.bid}> 有 <{len(downloaded_imgs)}> 页已经下载到本地"
+                f"书籍 <{self.bid}> 有 <{len(self.downloaded_page)}> 页已经下载到本地"
+            )
+
+    def _migrate_legacy_images(self) -> None:
+        """
+        旧版本没有 manifest，只能扫描一次目录，把已经下载的图片记录下来。
+
+        下载到一半修改过 picture_format 的书中可能有多种格式的图片，同一页有多个格式时以当前的格式为准。
+        """
+        current = settings["picture_format"]
+        downloaded_imgs = {}
+        for suffix in (current, *IMAGE_SUFFIXES):
+            for img in utils.get_imgs_files(self.images_path, suffix=suffix):
+                downloaded_imgs.setdefault(int(img.stem), img)
+        for _, img in sorted(downloaded_imgs.items()):
+            # 空文件、被截断的图片肯定是没写完的，只检查文件头、文件尾，不解码
+            problem, _, _ = imaging.check_image(img)
+            if problem:
+                logger.info(f"图片 <{img}> 不完整，需要重新下载: {problem}")
+                continue
+            data = img.read_bytes()
+            self.manifest.add_page(
+                int(img.stem), checksum(data), len(data), suffix=img.suffix[1:]
+            )
+
+        bookmark_file = self.images_path / "bookmark.json"
+        if bookmark_file.exists():
+            self.manifest.set_bookmark(
+                json.loads(bookmark_file.read_text(encoding="utf-8"))
             )
 
-        return path
+        # 多个实例共用图片目录时，其它实例可能正在追加 journal，不能删除它
+        if not self.manifest.shared:
+            self.manifest.compact()
+
+    def _init_ledger(self) -> None:
+        from ledger import PageLedger
+
+        self.ledger = PageLedger(
+            self.images_path, settings["instance_id"], settings["claim_ttl"]
+        )
+        # 开启共享之前本实例就下载好的页，其它实例也不需要再处理
+        ledger_writer.write(self.ledger.import_pages, list(self.downloaded_page))
+        self.sync_shared_pages()
+
+    def sync_shared_pages(self) -> None:
+        """把其它实例保存好的页记录为已经下载，本实例还没凑齐小图片的这些页直接丢弃"""
+        if self.ledger is None:
+            return
+
+        for page_num in self.ledger.new_done_pages():
+            self.downloaded_page.add(page_num)
+            page = self.pages.pop(page_num, None)
+            if page is not None:
+                pending_memory.release(self, page_num, page.nbytes())
+                if page.spilled:
+                    shutil.rmtree(self._spill_path(page_num), ignore_errors=True)
+
+    async def claim_page(self, page_num: int) -> bool:
+        """
+        开始处理第 page_num 页之前先认领它，返回 False 表示其它实例已经保存好、或者正在处理这一页。
+
+        没有开启 shared_store、或者本实例最近认领过这一页时立即返回 True，否则在 ledger 的写线程中认领。
+        """
+        ledger = self.ledger
+        if ledger is None or ledger.holds(page_num):
+            return True
+        if await asyncio.wrap_future(ledger_writer.submit(ledger.claim, page_num)):
+            return True
+
+        self.sync_shared_pages()
+        return False
+
+    @property
+    def incremental(self) -> bool:
+        """是否边下载边写入 PDF，多个实例共用图片目录时每个实例只有一部分页，只能最后再合并"""
+        return settings["pdf_mode"] == "incremental" and not settings["shared_store"]
 
     def add_book_info(self, author: str, book_name: str, total_page: int) -> None:
         """添加书籍的名称、总页数信息"""
-        if self.name != "" and self.total_page != 0:
+        if self._has_book_info:
             return
+        self._has_book_info = True
+
+        if (author, book_name, total_page) != (self.author, self.name, self.total_page):
+            self.manifest.set_info(book_name, author, total_page)
 
         self.author = author
         self.name = book_name
@@ -134,12 +402,11 @@ class WQBook:
                 f"书籍 <{self.bid}> 的所有图片已经缓存到了本地，请将该 id 从待下载设置项中移除"
             )
         else:
-            losed_page = []
-            for i in range(1, self.total_page + 1):
-                if i not in self.downloaded_page:
-                    losed_page.append(i)
-
-            logger.info(f"书籍 <{self.bid}> 还需要下载以下页: {losed_page}")
+            plan = self.save_refetch_plan()
+            logger.info(
+                f"书籍 <{self.bid}> 还需要下载 <{plan['missing']}> 页: {plan['text']}，"
+                f"补下载的计划已保存到 {self.refetch_plan_path}"
+            )
 
     def add_bookmark(self, bookmark: dict) -> None:
         """添加书籍的书签信息"""
@@ -147,9 +414,11 @@ class WQBook:
             return
 
         self.bookmark = bookmark
-        # 保存到本地一份
-        with open(self.images_path / "bookmark.json", "w", encoding="utf-8") as f:
-            json.dump(bookmark, f)
+        self.manifest.set_bookmark(bookmark)
+        # 保存到本地一份，方便手动合并 PDF
+        atomic_write_bytes(
+            self.images_path / "bookmark.json", json.dumps(bookmark).encode("utf-8")
+        )
 
     def _get_one_page(self, page_num: int) -> OnePage:
         """获取书本的某一页"""
@@ -164,54 +433,356 @@ class WQBook:
     def add_split_page(self, page_num: int, index: int, image: bytes) -> bool:
         """
         给图书的第 page_num 页添加一个小图片，小图片的顺序为 index。
-        如果已经添加了 6 张小图片，则会自动合并、保存该图片啦啦。
 
-        如果返回值 True，表示这本书已经下载完毕。
+        如果返回值 True，表示这一页已经凑齐了 6 张小图片，可以通过 take_full_page 取走并保存啦。
         """
         page = self._get_one_page(page_num)
-        page.add_split_page(index, image)
+        if page.spilled:
+            self._load_page(page_num, page)
+
+        is_new = 0 <= index <= 5 and page.hashes[index] is None
+        pending_memory.touch(self, page_num, page.add_split_page(index, image))
+
+        if is_new:
+            self.tiles_received += 1
+            tile_hash = page.hashes[index]
+            if tile_hash in self.tile_hashes:
+                self.tiles_duplicate += 1
+                metrics.tiles_deduped.inc()
+            else:
+                self.tile_hashes.add(tile_hash)
 
-        # 已经添加了 6 张小图片，则需要保存该图片啦
         if page.is_enough():
-            # 图片路径如 `path/book_id/page_num.webp`
-            suffix = settings["picture_format"]
-            filename = self.images_path / f"{page_num}.{suffix}"
-            page.save_full_page(filename)
+            return True
 
-            # 然后标记该页已经下载过了
-            self.downloaded_page.add(page_num)
-            logger.info(
-                f"书籍 <{self.bid}> 的第 <{page_num}> 页已保存，整体进度 <{len(self.downloaded_page)}/{self.total_page}>"
+        pending_memory.spill_if_needed()
+        return False
+
+    def take_full_page(self, page_num: int) -> OnePage:
+        """取走已经凑齐 6 张小图片的一页，在保存完成之前，这一页都视为已经下载"""
+        self.saving_page.add(page_num)
+        page = self.pages.pop(page_num)
+        self._saving_keys[page_num] = page.page_key()
+        if page.spilled:
+            self._load_page(page_num, page)
+
+        pending_memory.release(self, page_num, page.nbytes())
+        return page
+
+    def find_duplicate(self, page_num: int) -> int | None:
+        """已经凑齐小图片的第 page_num 页，如果和之前保存的某一页内容完全相同，则返回那一页的页码"""
+        source = self.page_keys.get(self.pages[page_num].page_key())
+        if source is None or source == page_num or source not in self.downloaded_page:
+            return None
+        return source
+
+    def save_duplicate_page(self, page_num: int, source: int) -> SavedPage | None:
+        """
+        第 page_num 页和第 source 页内容完全相同，直接链接到 source 页的图片，不需要拼接、编码。
+
+        链接失败时返回 None，这时还是需要正常保存这一页。
+        """
+        # source 页可能是修改 picture_format 之前保存的，链接过去的这一页和它的格式一样
+        source_path = self.manifest.page_file(source, settings["picture_format"])
+        try:
+            link_or_copy(
+                source_path, self.images_path / f"{page_num}{source_path.suffix}"
             )
+        except OSError as e:
+            logger.error(f"书籍 <{self.bid}> 的第 <{page_num}> 页链接失败: {e}")
+            return None
+
+        page_checksum, size = self.manifest.pages[source][:2]
+        return SavedPage(
+            page_checksum,
+            size,
+            None,
+            duplicate_of=source,
+            suffix=source_path.suffix[1:],
+        )
+
+    def dedup_report(self) -> str:
+        """本次运行的去重情况"""
+        page_ratio = self.pages_duplicate / self.pages_saved if self.pages_saved else 0
+        tile_ratio = (
+            self.tiles_duplicate / self.tiles_received if self.tiles_received else 0
+        )
+        report = (
+            f"重复页 <{self.pages_duplicate}/{self.pages_saved}> ({page_ratio:.1%})，"
+            f"重复小图片 <{self.tiles_duplicate}/{self.tiles_received}> ({tile_ratio:.1%})"
+        )
+        if self.incremental_pdf is not None:
+            report += f"，PDF 中共用图片的页 <{self.incremental_pdf.shared}>"
+        return report
+
+    def _spill_root(self) -> Path:
+        if self.ledger is not None:
+            return (
+                self.images_path
+                / ".spill"
+                / utils.be_good_name(settings["instance_id"], "_")
+            )
+        return self.images_path / ".spill"
+
+    def _spill_path(self, page_num: int) -> Path:
+        return self._spill_root() / f"{page_num}"
+
+    def spill_page(self, page_num: int) -> int:
+        """把第 page_num 页的小图片转移到磁盘上，返回释放的内存大小"""
+        logger.debug(
+            "内存占用过多，书籍 <%s> 的第 <%s> 页转移到磁盘上", self.bid, page_num
+        )
+        return self.pages[page_num].spill(self._spill_path(page_num))
+
+    def _load_page(self, page_num: int, page: OnePage) -> None:
+        """把转移到磁盘上的第 page_num 页读回内存"""
+        loaded = page.load(self._spill_path(page_num))
+        pending_memory.touch(self, page_num, loaded)
+        pending_memory.loaded += 1
+
+    def page_path(self, page_num: int) -> Path:
+        """
+        新保存的图片路径如 `path/book_id/page_num.webp`。
 
-            # 然后判断书本是否下载完成，下载完成之后需要合并 PDF 哟
-            if self.total_page != 0 and len(self.downloaded_page) == self.total_page:
-                self._save_as_pdf()
-                return True
+        已经下载的页可能是其它格式，请使用 manifest.page_file。
+        """
+        suffix = settings["picture_format"]
+        return self.images_path / f"{page_num}.{suffix}"
+
+    def finish_page(self, page_num: int, saved: SavedPage | None) -> bool:
+        """
+        第 page_num 页保存结束，saved 为 None 表示保存失败。
+        saved 中如果有用于嵌入 PDF 的数据，边下载边生成 PDF 时会立即追加到 PDF 文件中。
+
+        如果返回值 True，表示这本书已经下载完毕，并且已经开始合并 PDF 啦。
+        这本书已经关闭时直接忽略，不会重新打开 journal、ledger、PDF 文件。
+        """
+        self.saving_page.discard(page_num)
+        page_key = self._saving_keys.pop(page_num, "")
+        if self.closed:
+            return False
+        if saved is None:
+            if self.ledger is not None:
+                ledger_writer.write(self.ledger.release, page_num)
+            return False
+
+        # 然后标记该页已经下载过了，图片已经完整地写入磁盘，可以记录到 manifest 中了
+        self.downloaded_page.add(page_num)
+        self.manifest.add_page(
+            page_num, saved.checksum, saved.size, page_key, saved.suffix
+        )
+        if self.ledger is not None:
+            # 先写入 manifest 再标记为 done，合并者读取 manifest 时一定有这一页
+            ledger_writer.write(self.ledger.complete, page_num)
+            self.sync_shared_pages()
+        if page_key:
+            self.page_keys.setdefault(page_key, page_num)
+
+        self.pages_saved += 1
+        if saved.duplicate_of:
+            self.pages_duplicate += 1
+
+        if self.incremental:
+            if saved.pdf_image is not None:
+                self._get_incremental_pdf().add_page(page_num, saved.pdf_image)
+            elif saved.duplicate_of:
+                # 引用之前那一页的图片，不在 PDF 中的话，合并时会从图片文件补上
+                self._get_incremental_pdf().add_shared_page(
+                    page_num, saved.duplicate_of
+                )
+
+        logger.info(
+            f"书籍 <{self.bid}> 的第 <{page_num}> 页已保存，整体进度 <{len(self.downloaded_page)}/{self.total_page}>"
+        )
+
+        # 然后判断书本是否下载完成，下载完成之后需要合并 PDF 哟
+        if self.is_complete():
+            logger.info(f"书籍 <{self.bid}> 去重统计: {self.dedup_report()}")
+            # 下载完的书会从下载列表中移除，这里就把 journal 写到磁盘上
+            self.manifest.close()
+            self.refetch_plan_path.unlink(missing_ok=True)
+            self._save_as_pdf()
+            return True
 
         return False
 
     def is_page_downloaded(self, page_num: int) -> bool:
-        """判断某一页是否已经下载过"""
-        return page_num in self.downloaded_page
+        """判断某一页是否已经下载过，正在保存的页也算"""
+        return page_num in self.downloaded_page or page_num in self.saving_page
+
+    def missing_ranges(self) -> list[tuple[int, int]]:
+        """还没有下载的页组成的区间，正在保存的页、其它实例正在处理的页不算"""
+        self.sync_shared_pages()
+        busy = self.saving_page
+        if self.ledger is not None:
+            # 其它实例正在处理的页也不需要本实例去翻
+            busy = busy | self.ledger.claimed_by_others()
+
+        ranges = []
+        for start, end in self.downloaded_page.missing_ranges(self.total_page):
+            # 正在保存的页很少，把它们从区间中挖掉
+            for page_num in sorted(p for p in busy if start <= p <= end):
+                if start < page_num:
+                    ranges.append((start, page_num - 1))
+                start = page_num + 1
+            if start <= end:
+                ranges.append((start, end))
+        return ranges
+
+    def missing_pages(self):
+        """按照页码顺序返回还没有下载的页"""
+        for start, end in self.missing_ranges():
+            yield from range(start, end + 1)
+
+    def refetch_plan(self) -> dict:
+        """
+        补下载的计划：还缺少哪些页（压缩成区间），翻页脚本、主动下载可以直接跳到这些页。
 
-    def _save_as_pdf(self):
-        """合并 PDF 文件"""
+        partial 是已经收到一部分小图片的页，它们也在 ranges 中。
+        """
+        ranges = self.missing_ranges()
+        return {
+            "bid": self.bid,
+            "name": self.name,
+            "total_page": self.total_page,
+            "downloaded": len(self.downloaded_page),
+            "missing": sum(end - start + 1 for start, end in ranges),
+            "ranges": ranges,
+            "text": format_ranges(ranges),
+            "partial": sorted(self.pages),
+            "bitmap": pages_to_bitmap(self.downloaded_page),
+        }
+
+    @property
+    def refetch_plan_path(self) -> Path:
+        return self.images_path / "refetch.json"
+
+    def save_refetch_plan(self) -> dict:
+        """把补下载的计划保存到书籍的图片目录中，书籍信息还没有收到、已经下载完时不保存"""
+        plan = self.refetch_plan()
+        if self.total_page and plan["missing"]:
+            atomic_write_bytes(
+                self.refetch_plan_path,
+                json.dumps(plan, ensure_ascii=False).encode("utf-8"),
+            )
+        return plan
+
+    def is_complete(self) -> bool:
+        return self.total_page != 0 and len(self.downloaded_page) == self.total_page
+
+    def resume_pdf(self) -> bool:
+        """
+        上次运行时已经下载完所有页，但是 PDF 还没有生成（比如合并时进程退出了），则现在生成。
+
+        如果返回值 True，表示这本书已经下载完毕。
+        """
+        self.sync_shared_pages()
+        if not self.is_complete():
+            return False
+
+        if not self._output_pdf_path().exists():
+            logger.info(
+                f"书籍 <{self.bid}> 已经下载完成，但是还没有生成 PDF，正在生成 . . ."
+            )
+            self._save_as_pdf()
+        return True
+
+    def merge_now(self) -> None:
+        """
+        手动合并 PDF，还没下载完的书只会合并已经下载的页。
+
+        没下载完时不使用边下载边写入的 PDF 文件，因为之后的页还要继续写入它。
+        """
+        if self.is_complete():
+            self._save_as_pdf()
+            return
+
+        output_pdf = self._output_pdf_path()
+        merge_scheduler.submit(
+            self.bid,
+            self.images_path,
+            output_pdf,
+            output_pdf.with_name(output_pdf.name + ".partial"),
+            self.total_page,
+        )
+
+    def close(self) -> None:
+        """
+        不再下载这本书（比如从下载列表中移除了），释放还没凑齐小图片的页。
+
+        还在流水线中的页保存完之后不会再记录到 manifest 中，下次下载这本书时重新下载。
+        """
+        self.closed = True
+        for page_num, page in self.pages.items():
+            pending_memory.release(self, page_num, page.nbytes())
+        self.pages.clear()
+        shutil.rmtree(self._spill_root(), ignore_errors=True)
+        self.save_refetch_plan()
+
+        self.manifest.close()
+        if self.ledger is not None:
+            # 其它实例可以立即认领本实例没有处理完的页，之前提交的写操作会先执行完
+            ledger_writer.write(_close_ledger, self.ledger)
+            self.ledger = None
+        if self.incremental_pdf is not None:
+            self.incremental_pdf.close()
+            self.incremental_pdf = None
+
+    def _get_incremental_pdf(self) -> IncrementalPdf:
+        """打开正在写入的 PDF 文件，之前没写完的话会接着写"""
+        if self.incremental_pdf is None:
+            self.incremental_pdf = IncrementalPdf(self.images_path / "book.partial.pdf")
+        return self.incremental_pdf
+
+    def _output_pdf_path(self) -> Path:
         good_name = utils.be_good_name(self.name)
         good_author = utils.be_good_name(self.author)
 
-        output_pdf = (
-            settings["save_path"] / f"{self.bid}_{good_name}({good_author}).pdf"
-        )
+        return settings["save_path"] / f"{self.bid}_{good_name}({good_author}).pdf"
+
+    def _save_as_pdf(self):
+        """提交合并 PDF 的任务，由 merge_scheduler 在合并进程中执行"""
+        if self.ledger is not None:
+            # 多个实例共用图片目录时，在 ledger 的写线程中选出合并者，排在这本书之前的写操作之后
+            ledger_writer.write(self._merge_if_elected, self.ledger)
+            return
+
+        self._submit_merge()
+
+    def _merge_if_elected(self, ledger: "PageLedger") -> None:
+        """在 ledger 的写线程中执行，只有被选为合并者的实例合并 PDF"""
+        merger = ledger.elect_merger(self.total_page)
+        if merger == settings["instance_id"]:
+            self._submit_merge()
+        elif merger:
+            logger.info(
+                f"书籍 <{self.bid}> 的所有页都已经下载完成，由实例 <{merger}> 合并 PDF"
+            )
+
+    def _submit_merge(self) -> None:
+        output_pdf = self._output_pdf_path()
 
-        threading.Thread(
-            target=utils.merge_image_as_pdf,
-            args=(self.images_path, output_pdf, self.bookmark),
-        ).start()
+        if self.incremental:
+            # 合并进程会接着写这个文件，补上缺少的页（比如切换模式之前就下载好的页），然后写入页面树、书签
+            if self.incremental_pdf is not None:
+                self.incremental_pdf.close()
+                self.incremental_pdf = None
+            partial = self.images_path / "book.partial.pdf"
+        else:
+            partial = output_pdf.with_name(output_pdf.name + ".partial")
+
+        merge_scheduler.submit(
+            self.bid, self.images_path, output_pdf, partial, self.total_page
+        )
 
     pass
 
 
+def _close_ledger(ledger: "PageLedger") -> None:
+    ledger.release_all()
+    ledger.close()
+
+
 class SplitPageOrder:
     """
     根据 req_before_split_page 请求，确认它对应的小图片请求，
@@ -221,40 +792,105 @@ class SplitPageOrder:
         小图片里面的 zn 称之为 encode_zn，它们是被加密过的，如 "ha1TgXQ9J1c"
         req_before_split_page 请求中的 zn 依然保持名为 zn，如 1
 
-        此处就是就记录 { zn: encoe_zn } 的映射关系。
+        此处就是记录 { encode_zn: (bid, page_num, zn) } 的映射关系，查找小图片顺序只需要查一次表。
+
+    小图片可能永远不会到来（比如翻页太快、请求被取消），所以映射关系有存活时间、数量上限，
+    超过之后最早添加的映射关系会被清理掉。
+
+    小图片也可能比它的 req_before_split_page 请求先到（HTTP/2 多路复用时很常见），
+    这时先把小图片暂存起来，等映射关系添加之后再确认它的顺序，同样有存活时间、数量上限。
     """
 
-    def __init__(self) -> None:
-        self.zn_table: dict[int, dict[int, dict[int, str]]] = {}
+    def __init__(self, ttl: float | None = None, max_size: int | None = None) -> None:
+        self.zn_table: OrderedDict[str, tuple[int, int, int, float]] = OrderedDict()
         """
-        其构成类似
-        // 表示某本书
-        bid: {
-            // 表示书本的某一页
-            page_num: {
-                // 一个映射关系
-                1: "ha1TgXQ9J1c"
-            }
-        }
+        encode_zn => (书籍 id, 页码, 第几个小图片, 添加的时间)，按照添加的先后顺序排列，如
+            "ha1TgXQ9J1c": (3238891, 3, 1, 1718888888.8)
+        """
+        self.ttl = settings["zn_table_ttl"] if ttl is None else ttl
+        "映射关系的存活时间（秒）"
+        self.max_size = settings["zn_table_max_size"] if max_size is None else max_size
+        "最多保存多少个映射关系"
+
+        self.expired = 0
+        "因为超过存活时间而被清理的映射关系数量"
+        self.evicted = 0
+        "因为超过数量上限而被清理的映射关系数量"
+
+        self.pending_tiles: OrderedDict[tuple[int, int, str], tuple[bytes, float]] = (
+            OrderedDict()
+        )
+        "(书籍 id, 页码, encode_zn) => (小图片, 暂存的时间)，还没有映射关系的小图片"
+        self.pending_ttl = settings["pending_tile_ttl"]
+        "暂存小图片的存活时间（秒）"
+        self.pending_max_size = settings["pending_tile_max_size"]
+        "最多暂存多少个小图片"
+
+        self.pending_miss = 0
+        "查不到映射关系、被暂存的小图片数量"
+        self.pending_hit = 0
+        "暂存之后又等到了映射关系的小图片数量"
+        self.pending_expired = 0
+        "暂存之后一直没等到映射关系、被清理掉的小图片数量（包括超过数量上限的）"
+
+    def add(self, k: str, body: str) -> tuple[int, int, int, bytes] | None:
+        """
+        传入 `req_before_split_page` 的参数 k、响应体 data，生成一个映射关系。
+
+        如果对应的小图片已经先到了，则返回 (书籍 id, 页码, 小图片的顺序, 小图片)，否则返回 None。
         """
+        decoded = self.decode(k, body)
+        if decoded is None:
+            return None
+
+        bid, page_num, zn, encode_zn = decoded
+
+        # 添加到映射表
+        logger.debug(
+            "添加映射关系: 书籍 <%s> 的第 <%s> 页的第 <%s> 个小图片对应的 zn 值为 <%s>",
+            bid,
+            page_num,
+            zn,
+            encode_zn,
+        )
+        self._add(bid, page_num, zn, encode_zn)
 
-    def add(self, k: str, body: str) -> None:
-        """传入 `req_before_split_page` 的参数 k、响应体 data，生成一个映射关系"""
+        # 小图片先到了，现在可以确认它的顺序啦
+        pending = self.pending_tiles.pop((bid, page_num, encode_zn), None)
+        if pending is None:
+            return None
+
+        self.zn_table.pop(encode_zn)
+        self.pending_hit += 1
+        metrics.pending_tiles.labels("hit").inc()
+        logger.debug(
+            "暂存的小图片 - 书籍 <%s>，页码 <%s>，顺序 <%s> 已经确认顺序",
+            bid,
+            page_num,
+            zn,
+        )
+        return bid, page_num, zn, pending[0]
+
+    def decode(self, k: str, body: str) -> tuple[int, int, int, str] | None:
+        """
+        解密 `req_before_split_page` 的参数 k、响应体 data，
+        返回 (书籍 id, 页码, 第几个小图片, encode_zn)，解密失败时返回 None。
+        """
 
         # 出现了 body 为空字符串的情况。我也不知道为什么，很难复现，所以暂时忽略
         if not body:
-            return
+            return None
 
         data = utils.jwt_decrypt(k)
 
         # 解密失败，直接返回
         if not data:
             logger.debug(
-                f"req_before_split_page 请求参数 k 值进行 jwt 解密失败，k 值为 => {k}"
+                "req_before_split_page 请求参数 k 值进行 jwt 解密失败，k 值为 => %s", k
             )
-            return
+            return None
 
-        logger.debug(f"req_before_split_page 请求的参数 k 进行 jwt 解密结果 => {data}")
+        logger.debug("req_before_split_page 请求的参数 k 进行 jwt 解密结果 => %s", data)
 
         bid = data["b"]  # 书籍的 id
         page_num = data["p"]  # 书籍的第几页
@@ -263,80 +899,132 @@ class SplitPageOrder:
         # 计算出对应的小图片中的 zn
         key = json.loads(data["k"])["i"][:16]
 
-        logger.debug(f"req_before_split_page 请求的响应数据 => {body}")
-        logger.debug(f"用于 AES 加密的 key => {key}")
+        logger.debug("req_before_split_page 请求的响应数据 => %s", body)
+        logger.debug("用于 AES 加密的 key => %s", key)
 
         decrypt_data = utils.aes_decrypt(body, key)
         if not decrypt_data:
-            return
+            return None
 
-        logger.debug(f"对 req_before_split_page 请求的 AES 解密结果 => {decrypt_data}")
+        logger.debug("对 req_before_split_page 请求的 AES 解密结果 => %s", decrypt_data)
 
-        encode_zn = json.loads(decrypt_data)["zn"]
-
-        # 添加到映射表
-        logger.debug(
-            f"添加映射关系: 书籍 <{bid}> 的第 <{page_num}> 页的第 <{zn}> 个小图片对应的 zn 值为 <{encode_zn}>"
-        )
-        self._add(bid, page_num, zn, encode_zn)
+        return bid, page_num, zn, json.loads(decrypt_data)["zn"]
 
     def _add(self, bid: int, page_num: int, zn: int, encode_zn: str) -> None:
         """给书籍 bid 的第 page_num 页建立映射关系"""
-        if bid not in self.zn_table:
-            self.zn_table[bid] = {}
+        now = time.monotonic()
+
+        # 重复的请求，刷新一下添加时间
+        self.zn_table.pop(encode_zn, None)
+        self.zn_table[encode_zn] = (bid, page_num, zn, now)
+
+        self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        """清理超过存活时间、超过数量上限的映射关系，最早添加的在最前面"""
+        while self.zn_table:
+            _, (_, _, _, added_time) = next(iter(self.zn_table.items()))
+            if now - added_time <= self.ttl:
+                break
+            self.zn_table.popitem(last=False)
+            self.expired += 1
+            metrics.zn_expired.inc()
+
+        while len(self.zn_table) > self.max_size:
+            self.zn_table.popitem(last=False)
+            self.evicted += 1
+            metrics.zn_evicted.inc()
+
+        while self.pending_tiles:
+            _, (_, parked_time) = next(iter(self.pending_tiles.items()))
+            if now - parked_time <= self.pending_ttl:
+                break
+            self._drop_tile("expired")
+
+        while len(self.pending_tiles) > self.pending_max_size:
+            self._drop_tile("overflow")
+
+    def _drop_tile(self, reason: str) -> None:
+        """丢弃最早暂存的小图片，翻页脚本之后需要重新翻到这一页"""
+        (bid, page_num, _), _ = self.pending_tiles.popitem(last=False)
+        self.pending_expired += 1
+        metrics.pending_tiles.labels("expired").inc()
+        metrics.tiles_dropped.inc()
+        event_bus.publish(
+            "tile-dropped", {"bid": bid, "page": page_num, "reason": reason}
+        )
 
-        if page_num not in self.zn_table[bid]:
-            self.zn_table[bid][page_num] = {}
+    def _park(self, bid: int, page_num: int, encode_zn: str, image: bytes) -> None:
+        """暂存还没有映射关系的小图片"""
+        now = time.monotonic()
+        self.pending_tiles[(bid, page_num, encode_zn)] = (image, now)
+        self.pending_miss += 1
+        metrics.pending_tiles.labels("miss").inc()
+        self._evict(now)
 
-        self.zn_table[bid][page_num][zn] = encode_zn
+    def get(self, k: str, image: bytes | None = None) -> int:
+        """
+        传入小图片请求参数中的 k，获取它的顺序。如果返回 -1 表示失败。
 
-    def get(self, k: str) -> int:
-        """传入小图片请求参数中的 k，获取它的顺序。如果返回 -1 表示失败"""
+        如果传入了小图片 image，查不到映射关系时会暂存它，等映射关系添加之后由 add 返回。
+        """
+        with metrics.tile_order.time():
+            return self._get(k, image)
 
+    def _get(self, k: str, image: bytes | None) -> int:
         data = utils.jwt_decrypt(k)
         order = -1  # 记录最终查找到的小图片的顺序
 
         if not data:
-            logger.debug(f"小图片请求参数 k 值进行 jwt 解密失败，k 值为 => {k}")
+            logger.debug("小图片请求参数 k 值进行 jwt 解密失败，k 值为 => %s", k)
             return order
 
-        logger.debug(f"解析小图片请求的参数 k => {data}")
+        logger.debug("解析小图片请求的参数 k => %s", data)
 
         bid = data["b"]  # 书籍的 id
         page_num = data["p"]  # 书籍的第几页
         page_zn = json.loads(data["k"])["zn"]  # 这个就要看网站分析的文档啦
 
-        if bid not in self.zn_table:
-            logger.debug(f"书籍 <{bid}> 不在映射表中")
-            return order
-
-        book_zn_table = self.zn_table[bid]  # 记录一本书的 zn 关系表
-
-        if page_num not in book_zn_table:
-            logger.debug(f"书籍 <{bid}> 的第 <{page_num}> 页不在映射表中")
+        # 先只查表，书籍、页码对上了再删除，对不上时映射关系留在原来的位置，按照添加的时间过期
+        item = self.zn_table.get(page_zn)
+        if item is None:
+            logger.debug(
+                "书籍 <%s> 的第 <%s> 页的第 <%s> 小图片不在映射表中",
+                bid,
+                page_num,
+                page_zn,
+            )
+            if image is not None:
+                self._park(bid, page_num, page_zn, image)
             return order
 
-        page_zn_table = book_zn_table[page_num]  # 记录该本书、某一页的 zn 关系表
-
-        logger.debug(
-            f"书籍 <{bid}> 的第 <{page_num}> 页的 zn 关系表 => {page_zn_table}"
-        )
-        for zn, encode_zn in page_zn_table.items():
-            if encode_zn == page_zn:
-                order = zn
-                break
-
-        if order == -1:
+        if item[:2] != (bid, page_num):
+            # encode_zn 对上了，书籍、页码却对不上，那就不用它
             logger.debug(
-                f"书籍 <{bid}> 的第 <{page_num}> 页的第 <{page_zn}> 小图片不在映射表中"
+                "小图片 <%s> 属于书籍 <%s> 的第 <%s> 页，而不是书籍 <%s> 的第 <%s> 页",
+                page_zn,
+                item[0],
+                item[1],
+                bid,
+                page_num,
             )
-        else:
-            # 现在已经拿到了小图片顺序，需要清理一下空间呀
-            page_zn_table.pop(order)
-            # 如果该页的小图片已经全部确定好了顺序，那么就清理掉该页的映射关系
-            if len(page_zn_table) == 0:
-                book_zn_table.pop(page_num)
+            return order
 
+        # 现在已经拿到了小图片顺序，顺便清理一下空间呀
+        del self.zn_table[page_zn]
+        order = item[2]
         return order
 
+    def stats(self) -> dict:
+        """映射表、暂存小图片当前的大小，以及命中、被清理的数量"""
+        return {
+            "size": len(self.zn_table),
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "pending_tiles": len(self.pending_tiles),
+            "pending_miss": self.pending_miss,
+            "pending_hit": self.pending_hit,
+            "pending_expired": self.pending_expired,
+        }
+
     pass
@@ -0,0 +1,118 @@
+"""
+用模拟的网站（wqbook_emulator.py 的本地 HTTP 服务器）测试主动下载模式，比较不同并发数下的下载速度。
+
+先用模拟的一次翻页请求让代理抓到会话，然后由 PageFetcher 自己请求剩下的所有页，
+响应走的是和浏览器翻页完全相同的处理流程。
+
+用法: python test/bench_fetch.py [--pages 60] [--concurrency 1,4,16] [--rate 0]
+"""
+
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+import urllib.parse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "proxy_server"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from settings import settings
+from wqbook_emulator import HOST, EmulatedBook, WQBookEmulator
+
+BID = 9000002
+
+
+class CapturedRequest:
+    """模拟 mitmproxy 的请求，只有 PageFetcher 用到的属性"""
+
+    def __init__(self, url: str) -> None:
+        parts = urllib.parse.urlsplit(url)
+        self.url = url
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.headers = {"User-Agent": "bench", "Cookie": "PHPSESSID=bench"}
+
+
+async def fetch_once(emulator: WQBookEmulator, port: int, concurrency: int) -> dict:
+    settings["fetch_concurrency"] = concurrency
+
+    import wqbook
+    from process_url import WQBookAddon
+
+    # 这里只比较下载速度，不合并 PDF
+    wqbook.WQBook._save_as_pdf = lambda self: None
+
+    addon = WQBookAddon()
+    book = addon.load_book(BID)
+    base = f"http://127.0.0.1:{port}"
+
+    # 书籍信息，以及浏览器翻开第一页时的请求，代理从这些请求中抓到会话
+    flows = emulator.book_flows(BID)
+    for url, body in next(flows):
+        await addon.dispatch(url.replace(HOST, base), body)
+    for url, body in next(flows):
+        url = url.replace(HOST, base)
+        route = "split_page" if "/lmg/" in url else "req_before_split_page"
+        addon.fetcher.session.capture(route, CapturedRequest(url))
+        await addon.dispatch(url, body)
+
+    start = time.perf_counter()
+    addon.fetcher.start(book)
+    await addon.fetcher.tasks[BID]
+    await addon.page_pipeline.drain()
+    elapsed = time.perf_counter() - start
+
+    saved = len(book.downloaded_page)
+    await addon.done()
+    return {
+        "concurrency": concurrency,
+        "saved": saved,
+        "seconds": elapsed,
+        "pages_per_second": (saved - 1) / elapsed,
+        "requests": addon.fetcher.pool.requests,
+        "errors": addon.fetcher.pool.errors,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="主动下载模式的压测")
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--rate", type=float, default=0, help="每秒最多请求数")
+    args = parser.parse_args()
+
+    emulator = WQBookEmulator([EmulatedBook(BID, args.pages)], secret="secret")
+    server = emulator.serve()
+
+    settings["api_hosts"] = ["127.0.0.1"]
+    settings["book_id"] = [BID]
+    settings["fetch_jwt_secret"] = "secret"
+    settings["fetch_rate_limit"] = args.rate
+    settings["logger_level"] = "ERROR"
+
+    from mylogger import logger
+
+    logger.logger.setLevel("ERROR")
+
+    print(
+        f"{'并发':>6}{'已保存':>8}{'用时(s)':>10}{'页/秒':>10}{'请求数':>8}{'失败':>6}"
+    )
+    for concurrency in (int(c) for c in args.concurrency.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            settings["image_path"] = Path(tmp) / "images"
+            settings["save_path"] = Path(tmp) / "download"
+            settings["save_path"].mkdir()
+            r = asyncio.run(fetch_once(emulator, server.server_port, concurrency))
+        print(
+            f"{r['concurrency']:>6}{r['saved']:>8}{r['seconds']:>10.2f}"
+            f"{r['pages_per_second']:>10.1f}{r['requests']:>8}{r['errors']:>6}"
+        )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+测试每个小图片的日志开销，对比原来的写法和现在的写法：
+
+    原来    f-string 在调用前就格式化好，处理器在调用的线程中同步写入文件
+    现在    % 格式，级别没有开启时不格式化；日志放进队列，由后台线程写入文件；
+            重复的错误日志（比如解密失败）每隔一段时间最多输出一条
+
+处理一个小图片时 SplitPageOrder.add、get 大约会输出 8 条 debug 日志，其中包括解密后的参数、响应体。
+这里分别在 INFO 级别（debug 日志不输出）、DEBUG 级别下测试，时间只统计调用日志的线程，也就是事件循环。
+
+用法: python test/bench_logging.py [--tiles 20000]
+"""
+
+import argparse
+import json
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "proxy_server"))
+
+from mylogger import MyLogger
+
+# 模拟一个小图片的数据
+BID, PAGE_NUM, ZN = 3238891, 42, 3
+DATA = {
+    "b": BID,
+    "p": PAGE_NUM,
+    "zn": ZN,
+    "k": json.dumps({"i": "0123456789abcdef0123"}),
+}
+BODY = "x" * 200
+KEY = "0123456789abcdef"
+ENCODE_ZN = "e3238891_42_3_0.123456789"
+
+
+def eager_tile(logger: logging.Logger) -> None:
+    """原来的写法：SplitPageOrder.add、get 中的 debug 日志"""
+    logger.debug(f"req_before_split_page 请求的参数 k 进行 jwt 解密结果 => {DATA}")
+    logger.debug(f"req_before_split_page 请求的响应数据 => {BODY}")
+    logger.debug(f"用于 AES 加密的 key => {KEY}")
+    logger.debug(f"对 req_before_split_page 请求的 AES 解密结果 => {ENCODE_ZN}")
+    logger.debug(
+        f"添加映射关系: 书籍 <{BID}> 的第 <{PAGE_NUM}> 页的第 <{ZN}> 个小图片对应的 zn 值为 <{ENCODE_ZN}>"
+    )
+    logger.debug(f"解析小图片请求的参数 k => {DATA}")
+    logger.debug(f"处理小图片 - 书籍 <{BID}>，页码 <{PAGE_NUM}>，顺序 <{ZN}>")
+    logger.debug(f"编码队列状态 => {dict(pending=1, waiting=0, completed=100)}")
+
+
+def lazy_tile(logger: MyLogger) -> None:
+    """现在的写法"""
+    logger.debug("req_before_split_page 请求的参数 k 进行 jwt 解密结果 => %s", DATA)
+    logger.debug("req_before_split_page 请求的响应数据 => %s", BODY)
+    logger.debug("用于 AES 加密的 key => %s", KEY)
+    logger.debug("对 req_before_split_page 请求的 AES 解密结果 => %s", ENCODE_ZN)
+    logger.debug(
+        "添加映射关系: 书籍 <%s> 的第 <%s> 页的第 <%s> 个小图片对应的 zn 值为 <%s>",
+        BID,
+        PAGE_NUM,
+        ZN,
+        ENCODE_ZN,
+    )
+    logger.debug("解析小图片请求的参数 k => %s", DATA)
+    logger.debug("处理小图片 - 书籍 <%s>，页码 <%s>，顺序 <%s>", BID, PAGE_NUM, ZN)
+    logger.debug(lambda: f"编码队列状态 => {dict(pending=1, waiting=0, completed=100)}")
+
+
+def eager_error(logger: logging.Logger) -> None:
+    """原来的写法：每个小图片都解密失败"""
+    logger.error(f"jwt_decrypt 错误: Invalid token。\n解密数据为: {DATA}。")
+
+
+def lazy_error(logger: MyLogger) -> None:
+    logger.limited(
+        "error",
+        "jwt_decrypt",
+        lambda: f"jwt_decrypt 错误: Invalid token。\n解密数据为: {DATA}。",
+    )
+
+
+def sync_logger(level: str, log_file: Path) -> logging.Logger:
+    """原来的 MyLogger：处理器直接挂在记录器上"""
+    logger = logging.getLogger(f"bench.sync.{level}")
+    logger.setLevel(level)
+    handler = logging.FileHandler(log_file, encoding="utf-8")
+    handler.setFormatter(
+        logging.Formatter(
+            "[%(asctime)s] - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+        )
+    )
+    logger.addHandler(handler)
+    return logger
+
+
+def measure(func, logger, tiles: int) -> float:
+    """每个小图片的耗时（微秒）"""
+    start = time.perf_counter()
+    for _ in range(tiles):
+        func(logger)
+    return (time.perf_counter() - start) / tiles * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="小图片日志开销的测试")
+    parser.add_argument("--tiles", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'场景':<28}{'原来(us/小图片)':>16}{'现在(us/小图片)':>16}{'倍数':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = [
+            ("INFO 级别，debug 日志", "INFO", eager_tile, lazy_tile),
+            ("DEBUG 级别，debug 日志", "DEBUG", eager_tile, lazy_tile),
+            ("每个小图片都解密失败", "INFO", eager_error, lazy_error),
+        ]
+        for i, (name, level, eager, lazy) in enumerate(cases):
+            before = sync_logger(level, Path(tmp) / f"sync_{i}.log")
+            after = MyLogger(
+                level, Path(tmp) / f"queue_{i}.log", 10, name=f"bench.queue.{i}"
+            )
+
+            before_us = measure(eager, before, args.tiles)
+            after_us = measure(lazy, after, args.tiles)
+
+            # 写完队列中剩下的日志，确认后台线程没有丢日志
+            after.stop()
+            print(
+                f"{name:<28}{before_us:>16.2f}{after_us:>16.2f}{before_us / after_us:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+测试合并 PDF 的耗时随转换进程数的变化。
+
+先用模拟的书籍（wqbook_emulator.py）生成若干页图片，然后分别用不同的进程数合并成 PDF，
+输出耗时、加速比，以及合并进程的峰值内存。每种进程数都在单独的子进程中运行，峰值内存互不影响。
+
+用法: python test/bench_merge.py [--pages 400] [--workers 1,2,4,8] [--format webp] [--adaptive]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "proxy_server"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import imaging
+import pdf_merge
+from bench_scaling import peak_rss_mb
+from wqbook_emulator import EmulatedBook
+
+
+def make_pages(path: Path, pages: int, picture_format: str) -> None:
+    book = EmulatedBook(1, pages)
+    for page_num in range(1, pages + 1):
+        imaging.save_full_page(
+            book.tiles(page_num),
+            path / f"{page_num}.{picture_format}",
+            picture_format,
+            50,
+        )
+
+
+def run_single(path: Path, picture_format: str, workers: int, adaptive: bool) -> None:
+    """用 workers 个进程合并一次，结果以 JSON 输出到最后一行"""
+    pages = sorted((int(img.stem), img) for img in path.glob(f"*.{picture_format}"))
+    output = path / f"merged_{workers}.pdf"
+
+    start = time.perf_counter()
+    pdf_merge.merge_pages(
+        pages,
+        path / f"merged_{workers}.pdf.partial",
+        output,
+        None,
+        50,
+        adaptive=adaptive,
+        workers=workers,
+    )
+    seconds = time.perf_counter() - start
+
+    main_rss, children_rss = peak_rss_mb()
+    print(
+        json.dumps(
+            {
+                "seconds": seconds,
+                "main_rss_mb": main_rss,
+                "children_rss_mb": children_rss,
+                "pdf_mb": output.stat().st_size / 1024 / 1024,
+            }
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="合并 PDF 的多进程压测")
+    parser.add_argument("--pages", type=int, default=400)
+    parser.add_argument("--workers", default="1,2,4,8")
+    parser.add_argument(
+        "--format", default="webp", help="图片格式，jpeg 会直接复制字节"
+    )
+    parser.add_argument("--adaptive", action="store_true", help="按照页的类型选择编码")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(Path(args.path), args.format, args.single, args.adaptive)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"生成 {args.pages} 页 {args.format} 图片 . . .")
+        make_pages(Path(tmp), args.pages, args.format)
+
+        print(
+            f"{'进程数':>6}{'耗时(s)':>10}{'加速比':>8}{'主进程(MB)':>12}{'子进程(MB)':>12}"
+        )
+        baseline = None
+        for workers in (int(w) for w in args.workers.split(",")):
+            command = [
+                sys.executable,
+                __file__,
+                "--single",
+                str(workers),
+                "--path",
+                tmp,
+                "--format",
+                args.format,
+            ]
+            if args.adaptive:
+                command.append("--adaptive")
+            output = subprocess.run(
+                command, capture_output=True, text=True, check=True
+            ).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+
+            baseline = baseline or r["seconds"]
+            print(
+                f"{workers:>6}{r['seconds']:>10.2f}{baseline / r['seconds']:>8.2f}"
+                f"{r['main_rss_mb']:>12.1f}{r['children_rss_mb']:>12.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
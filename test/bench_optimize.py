@@ -0,0 +1,72 @@
+"""
+测试合并之后优化 PDF（pdf_optimize）的效果：大小、打开时间（打开 PDF 并读取第一页的图片），以及优化本身的耗时。
+
+先用模拟的书籍（wqbook_emulator.py）生成若干页图片，合并成 PDF，然后优化它。需要安装 pikepdf。
+
+用法: python test/bench_optimize.py [--pages 400] [--format webp] [--adaptive] [--no-linearize]
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "proxy_server"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import pdf_merge
+import pdf_optimize
+from bench_merge import make_pages
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="优化 PDF 的效果")
+    parser.add_argument("--pages", type=int, default=400)
+    parser.add_argument("--format", default="webp")
+    parser.add_argument("--adaptive", action="store_true", help="按照页的类型选择编码")
+    parser.add_argument("--no-linearize", action="store_true", help="不线性化")
+    args = parser.parse_args()
+
+    if not pdf_optimize.available():
+        sys.exit("没有安装 pikepdf")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp)
+        print(f"生成 {args.pages} 页 {args.format} 图片 . . .")
+        make_pages(path, args.pages, args.format)
+
+        pages = sorted((int(img.stem), img) for img in path.glob(f"*.{args.format}"))
+        output = path / "book.pdf"
+        start = time.perf_counter()
+        pdf_merge.merge_pages(
+            pages,
+            path / "book.pdf.partial",
+            output,
+            [{"label": "第一章", "pnum": 1, "children": []}],
+            50,
+            adaptive=args.adaptive,
+        )
+        merge_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        stats = pdf_optimize.optimize_pdf(output, linearize=not args.no_linearize)
+        optimize_seconds = time.perf_counter() - start
+
+        print(f"{'':<12}{'大小(MB)':>12}{'打开(ms)':>12}")
+        print(
+            f"{'优化之前':<12}{stats['size_before'] / 1024 / 1024:>12.2f}"
+            f"{stats['open_before'] * 1000:>12.2f}"
+        )
+        print(
+            f"{'优化之后':<12}{stats['size_after'] / 1024 / 1024:>12.2f}"
+            f"{stats['open_after'] * 1000:>12.2f}"
+        )
+        print(
+            f"合并 <{merge_seconds:.2f}s>，优化 <{optimize_seconds:.2f}s>"
+            f"（其中包括测量打开时间），合并重复图片 <{stats['deduped_images']}> 个"
+        )
+
+
+if __name__ == "__main__":
+    main()
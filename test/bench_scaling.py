@@ -0,0 +1,202 @@
+"""
+用模拟的网站接口（wqbook_emulator.py）驱动整个处理流程，测试书籍页数增长时的表现：
+
+    吞吐量          每秒保存多少页
+    p50/p99 延迟    一页的第一个小图片到达，到这一页保存完成的时间
+    峰值内存        主进程、编码子进程的峰值 RSS
+    合并耗时        merge 模式合并 PDF、incremental 模式写入页面树的耗时
+
+每一种页数都在单独的子进程中运行，这样峰值内存互不影响。
+默认每一页的内容都不一样；加上 --variants 16 时只有 16 种不同的页，大部分页会被去重，用于测试去重的效果。
+生成模拟的小图片的耗时不计入吞吐量。
+
+用法: python test/bench_scaling.py [--pages 10,100,1000,5000] [--reorder 0.2] [--pdf-mode incremental] [--variants 16]
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "proxy_server"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from settings import settings
+from wqbook_emulator import EmulatedBook, WQBookEmulator
+
+BID = 9000001
+
+
+def peak_rss_mb() -> tuple[float, float]:
+    """(主进程, 子进程) 的峰值内存，Windows 上没有 resource 模块，返回 0"""
+    try:
+        import resource
+    except ImportError:
+        return 0.0, 0.0
+
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux 上单位是 KB，macOS 上是字节
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return self_rss / scale, children_rss / scale
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def drive(pages: int, reorder: float, variants: int) -> dict:
+    import pdf_merge
+    import utils
+    import wqbook
+    from process_url import WQBookAddon
+
+    # 自动合并会交给合并进程，这里改为最后在当前进程中单独计时
+    wqbook.WQBook._save_as_pdf = lambda self: None
+
+    addon = WQBookAddon()
+    book = addon.load_book(BID)
+    emulator = WQBookEmulator(
+        [EmulatedBook(BID, pages, variants=variants)], reorder=reorder, seed=1
+    )
+
+    first_tile: dict[int, float] = {}
+    latency: list[float] = []
+    on_page_saved = addon.on_page_saved
+
+    def record(book, page_num, saved):
+        latency.append(time.perf_counter() - first_tile[page_num])
+        on_page_saved(book, page_num, saved)
+
+    addon.on_page_saved = record
+
+    # 生成模拟的小图片也要花时间，不算在内
+    generate = 0.0
+    flows = emulator.flows()
+    start = time.perf_counter()
+    while True:
+        before = time.perf_counter()
+        item = next(flows, None)
+        generate += time.perf_counter() - before
+        if item is None:
+            break
+        url, body = item
+        if settings["api"]["split_page"] in url:
+            page_num = int(urllib.parse.urlparse(url).path.split("/")[-1])
+            first_tile.setdefault(page_num, time.perf_counter())
+        await addon.dispatch(url, body)
+    await addon.done()
+    elapsed = time.perf_counter() - start - generate
+
+    # 合并 PDF
+    output = settings["save_path"] / f"{BID}.pdf"
+    start = time.perf_counter()
+    if settings["pdf_mode"] == "incremental":
+        if book.incremental_pdf is not None:
+            book.incremental_pdf.close()
+        pdf_merge.merge_book(
+            BID,
+            book.images_path,
+            book.images_path / "book.partial.pdf",
+            output,
+            settings["picture_format"],
+            settings["picture_quality"],
+            settings["adaptive_encoding"],
+            settings["merge_page_workers"],
+        )
+    else:
+        utils.merge_image_as_pdf(book.images_path, output, book.bookmark)
+    merge_seconds = time.perf_counter() - start
+
+    main_rss, children_rss = peak_rss_mb()
+    return {
+        "pages": pages,
+        "saved": len(latency),
+        "seconds": elapsed,
+        "pages_per_second": len(latency) / elapsed,
+        "deduplicated": addon.page_pipeline.deduplicated,
+        "p50_ms": percentile(latency, 0.50) * 1000,
+        "p99_ms": percentile(latency, 0.99) * 1000,
+        "main_rss_mb": main_rss,
+        "children_rss_mb": children_rss,
+        "merge_seconds": merge_seconds,
+        "pdf_mb": output.stat().st_size / 1024 / 1024,
+    }
+
+
+def run_single(pages: int, reorder: float, pdf_mode: str, variants: int) -> None:
+    """在当前进程中测试一种页数，结果以 JSON 输出到最后一行"""
+    with tempfile.TemporaryDirectory() as tmp:
+        settings["image_path"] = Path(tmp) / "images"
+        settings["save_path"] = Path(tmp) / "download"
+        settings["save_path"].mkdir()
+        settings["book_id"] = [BID]
+        settings["logger_level"] = "ERROR"
+        settings["pdf_mode"] = pdf_mode
+
+        from mylogger import logger
+
+        logger.logger.setLevel("ERROR")
+        result = asyncio.run(drive(pages, reorder, variants))
+
+    print(json.dumps(result))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="书籍页数增长时的压测")
+    parser.add_argument("--pages", default="10,100,1000,5000")
+    parser.add_argument("--reorder", type=float, default=0.2)
+    parser.add_argument("--pdf-mode", default=settings["pdf_mode"])
+    parser.add_argument(
+        "--variants",
+        type=int,
+        default=0,
+        help="只生成这么多种不同的页（大部分页会被去重），默认每一页都不一样",
+    )
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.single, args.reorder, args.pdf_mode, args.variants)
+        return
+
+    header = f"{'页数':>6}{'页/秒':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'主进程(MB)':>12}{'子进程(MB)':>12}{'合并(s)':>10}{'PDF(MB)':>10}{'去重':>8}"
+    print(
+        f"pdf_mode={args.pdf_mode} reorder={args.reorder} variants={args.variants or '每页不同'}"
+    )
+    print(header)
+    for pages in (int(p) for p in args.pages.split(",")):
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--single",
+                str(pages),
+                "--reorder",
+                str(args.reorder),
+                "--pdf-mode",
+                args.pdf_mode,
+                "--variants",
+                str(args.variants),
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        r = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{r['pages']:>6}{r['pages_per_second']:>10.1f}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+            f"{r['main_rss_mb']:>12.1f}{r['children_rss_mb']:>12.1f}{r['merge_seconds']:>10.2f}{r['pdf_mb']:>10.1f}{r['deduplicated']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+对比两种图片流水线的 CPU 耗时、输出大小：
+
+    原来的流程：拼接 -> 编码为 webp -> 合并时解码 webp -> PIL 编码为 PDF -> pypdf 解析、合并
+    单次编码：  拼接 -> 编码为 jpeg -> 合并时直接复制 jpeg 数据到 PDF
+
+用法: python test/bench_single_encode.py [页数] [图片质量]
+"""
+
+import random
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "proxy_server"))
+
+import pypdf
+from PIL import Image, ImageDraw
+
+import imaging
+import utils
+from settings import settings
+
+
+def make_split_pages(seed: int, width: int = 900, height: int = 1300) -> list[bytes]:
+    """生成一页类似教材的内容（白底黑字、偶尔有彩色插图），并且切成 6 个 webp 小图片"""
+    rnd = random.Random(seed)
+    page = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(page)
+    for y in range(60, height - 60, 28):
+        x = 60
+        while x < width - 80:
+            word = rnd.randint(20, 90)
+            draw.rectangle((x, y, x + word, y + 14), fill=(20, 20, 20))
+            x += word + rnd.randint(8, 16)
+    if rnd.random() < 0.3:
+        draw.ellipse((200, 400, 700, 800), fill=(rnd.randint(0, 255), 120, 200))
+
+    result = []
+    tile_width = width // 6
+    for i in range(6):
+        stream = BytesIO()
+        tile = page.crop((i * tile_width, 0, (i + 1) * tile_width, height))
+        tile.save(stream, format="webp", quality=80)
+        result.append(stream.getvalue())
+    return result
+
+
+def old_merge(path: Path, filename: Path) -> None:
+    """原来的 merge_image_as_pdf：逐页解码、用 PIL 生成 PDF、再用 pypdf 解析"""
+    with pypdf.PdfWriter() as pdf_writer:
+        for img in utils.get_imgs_files(path, suffix="webp"):
+            pdf_stream = BytesIO()
+            Image.open(img).save(pdf_stream, "PDF")
+            reader = pypdf.PdfReader(pdf_stream)
+            pdf_writer.add_page(reader.pages[0])
+        pdf_writer.write(filename)
+
+
+def dir_size(path: Path, suffix: str) -> int:
+    return sum(f.stat().st_size for f in path.glob(f"*.{suffix}"))
+
+
+def run(pages: list[list[bytes]], quality: int, root: Path) -> None:
+    # 原来的流程
+    old_dir = root / "old"
+    old_dir.mkdir()
+    start = time.process_time()
+    for i, split_pages in enumerate(pages, 1):
+        imaging.save_full_page(split_pages, old_dir / f"{i}.webp", "webp", quality)
+    old_save = time.process_time() - start
+
+    start = time.process_time()
+    old_merge(old_dir, root / "old.pdf")
+    old_merge_time = time.process_time() - start
+
+    # 单次编码
+    new_dir = root / "new"
+    new_dir.mkdir()
+    start = time.process_time()
+    for i, split_pages in enumerate(pages, 1):
+        imaging.save_full_page(split_pages, new_dir / f"{i}.jpeg", "jpeg", quality)
+    new_save = time.process_time() - start
+
+    settings["picture_format"] = "jpeg"
+    start = time.process_time()
+    utils.merge_image_as_pdf(new_dir, root / "new.pdf")
+    new_merge_time = time.process_time() - start
+
+    rows = [
+        (
+            "原来的流程 (webp)",
+            old_save,
+            old_merge_time,
+            dir_size(old_dir, "webp"),
+            root / "old.pdf",
+        ),
+        (
+            "单次编码 (jpeg)",
+            new_save,
+            new_merge_time,
+            dir_size(new_dir, "jpeg"),
+            root / "new.pdf",
+        ),
+    ]
+    print(f"\n页数 {len(pages)}，图片质量 {quality}")
+    print(
+        f"{'流程':<20}{'保存 CPU(s)':>12}{'合并 CPU(s)':>12}{'图片(KB)':>12}{'PDF(KB)':>12}"
+    )
+    for name, save, merge, images, pdf in rows:
+        print(
+            f"{name:<20}{save:>12.2f}{merge:>12.2f}{images / 1024:>12.0f}{pdf.stat().st_size / 1024:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    page_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    quality = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    pages = [make_split_pages(i) for i in range(page_count)]
+    with tempfile.TemporaryDirectory() as tmp:
+        run(pages, quality, Path(tmp))
@@ -0,0 +1,172 @@
+"""
+测试代理的启动耗时：
+
+    导入耗时      python -X importtime 统计的每个模块的导入耗时（自身、包括子模块），
+                  以及 PIL、pypdf 等重量级的库有没有在启动时被加载
+    初始化耗时    配置了很多本书时，创建 WQBookAddon、读取第一本书、读取所有书的耗时
+
+每一项都在单独的子进程中运行，这样模块缓存互不影响。
+
+用法: python test/bench_startup.py [--books 50] [--pages 500] [--top 15]
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PROXY_DIR = Path(__file__).parent.parent / "proxy_server"
+sys.path.insert(0, str(PROXY_DIR))
+
+HEAVY_MODULES = ("PIL", "pypdf", "jwt", "Crypto", "multiprocessing", "commentjson")
+"启动时最好不要加载的库（commentjson 读取配置文件时必须用到，只是列出来作为参照）"
+
+
+def import_times() -> list[tuple[str, int, int, int]]:
+    """在子进程中导入 process_url，返回 (模块名, 嵌套深度, 自身耗时 us, 累计耗时 us)"""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import process_url"],
+        cwd=PROXY_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+
+    result = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        result.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return result
+
+
+def report_imports(top: int) -> None:
+    times = import_times()
+    project = {path.stem for path in PROXY_DIR.glob("*.py")}
+    total = next(t for t in times if t[0] == "process_url")[3]
+    print(f"导入 process_url 总耗时 <{total / 1000:.1f}ms>\n")
+
+    print(f"{'本项目的模块':<20}{'自身(ms)':>10}{'累计(ms)':>10}")
+    for name, _, self_us, cumulative_us in sorted(
+        (t for t in times if t[0] in project), key=lambda t: -t[3]
+    ):
+        print(f"{name:<20}{self_us / 1000:>10.1f}{cumulative_us / 1000:>10.1f}")
+
+    print(f"\n{'累计耗时最多的第三方库':<20}{'累计(ms)':>10}")
+    packages: dict[str, int] = {}
+    for name, _, _, cumulative_us in times:
+        package = name.split(".")[0]
+        if package not in project and name == package:
+            packages[package] = max(packages.get(package, 0), cumulative_us)
+    for package, cumulative_us in sorted(packages.items(), key=lambda p: -p[1])[:top]:
+        print(f"{package:<20}{cumulative_us / 1000:>10.1f}")
+
+    loaded = {t[0].split(".")[0] for t in times}
+    print("\n启动时加载的重量级库:")
+    for package in HEAVY_MODULES:
+        print(f"    {package:<18}{'已加载' if package in loaded else '未加载'}")
+
+
+def make_books(image_path: Path, books: int, pages: int) -> list[int]:
+    """生成 books 本书的下载状态，每本书下载了一半的页"""
+    from book_state import BookManifest
+
+    bids = list(range(9100001, 9100001 + books))
+    for bid in bids:
+        manifest = BookManifest(image_path / str(bid))
+        manifest.path.mkdir(parents=True)
+        manifest.set_info(f"Book{bid}", "bench", pages)
+        for page_num in range(1, pages // 2 + 1):
+            manifest.add_page(page_num, f"{page_num:08x}", 1000)
+        manifest.compact()
+        manifest.close()
+    return bids
+
+
+def run_single(books: int, pages: int) -> None:
+    """在当前进程中测试初始化耗时，结果以 JSON 输出到最后一行"""
+    start = time.perf_counter()
+    from settings import settings
+
+    with tempfile.TemporaryDirectory() as tmp:
+        settings["image_path"] = Path(tmp) / "images"
+        settings["save_path"] = Path(tmp) / "download"
+        settings["book_id"] = make_books(settings["image_path"], books, pages)
+        settings["logger_level"] = "ERROR"
+
+        from mylogger import logger
+
+        logger.logger.setLevel("ERROR")
+
+        from process_url import WQBookAddon
+
+        imported = time.perf_counter()
+
+        async def init() -> dict:
+            start = time.perf_counter()
+            addon = WQBookAddon()
+            created = time.perf_counter()
+            await addon.filter_book(settings["book_id"][0])
+            first = time.perf_counter()
+            await addon._load_books()
+            loaded = time.perf_counter()
+            await addon.done()
+            return {
+                "create_ms": (created - start) * 1000,
+                "first_book_ms": (first - created) * 1000,
+                "all_books_ms": (loaded - created) * 1000,
+            }
+
+        result = asyncio.run(init())
+
+    result["import_ms"] = (imported - start) * 1000
+    result["heavy_loaded"] = [m for m in HEAVY_MODULES if m in sys.modules]
+    print(json.dumps(result))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="代理启动耗时的测试")
+    parser.add_argument("--books", type=int, default=50, help="配置的书籍数量")
+    parser.add_argument("--pages", type=int, default=500, help="每本书的页数")
+    parser.add_argument("--top", type=int, default=15, help="列出多少个第三方库")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.books, args.pages)
+        return
+
+    report_imports(args.top)
+
+    output = subprocess.run(
+        [
+            sys.executable,
+            __file__,
+            "--single",
+            "--books",
+            str(args.books),
+            "--pages",
+            str(args.pages),
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    r = json.loads(output.strip().splitlines()[-1])
+
+    print(f"\n初始化耗时（{args.books} 本书，每本 {args.pages} 页，已下载一半）:")
+    print(f"    导入模块                {r['import_ms']:>10.1f}ms")
+    print(f"    创建 WQBookAddon        {r['create_ms']:>10.1f}ms")
+    print(f"    读取第一本书            {r['first_book_ms']:>10.1f}ms")
+    print(f"    读取所有书              {r['all_books_ms']:>10.1f}ms")
+    print(f"    之后加载的重量级库      {', '.join(r['heavy_loaded']) or '无'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+本地接口 /events 的客户端，用于测试代理推送的事件。
+
+直接运行时连接正在运行的代理，打印收到的每一个事件：
+
+    python test/events_client.py [--url http://127.0.0.1:8899/events]
+
+加上 --emulate 时不需要启动代理：在当前进程中创建 WQBookAddon、启动本地接口，
+用模拟的网站（wqbook_emulator.py）翻完一本书，同时用客户端接收事件，
+最后检查每一页都收到了 page-saved，并输出从一页的最后一个小图片到达、到收到 page-saved 的延迟。
+
+    python test/events_client.py --emulate [--pages 30] [--queue 2]
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections.abc import Iterator
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "proxy_server"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+BID = 9000003
+
+
+def read_events(url: str) -> Iterator[tuple[str, dict]]:
+    """连接 SSE 接口，返回 (事件名, 数据)，连接断开时结束"""
+    with urllib.request.urlopen(url) as response:
+        event, data = "message", []
+        for raw in response:
+            line = raw.decode("utf-8").rstrip("\n")
+            if line.startswith(":"):
+                continue
+            if line.startswith("event:"):
+                event = line[len("event:") :].strip()
+            elif line.startswith("data:"):
+                data.append(line[len("data:") :].strip())
+            elif not line and data:
+                yield event, json.loads("\n".join(data))
+                event, data = "message", []
+
+
+def print_events(url: str) -> None:
+    for event, data in read_events(url):
+        print(f"[{time.strftime('%H:%M:%S')}] {event}: {data}")
+
+
+async def emulate(pages: int, port: int) -> None:
+    from settings import settings
+    from wqbook_emulator import EmulatedBook, WQBookEmulator
+
+    import wqbook
+    from process_url import WQBookAddon
+
+    # 这里只关心事件，不合并 PDF
+    wqbook.WQBook._save_as_pdf = lambda self: None
+
+    addon = WQBookAddon()
+    await addon.running()
+
+    received: list[tuple[float, str, dict]] = []
+
+    def client():
+        for event, data in read_events(f"http://127.0.0.1:{port}/events"):
+            received.append((time.perf_counter(), event, data))
+
+    thread = threading.Thread(target=client, daemon=True)
+    thread.start()
+    # 等待客户端连上
+    while not received:
+        await asyncio.sleep(0.05)
+
+    emulator = WQBookEmulator([EmulatedBook(BID, pages)], reorder=0.2, seed=1)
+    last_tile: dict[int, float] = {}
+    for url, body in emulator.flows():
+        if settings["api"]["split_page"] in url:
+            page_num = int(urllib.parse.urlparse(url).path.split("/")[-1])
+            last_tile[page_num] = time.perf_counter()
+        await addon.dispatch(url, body)
+    await addon.page_pipeline.drain()
+    await asyncio.sleep(0.2)
+    await addon.done()
+    thread.join(timeout=5)
+
+    saved = {data["page"]: t for t, event, data in received if event == "page-saved"}
+    pacing = [data["interval_ms"] for _, event, data in received if event == "pacing"]
+    dropped = [data for _, event, data in received if event == "tile-dropped"]
+    latency = sorted(saved[p] - last_tile[p] for p in saved)
+
+    print(f"收到事件 <{len(received)}> 个")
+    print(f"page-saved    <{len(saved)}/{pages}> 页")
+    print(f"tile-dropped  <{len(dropped)}> 个")
+    print(f"pacing        {pacing}")
+    if latency:
+        print(
+            f"最后一个小图片 => page-saved 延迟: p50 <{latency[len(latency) // 2] * 1000:.1f}ms>，"
+            f"最大 <{latency[-1] * 1000:.1f}ms>"
+        )
+
+    missing = set(range(1, pages + 1)) - set(saved)
+    if missing:
+        print(f"没有收到 page-saved 的页: {sorted(missing)}")
+        sys.exit(1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="/events 的测试客户端")
+    parser.add_argument("--url", default="http://127.0.0.1:8899/events")
+    parser.add_argument("--emulate", action="store_true", help="不连接代理，自己模拟")
+    parser.add_argument("--pages", type=int, default=30)
+    parser.add_argument("--queue", type=int, default=2, help="编码队列的长度")
+    parser.add_argument("--port", type=int, default=18899, help="模拟时本地接口的端口")
+    args = parser.parse_args()
+
+    if not args.emulate:
+        print_events(args.url)
+        return
+
+    from settings import settings
+
+    with tempfile.TemporaryDirectory() as tmp:
+        settings["image_path"] = Path(tmp) / "images"
+        settings["save_path"] = Path(tmp) / "download"
+        settings["book_id"] = [BID]
+        settings["local_api_port"] = args.port
+        settings["page_queue_size"] = args.queue
+        settings["settings_reload_interval"] = 0
+        settings["metrics_log_interval"] = 0
+
+        from mylogger import logger
+
+        logger.logger.setLevel("ERROR")
+        asyncio.run(emulate(args.pages, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+测试多个代理实例共用同一个图片目录（settings.jsonc 中的 shared_store）。
+
+在本机启动多个进程，每个进程是一个代理实例（WQBookAddon），用环境变量 WQBOOK_SETTINGS 指定各自的
+instance_id、local_api_port。每个实例都用模拟的网站（wqbook_emulator.py）从书的不同位置开始，
+一直翻完整本书，模拟多个浏览器同时阅读同一本书。最后检查：
+
+    每一页只被一个实例保存（其它实例收到这一页的请求时直接放行）
+    所有实例合起来保存了所有页
+    只有一个实例被选为合并者，并且只合并了一次，PDF 包含所有页
+
+用法: python test/shared_store.py [--instances 3] [--pages 60] [--delay 0.01]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "proxy_server"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+BID = 9000004
+
+
+async def run_instance(index: int, instances: int, pages: int, delay: float) -> dict:
+    from wqbook_emulator import EmulatedBook, WQBookEmulator
+
+    import wqbook
+    from merge_scheduler import merge_scheduler
+    from process_url import WQBookAddon
+
+    saved_pages, merges = [], []
+    finish_page, submit = wqbook.WQBook.finish_page, merge_scheduler.submit
+
+    def count_saved(self, page_num, saved):
+        if saved is not None:
+            saved_pages.append(page_num)
+        return finish_page(self, page_num, saved)
+
+    def count_merges(bid, *args):
+        # 没被选为合并者的实例不会提交合并任务
+        merges.append(bid)
+        submit(bid, *args)
+
+    wqbook.WQBook.finish_page = count_saved
+    merge_scheduler.submit = count_merges
+
+    addon = WQBookAddon()
+    emulator = WQBookEmulator([EmulatedBook(BID, pages)], seed=index)
+    flows = list(emulator.book_flows(BID))
+    info, page_flows = flows[0], flows[1:]
+
+    # 每个实例从书的不同位置开始翻，翻到最后再从头翻到开始的位置
+    start = pages * index // instances
+    order = page_flows[start:] + page_flows[:start]
+
+    begin = time.perf_counter()
+    for url, body in info:
+        await addon.dispatch(url, body)
+    for page in order:
+        for url, body in page:
+            await addon.dispatch(url, body)
+        await asyncio.sleep(delay)
+    # 等待保存完所有页，合并者还要等待合并完成
+    await addon.done(wait_merges=True)
+    elapsed = time.perf_counter() - begin
+
+    return {
+        "instance": index,
+        "saved_pages": saved_pages,
+        "merges": len(merges),
+        "seconds": elapsed,
+    }
+
+
+def child(args) -> None:
+    from settings import settings
+
+    root = Path(args.root)
+    settings["image_path"] = root / "images"
+    settings["save_path"] = root / "download"
+    settings["book_id"] = [BID]
+    settings["page_workers"] = 0
+    settings["settings_reload_interval"] = 0
+    settings["metrics_log_interval"] = 0
+
+    from mylogger import logger
+
+    logger.logger.setLevel("ERROR")
+    result = asyncio.run(
+        run_instance(args.child, args.instances, args.pages, args.delay)
+    )
+    print(json.dumps(result))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="多个代理实例共用图片目录的测试")
+    parser.add_argument("--instances", type=int, default=3)
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--delay", type=float, default=0.01, help="每翻一页等待的秒数")
+    parser.add_argument("--child", type=int, default=-1, help=argparse.SUPPRESS)
+    parser.add_argument("--root", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child >= 0:
+        child(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        procs = []
+        for i in range(args.instances):
+            override = Path(tmp) / f"instance{i}.jsonc"
+            override.write_text(
+                json.dumps(
+                    {
+                        "shared_store": True,
+                        "instance_id": f"instance{i}",
+                        "local_api_port": 0,
+                        "pdf_mode": "merge",
+                    }
+                )
+            )
+            procs.append(
+                subprocess.Popen(
+                    [
+                        sys.executable,
+                        __file__,
+                        "--child",
+                        str(i),
+                        "--root",
+                        tmp,
+                        "--instances",
+                        str(args.instances),
+                        "--pages",
+                        str(args.pages),
+                        "--delay",
+                        str(args.delay),
+                    ],
+                    env={**os.environ, "WQBOOK_SETTINGS": str(override)},
+                    stdout=subprocess.PIPE,
+                    text=True,
+                )
+            )
+
+        results = []
+        for proc in procs:
+            out, _ = proc.communicate()
+            if proc.returncode:
+                sys.exit(f"实例进程退出码 <{proc.returncode}>")
+            results.append(json.loads(out.strip().splitlines()[-1]))
+
+        saved = [page for result in results for page in result["saved_pages"]]
+        merges = sum(result["merges"] for result in results)
+        for result in results:
+            print(
+                f"实例 <{result['instance']}> 保存 <{len(result['saved_pages'])}> 页，"
+                f"提交合并 <{result['merges']}> 次，用时 <{result['seconds']:.2f}s>"
+            )
+
+        pdfs = list((Path(tmp) / "download").glob(f"{BID}_*.pdf"))
+        pdf_pages = 0
+        if len(pdfs) == 1:
+            from pypdf import PdfReader
+
+            pdf_pages = len(PdfReader(pdfs[0]).pages)
+        print(
+            f"合计保存 <{len(saved)}/{args.pages}> 页（不同的页 <{len(set(saved))}>），"
+            f"合并 <{merges}> 次，"
+            f"PDF <{len(pdfs)}> 个，共 <{pdf_pages}> 页"
+        )
+
+        if (
+            sorted(saved) != list(range(1, args.pages + 1))
+            or merges != 1
+            or pdf_pages != args.pages
+        ):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
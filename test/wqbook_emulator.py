@@ -0,0 +1,347 @@
+"""
+模拟网站的接口，用于在本地测试、压测代理的处理流程，不需要真的去网站上翻页。
+
+它生成的数据和网站的格式一致：
+    initread        书籍名称、作者、总页数
+    catatree        书签
+    once/get        参数 k 是 jwt，响应是用 k 中的 key 进行 AES 加密的 {"zn": encode_zn}
+    lmg             参数 k 是 jwt，其中的 zn 就是 encode_zn，响应是 webp 格式的小图片
+
+有两种用法：
+    1. WQBookEmulator.flows() 直接生成 (URL, 响应体)，可以交给 WQBookAddon.dispatch 处理
+    2. WQBookEmulator.serve() 启动一个本地 HTTP 服务器，接口路径和网站一样
+
+用法: python test/wqbook_emulator.py --port 8765 --book 1001:50 --book 1002:300
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import threading
+import urllib.parse
+from collections import OrderedDict
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import jwt
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+from PIL import Image, ImageDraw
+
+HOST = "https://wqbook.wqxuetang.com"
+
+
+class EmulatedBook:
+    """一本模拟的书，每一页的内容都是随机生成的（白底黑字，偶尔有彩色插图）"""
+
+    CACHE_PAGES = 64
+    "最多缓存多少页的小图片，页数很多时不会占用太多内存"
+
+    def __init__(
+        self,
+        bid: int,
+        pages: int,
+        tile_size: tuple[int, int] = (150, 1300),
+        seed: int = 0,
+        variants: int = 0,
+    ) -> None:
+        self.bid = bid
+        self.pages = pages
+        self.tile_size = tile_size
+        self.seed = seed
+        self.variants = variants
+        """
+        为 0 时每一页的内容都不一样（由页码决定）；
+        大于 0 时只生成这么多种不同的页、重复使用，大部分页内容相同，用于测试去重
+        """
+        self._tiles: OrderedDict[int, list[bytes]] = OrderedDict()
+
+    def info(self) -> bytes:
+        data = {
+            "author": "模拟作者",
+            "name": f"模拟书籍{self.bid}",
+            "pages": self.pages,
+        }
+        return json.dumps({"data": data}, ensure_ascii=False).encode()
+
+    def bookmark(self) -> bytes:
+        """每 10 页一个章节，每个章节下面两个小节"""
+        chapters = []
+        for start in range(1, self.pages + 1, 10):
+            children = [
+                {
+                    "label": f"{start}.{i}",
+                    "pnum": str(p),
+                    "isLeaf": True,
+                    "children": None,
+                }
+                for i, p in enumerate((start, min(start + 5, self.pages)), 1)
+            ]
+            chapters.append(
+                {
+                    "label": f"第 {start // 10 + 1} 章",
+                    "pnum": str(start),
+                    "isLeaf": False,
+                    "children": children,
+                }
+            )
+        return json.dumps({"data": chapters}, ensure_ascii=False).encode()
+
+    def tiles(self, page_num: int) -> list[bytes]:
+        """第 page_num 页的 6 个小图片，按照正确的顺序"""
+        variant = page_num
+        if self.variants:
+            variant = (page_num + self.seed) % self.variants
+
+        tiles = self._tiles.pop(variant, None)
+        if tiles is None:
+            tiles = self._make_tiles(variant)
+        self._tiles[variant] = tiles
+        while len(self._tiles) > self.CACHE_PAGES:
+            self._tiles.popitem(last=False)
+        return tiles
+
+    def _make_tiles(self, variant: int) -> list[bytes]:
+        rnd = random.Random(variant * 7919 + self.seed)
+        tile_width, height = self.tile_size
+        width = tile_width * 6
+
+        page = Image.new("RGB", (width, height), "white")
+        draw = ImageDraw.Draw(page)
+        for y in range(40, height - 40, 28):
+            x = 40
+            while x < width - 60:
+                word = rnd.randint(20, 90)
+                draw.rectangle((x, y, x + word, y + 14), fill=(20, 20, 20))
+                x += word + rnd.randint(8, 16)
+        if variant % 4 == 0:
+            draw.ellipse(
+                (width // 4, height // 3, width * 3 // 4, height * 2 // 3),
+                fill=(200, 80, 60),
+            )
+
+        result = []
+        for i in range(6):
+            stream = BytesIO()
+            tile = page.crop((i * tile_width, 0, (i + 1) * tile_width, height))
+            tile.save(stream, format="webp", quality=80)
+            result.append(stream.getvalue())
+        return result
+
+    pass
+
+
+class WQBookEmulator:
+    """模拟网站的接口"""
+
+    def __init__(
+        self,
+        books: list[EmulatedBook],
+        secret: str = "secret",
+        reorder: float = 0.0,
+        interleave: bool = False,
+        seed: int = 0,
+    ) -> None:
+        self.books = {book.bid: book for book in books}
+        self.secret = secret
+        "签名 jwt 用的密钥"
+        self.reorder = reorder
+        "小图片比它的 once/get 请求先到的概率"
+        self.interleave = interleave
+        "多本书时，是否交替请求各本书的页"
+        self.rnd = random.Random(seed)
+
+    # region 网站协议相关
+
+    def encode_zn(self, bid: int, page_num: int, zn: int) -> str:
+        """加密后的 zn，形如 ha1TgXQ9J1c，同一个小图片每次都一样"""
+        digest = hashlib.sha1(f"{self.secret}:{bid}:{page_num}:{zn}".encode()).digest()
+        return base64.urlsafe_b64encode(digest).decode()[:11]
+
+    def decode_zn(self, bid: int, page_num: int, encode_zn: str) -> int:
+        for zn in range(6):
+            if self.encode_zn(bid, page_num, zn) == encode_zn:
+                return zn
+        return -1
+
+    def once_get_k(self, bid: int, page_num: int, zn: int) -> str:
+        """once/get 请求的参数 k，里面的 i 用于生成 AES 的 key"""
+        key = hashlib.md5(
+            f"{bid}:{page_num}:{zn}:{self.rnd.random()}".encode()
+        ).hexdigest()
+        payload = {"b": bid, "p": page_num, "zn": zn, "k": json.dumps({"i": key})}
+        return jwt.encode(payload, self.secret, algorithm="HS256")
+
+    def lmg_k(self, bid: int, page_num: int, encode_zn: str) -> str:
+        payload = {"b": bid, "p": page_num, "k": json.dumps({"zn": encode_zn})}
+        return jwt.encode(payload, self.secret, algorithm="HS256")
+
+    def once_get_body(self, k: str) -> bytes:
+        """根据参数 k 生成 once/get 的响应"""
+        data = jwt.decode(k, options={"verify_signature": False})
+        encode_zn = self.encode_zn(data["b"], data["p"], data["zn"])
+        key = json.loads(data["k"])["i"][:16].encode()
+
+        plain = json.dumps({"zn": encode_zn}).encode()
+        ciphertext = AES.new(key, AES.MODE_ECB).encrypt(pad(plain, AES.block_size))
+        return json.dumps({"data": base64.b64encode(ciphertext).decode()}).encode()
+
+    def lmg_body(self, k: str) -> bytes | None:
+        """根据参数 k 返回对应的小图片，找不到时返回 None"""
+        data = jwt.decode(k, options={"verify_signature": False})
+        book = self.books.get(data["b"])
+        if book is None:
+            return None
+
+        zn = self.decode_zn(data["b"], data["p"], json.loads(data["k"])["zn"])
+        if zn == -1:
+            return None
+        return book.tiles(data["p"])[zn]
+
+    # endregion
+
+    # region 直接生成请求
+
+    def book_flows(self, bid: int) -> Iterator[list[tuple[str, bytes]]]:
+        """一本书的请求，每次返回一页（或者书籍信息）的全部请求"""
+        book = self.books[bid]
+        yield [
+            (f"{HOST}/api/v7/read/initread?bid={bid}", book.info()),
+            (f"{HOST}/deep/book/v1/catatree?bid={bid}", book.bookmark()),
+        ]
+
+        for page_num in range(1, book.pages + 1):
+            once, lmg = [], []
+            tiles = book.tiles(page_num)
+            for zn in range(6):
+                k = self.once_get_k(bid, page_num, zn)
+                once.append(
+                    (
+                        f"{HOST}/deep/page/once/get?bid={bid}&pnum={page_num}&k={k}",
+                        self.once_get_body(k),
+                    )
+                )
+                encode_zn = self.encode_zn(bid, page_num, zn)
+                k = self.lmg_k(bid, page_num, encode_zn)
+                lmg.append((f"{HOST}/deep/page/lmg/{bid}/{page_num}?k={k}", tiles[zn]))
+
+            # 小图片的顺序本来就是打乱的
+            self.rnd.shuffle(lmg)
+            flows = once + lmg
+
+            # 部分小图片比它的 once/get 请求先到
+            if self.reorder:
+                for i in range(6, 12):
+                    if self.rnd.random() < self.reorder:
+                        flows.insert(self.rnd.randint(0, 5), flows.pop(i))
+
+            yield flows
+
+    def flows(self) -> Iterator[tuple[str, bytes]]:
+        """所有书籍的请求，(URL, 响应体)"""
+        generators = [self.book_flows(bid) for bid in self.books]
+
+        if not self.interleave:
+            for generator in generators:
+                for flows in generator:
+                    yield from flows
+            return
+
+        # 交替请求各本书，模拟多个标签页同时阅读
+        while generators:
+            for generator in list(generators):
+                flows = next(generator, None)
+                if flows is None:
+                    generators.remove(generator)
+                else:
+                    yield from flows
+
+    # endregion
+
+    # region 本地 HTTP 服务器
+
+    def handle(self, path: str) -> tuple[int, bytes, str]:
+        """处理一个 GET 请求，返回 (状态码, 响应体, Content-Type)"""
+        parsed = urllib.parse.urlparse(path)
+        query = urllib.parse.parse_qs(parsed.query)
+        json_type = "application/json"
+
+        if parsed.path == "/api/v7/read/initread":
+            book = self.books.get(int(query["bid"][0]))
+            if book:
+                return 200, book.info(), json_type
+
+        elif parsed.path == "/deep/book/v1/catatree":
+            book = self.books.get(int(query["bid"][0]))
+            if book:
+                return 200, book.bookmark(), json_type
+
+        elif parsed.path == "/deep/page/once/get":
+            return 200, self.once_get_body(query["k"][0]), json_type
+
+        elif parsed.path.startswith("/deep/page/lmg/"):
+            body = self.lmg_body(query["k"][0])
+            if body is not None:
+                return 200, body, "image/webp"
+
+        return 404, b"not found", "text/plain"
+
+    def serve(self, port: int = 0) -> ThreadingHTTPServer:
+        """在后台线程中启动 HTTP 服务器，port 为 0 时随机选择端口（server.server_port）"""
+        emulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                try:
+                    status, body, content_type = emulator.handle(self.path)
+                except Exception:
+                    status, body, content_type = 400, b"bad request", "text/plain"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    # endregion
+
+    pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="模拟网站的接口")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--book",
+        action="append",
+        default=[],
+        help="书籍 id:页数，如 1001:50，可以有多个",
+    )
+    parser.add_argument("--secret", default="secret", help="签名 jwt 用的密钥")
+    parser.add_argument(
+        "--variants",
+        type=int,
+        default=0,
+        help="只生成这么多种不同的页（大部分页重复，用于测试去重），默认每一页都不一样",
+    )
+    args = parser.parse_args()
+
+    books = []
+    for item in args.book or ["1001:50"]:
+        bid, pages = item.split(":")
+        books.append(EmulatedBook(int(bid), int(pages), variants=args.variants))
+
+    server = WQBookEmulator(books, secret=args.secret).serve(args.port)
+    print(f"模拟服务器已启动: http://127.0.0.1:{server.server_port}")
+    threading.Event().wait()
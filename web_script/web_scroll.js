@@ -15,6 +15,64 @@
     /** 当没有找到翻页元素时，需要进行重试检测 */
     const MAX_RETRY_COUNT = 3;
 
+    /** 代理的本地接口（settings.jsonc 中的 local_api_port），用于查询还缺少哪些页。连不上时按原来的方式逐页滚动 */
+    const LOCAL_API = 'http://127.0.0.1:8899';
+
+    /** 没有连上代理时，每隔多少毫秒向下滚动一次 */
+    const DEFAULT_INTERVAL = 3000;
+
+    /** 代理建议的最短翻页间隔（毫秒），编码队列越满越长，见 connect_events */
+    let pacing_ms = DEFAULT_INTERVAL;
+
+    /** 代理已经保存好的页 @type Set<number> */
+    const saved_pages = new Set();
+
+    /** 还缺少的页，每次开始自动翻页时从代理获取。为 null 表示不知道，需要逐页滚动
+     * @type Set<number> | null
+     */
+    let missing_pages = null;
+
+    /** 从代理获取补下载的计划，返回还缺少的页 */
+    async function load_missing_pages() {
+        const bid = new URLSearchParams(location.search).get('bid');
+        try {
+            const resp = await fetch(`${LOCAL_API}/books/${bid}/missing`);
+            if (!resp.ok) return null;
+
+            const plan = await resp.json();
+            const pages = new Set();
+            for (const [start, end] of plan.ranges) {
+                for (let i = start; i <= end; i++) pages.add(i);
+            }
+            return pages;
+        } catch (e) {
+            return null;
+        }
+    }
+
+    /** 如果当前页之后紧接着的页已经下载过了，直接跳到下一个缺少的页。
+     * 其返回值有如下含义:
+     * - scroll: 按原来的方式向下滚动
+     * - jumped: 已经跳到下一个缺少的页
+     * - done: 当前页之后已经没有缺少的页了
+     *
+     * @returns 'scroll' | 'jumped' | 'done'
+     */
+    function jump_to_missing_page() {
+        const page_num_elem = document.querySelector('.page-head-tol');
+        if (!missing_pages || !page_num_elem) return 'scroll';
+
+        const page_num = parseInt(page_num_elem.textContent.split('/')[0]);
+        const next = Math.min(...[...missing_pages].filter(p => p > page_num));
+        if (next === Infinity) return 'done';
+        if (next == page_num + 1) return 'scroll';
+
+        const target = document.querySelector(`#pageImgBox${next}`);
+        if (!target) return 'scroll';
+        target.scrollIntoView();
+        return 'jumped';
+    }
+
     /** 是否可以继续向下滚动。它是检测网页端是否已经加载了 6 张小图片来判断。
      * 其返回值有如下含义:
      * - continue: 可以继续向下滚动
@@ -48,6 +106,49 @@
         }
     }
 
+    /** 当前所在的页数，找不到时返回 NaN */
+    function current_page_num() {
+        const page_num_elem = document.querySelector('.page-head-tol');
+        return page_num_elem ? parseInt(page_num_elem.textContent.split('/')[0]) : NaN;
+    }
+
+    /**
+     * 订阅代理推送的事件：
+     * - page-saved: 某一页已经保存到磁盘上了，不需要再等它
+     * - tile-dropped: 某个小图片被丢弃了，这一页之后需要重新翻到
+     * - pacing: 代理建议的翻页间隔
+     *
+     * 连不上代理时什么也不做，EventSource 会自动重连。
+     * @param {(page_num: number) => void} on_page_saved 当前书籍的某一页保存好之后调用
+     */
+    function connect_events(on_page_saved) {
+        if (!window.EventSource) return;
+
+        const bid = new URLSearchParams(location.search).get('bid');
+        const events = new EventSource(`${LOCAL_API}/events`);
+
+        events.addEventListener('pacing', e => {
+            pacing_ms = JSON.parse(e.data).interval_ms;
+        });
+        events.addEventListener('page-saved', e => {
+            const data = JSON.parse(e.data);
+            pacing_ms = data.pacing.interval_ms;
+            if (String(data.bid) != bid) return;
+
+            saved_pages.add(data.page);
+            if (missing_pages) missing_pages.delete(data.page);
+            on_page_saved(data.page);
+        });
+        events.addEventListener('tile-dropped', e => {
+            const data = JSON.parse(e.data);
+            if (String(data.bid) == bid && missing_pages) missing_pages.add(data.page);
+        });
+        events.onerror = () => {
+            // 连接断开了，恢复默认的速度
+            pacing_ms = DEFAULT_INTERVAL;
+        };
+    }
+
     function create_btn() {
         if (document.querySelector('#auto_scroll_btn')) return;
 
@@ -93,57 +194,91 @@
         const btn = create_btn();
 
         let is_auto_scroll = false;
-        let interval_id = -1;
+        let timeout_id = -1;
         /** 标记状态是否从 wait 到 continue 转变 */
         let flag_changed = false;
+        /** 上一次翻页的时间 */
+        let last_step = 0;
+
+        /** 停止自动翻页，并在按钮上显示原因 */
+        function stop(text, color) {
+            clearTimeout(timeout_id);
+            is_auto_scroll = false;
+            btn.textContent = text;
+            btn.style.backgroundColor = color;
+        }
+
+        /** 翻页一次，然后等待下一次翻页。没有连上代理时 3s 向下滚动 300px，相比较 1s 滚动 100px 可以降低访问的频率 */
+        function step() {
+            clearTimeout(timeout_id);
+            if (!is_auto_scroll) return;
+            last_step = Date.now();
+            // 代理保存好当前页时会立即翻页（见 connect_events），这里只是兜底，编码队列满了的时候还会变慢
+            timeout_id = setTimeout(step, Math.max(DEFAULT_INTERVAL, pacing_ms));
+
+            // 有小数的情况，需要取整
+            const is_end = Math.ceil(scroll_target.scrollTop) >= Math.ceil(scroll_target.scrollHeight - scroll_target.clientHeight);
+            if (is_end) {
+                stop('到底了，点我重新自动翻页', 'yellowgreen');
+                return;
+            }
+
+            const flag = can_continue();
+            if (flag == 'wait') {
+                btn.textContent = '正在等待小图片加载，点我停止自动翻页';
+                flag_changed = true;
+                return;
+            }
+            if (flag == 'error') {
+                stop('出现致命错误，脚本已无法工作', 'grey');
+                btn.disabled = true;
+                return;
+            }
+            if (flag_changed) {
+                btn.textContent = '点我停止自动翻页';
+                flag_changed = false;
+            }
+
+            const jump = jump_to_missing_page();
+            if (jump == 'done') {
+                stop('缺少的页都已经翻过了，点我重新自动翻页', 'yellowgreen');
+                return;
+            }
+            if (jump == 'jumped') return;
+
+            // 代理已经保存好当前页了，直接翻到下一页
+            const page_num = current_page_num();
+            const next = document.querySelector(`#pageImgBox${page_num + 1}`);
+            if (saved_pages.has(page_num) && next) {
+                next.scrollIntoView();
+                return;
+            }
+
+            scroll_target.scrollTop += 300;
+        }
+
+        connect_events(page_num => {
+            // 当前页保存好了就立即翻页，但是不要快过代理建议的间隔
+            if (!is_auto_scroll || page_num != current_page_num()) return;
+            const wait = last_step + pacing_ms - Date.now();
+            clearTimeout(timeout_id);
+            timeout_id = setTimeout(step, Math.max(0, wait));
+        });
 
         btn.addEventListener('click', () => {
             if (is_auto_scroll) {
                 // 取消自动翻页
-                clearInterval(interval_id);
-                btn.textContent = '点我开始自动翻页';
-                btn.style.backgroundColor = 'orange';
+                stop('点我开始自动翻页', 'orange');
                 flag_changed = false;
+                return;
             }
-            else {
-                // 开始自动翻页，3s 向下滚动 300px
-                // 相比较 1s 滚动 100px 可以降低访问的频率
-                interval_id = setInterval(() => {
-                    // 有小数的情况，需要取整
-                    const is_end = Math.ceil(scroll_target.scrollTop) >= Math.ceil(scroll_target.scrollHeight - scroll_target.clientHeight);
-                    if (is_end) {
-                        clearInterval(interval_id);
-                        is_auto_scroll = false;
-                        btn.textContent = '到底了，点我重新自动翻页';
-                        btn.style.backgroundColor = 'yellowgreen';
-                        return;
-                    }
-
-                    const flag = can_continue();
-                    if (flag == 'wait') {
-                        btn.textContent = '正在等待小图片加载，点我停止自动翻页';
-                        flag_changed = true;
-                        return;
-                    }
-                    if (flag == 'error') {
-                        clearInterval(interval_id);
-                        is_auto_scroll = false;
-                        btn.textContent = '出现致命错误，脚本已无法工作';
-                        btn.style.backgroundColor = 'grey';
-                        btn.disabled = true;
-                        return;
-                    }
-                    if (flag_changed) {
-                        btn.textContent = '点我停止自动翻页';
-                        flag_changed = false;
-                    }
-
-                    scroll_target.scrollTop += 300;
-                }, 3000);
-                btn.textContent = '点我停止自动翻页';
-                btn.style.backgroundColor = 'orangered';
-            }
-            is_auto_scroll = !is_auto_scroll;
+
+            is_auto_scroll = true;
+            // 获取还缺少哪些页，已经下载过的页会被直接跳过
+            load_missing_pages().then(pages => { missing_pages = pages; });
+            btn.textContent = '点我停止自动翻页';
+            btn.style.backgroundColor = 'orangered';
+            timeout_id = setTimeout(step, DEFAULT_INTERVAL);
         });
 
         document.body.appendChild(btn);